@@ -1,24 +1,44 @@
 from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory
-import json
 import os
 import csv
+import bisect
+import tempfile
+import threading
 from datetime import datetime
 
+from config_publisher import atomic_write
+from device_store import DeviceStore, normalize_mac
+from bulk_import import IMPORT_FORMATS, ImportManager, detect_format
+from config_jobs import RegenerationQueue
+
 app = Flask(__name__)
 
 # Directorios
 CONFIG_DIR = 'fanvil-provisioning/config'
+DEVICES_DB = 'devices.db'
+# Almacén anterior; se importa a DEVICES_DB la primera vez
 DEVICES_FILE = 'devices.json'
+# Hilos que regeneran archivos de configuración en segundo plano
+REGENERATION_WORKERS = 8
+
+# Servicios de la aplicación, creados al usarlos por primera vez: importar el módulo
+# (p. ej. desde benchmark_configs.py) no abre la base de datos ni arranca hilos
+_services = {}
+_services_lock = threading.RLock()
 
-def load_devices():
-    if os.path.exists(DEVICES_FILE):
-        with open(DEVICES_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+def _service(name, factory):
+    """Devuelve el servicio indicado, creándolo con factory la primera vez"""
+    service = _services.get(name)
+    if service is None:
+        with _services_lock:
+            service = _services.get(name)
+            if service is None:
+                service = _services[name] = factory()
+    return service
 
-def save_devices(devices):
-    with open(DEVICES_FILE, 'w') as f:
-        json.dump(devices, f, indent=2)
+def get_device_store():
+    """Dispositivos en SQLite: lecturas y escrituras por dispositivo, seguras con varios workers"""
+    return _service('device_store', lambda: DeviceStore(DEVICES_DB, legacy_json=DEVICES_FILE))
 
 def get_mac_from_filename(filename):
     """Extrae la MAC del nombre de archivo (ej. sip.cfg001122334455 -> 00:11:22:33:44:55)"""
@@ -28,34 +48,97 @@ def get_mac_from_filename(filename):
             return ':'.join(mac_part[i:i+2] for i in range(0, 12, 2)).upper()
     return filename
 
+# Listado de archivos de configuración; solo se vuelve a escanear cuando cambia el directorio
+_config_files_cache = {'key': None, 'snapshot': ([], [])}
+_config_files_lock = threading.Lock()
+
 def get_config_files():
-    """Obtiene la lista de archivos de configuración existentes"""
-    if not os.path.exists(CONFIG_DIR):
-        return []
+    """Obtiene la lista de archivos de configuración existentes, ordenada por nombre"""
+    return _config_files_snapshot()[0]
+
+def _config_files_snapshot():
+    """Devuelve (archivos, nombres) del directorio de configuración, desde la caché si no ha cambiado"""
+    try:
+        # Los archivos se escriben con rename, que actualiza la fecha del directorio
+        st = os.stat(CONFIG_DIR)
+    except OSError:
+        return [], []
+    key = (st.st_ino, st.st_mtime_ns)
+    
+    with _config_files_lock:
+        if _config_files_cache['key'] == key:
+            return _config_files_cache['snapshot']
+    
     config_files = []
-    for filename in os.listdir(CONFIG_DIR):
-        if filename.startswith('sip.cfg'):
-            mac = get_mac_from_filename(filename)
-            config_files.append({
-                'filename': filename,
-                'mac': mac,
-                'path': os.path.join(CONFIG_DIR, filename),
-                'modified': datetime.fromtimestamp(os.path.getmtime(os.path.join(CONFIG_DIR, filename))).strftime('%Y-%m-%d %H:%M:%S')
-            })
-    return sorted(config_files, key=lambda x: x['mac'])
+    with os.scandir(CONFIG_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith('sip.cfg') and entry.is_file():
+                config_files.append({
+                    'filename': entry.name,
+                    'mac': get_mac_from_filename(entry.name),
+                    'path': entry.path,
+                    'modified': datetime.fromtimestamp(entry.stat().st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+                })
+    config_files.sort(key=lambda x: x['filename'])
+    snapshot = (config_files, [f['filename'] for f in config_files])
+    
+    with _config_files_lock:
+        _config_files_cache.update(key=key, snapshot=snapshot)
+    return snapshot
+
+def _page_limit():
+    """Tamaño de página pedido en ?limit= (entre 1 y 200, por defecto 50)"""
+    try:
+        return min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError:
+        return 50
 
 @app.route('/')
 def index():
-    devices = load_devices()
-    config_files = get_config_files()
-    return render_template('index.html', devices=devices, config_files=config_files)
+    # Los dispositivos y archivos se cargan por páginas desde la API
+    return render_template('index.html')
+
+@app.route('/api/devices')
+def api_devices():
+    """Página de dispositivos: ?limit=, ?cursor=, ?sort=mac|name|username|sip_server|model, ?order=asc|desc, ?q="""
+    try:
+        devices, next_cursor = get_device_store().page(
+            limit=_page_limit(),
+            cursor=request.args.get('cursor'),
+            sort=request.args.get('sort', 'mac'),
+            descending=request.args.get('order') == 'desc',
+            search=request.args.get('q', '').strip() or None
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'devices': [{'key': key, **device} for key, device in devices],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/config_files')
+def api_config_files():
+    """Página de archivos de configuración: ?limit= y ?cursor= (último nombre de archivo recibido)"""
+    config_files, filenames = _config_files_snapshot()
+    limit = _page_limit()
+    cursor = request.args.get('cursor')
+    
+    start = bisect.bisect_right(filenames, cursor) if cursor else 0
+    page = config_files[start:start + limit]
+    
+    return jsonify({
+        'success': True,
+        'config_files': [{key: f[key] for key in ('filename', 'mac', 'modified')} for f in page],
+        'next_cursor': page[-1]['filename'] if start + limit < len(config_files) else None
+    })
 
 @app.route('/add_device', methods=['POST'])
 def add_device():
     data = request.json
-    devices = load_devices()
     
-    mac = data.get('mac').replace(':', '').replace('-', '').replace('.', '').upper()
+    mac = normalize_mac(data.get('mac'))
     if len(mac) != 12:
         return jsonify({'success': False, 'error': 'MAC inválida'})
     
@@ -71,58 +154,46 @@ def add_device():
         'created_at': datetime.now().isoformat()
     }
     
-    devices[mac] = device_info
-    save_devices(devices)
+    get_device_store().put(device_info)
     
-    # Generar archivo de configuración
-    generate_config_file(mac, device_info)
+    # El archivo de configuración se genera en segundo plano
+    job = get_regeneration_queue().submit([mac], {'mac': mac})
     
-    return jsonify({'success': True})
+    return _job_accepted(job, 'api_regenerate_status')
 
 @app.route('/edit_device/<mac>', methods=['POST'])
 def edit_device(mac):
-    original_mac = mac.replace(':', '').replace('-', '').replace('.', '').upper()
     data = request.json
     
-    devices = load_devices()
-    if original_mac in devices:
-        device_info = {
-            'mac': data.get('mac'),
-            'model': data.get('model'),
-            'name': data.get('name'),
-            'username': data.get('username'),
-            'password': data.get('password'),
-            'sip_server': data.get('sip_server'),
-            'port': data.get('port', '5060'),
-            'display_name': data.get('display_name', ''),
-            'created_at': devices[original_mac].get('created_at'),
-            'updated_at': datetime.now().isoformat()
-        }
-        
-        # Eliminar el dispositivo anterior si cambió la MAC
-        new_mac = data.get('mac').replace(':', '').replace('-', '').replace('.', '').upper()
-        if original_mac != new_mac:
-            del devices[original_mac]
-        
-        devices[new_mac] = device_info
-        save_devices(devices)
+    device_info = {
+        'mac': data.get('mac'),
+        'model': data.get('model'),
+        'name': data.get('name'),
+        'username': data.get('username'),
+        'password': data.get('password'),
+        'sip_server': data.get('sip_server'),
+        'port': data.get('port', '5060'),
+        'display_name': data.get('display_name', ''),
+        'updated_at': datetime.now().isoformat()
+    }
+    
+    # Conserva created_at y elimina el dispositivo anterior si cambió la MAC
+    device_info = get_device_store().update(mac, device_info)
+    if device_info is not None:
+        new_mac = normalize_mac(device_info['mac'])
         
-        # Regenerar archivo de configuración
-        generate_config_file(new_mac, device_info)
+        # Regenerar archivo de configuración en segundo plano
+        job = get_regeneration_queue().submit([new_mac], {'mac': new_mac})
         
-        return jsonify({'success': True})
+        return _job_accepted(job, 'api_regenerate_status')
     
     return jsonify({'success': False, 'error': 'Dispositivo no encontrado'})
 
 @app.route('/delete_device/<mac>', methods=['DELETE'])
 def delete_device(mac):
-    clean_mac = mac.replace(':', '').replace('-', '').replace('.', '').upper()
-    devices = load_devices()
+    clean_mac = normalize_mac(mac)
     
-    if clean_mac in devices:
-        del devices[clean_mac]
-        save_devices(devices)
-        
+    if get_device_store().delete(clean_mac):
         # Eliminar archivo de configuración
         config_path = os.path.join(CONFIG_DIR, f'sip.cfg{clean_mac}')
         if os.path.exists(config_path):
@@ -134,13 +205,11 @@ def delete_device(mac):
 
 @app.route('/generate_config/<mac>')
 def generate_config(mac):
-    clean_mac = mac.replace(':', '').replace('-', '').replace('.', '').upper()
-    devices = load_devices()
+    clean_mac = normalize_mac(mac)
     
-    if clean_mac in devices:
-        device_info = devices[clean_mac]
-        generate_config_file(clean_mac, device_info)
-        return jsonify({'success': True})
+    if get_device_store().get(clean_mac) is not None:
+        job = get_regeneration_queue().submit([clean_mac], {'mac': clean_mac})
+        return _job_accepted(job, 'api_regenerate_status')
     
     return jsonify({'success': False, 'error': 'Dispositivo no encontrado'})
 
@@ -169,8 +238,78 @@ account.1.port = {device_info['port']}
 network.lan.ip_assignment = dhcp
 """
     
-    with open(config_path, 'w') as f:
-        f.write(config_content)
+    atomic_write(config_path, config_content)
+
+def get_import_manager():
+    """Importaciones masivas en segundo plano (el estado se guarda en DEVICES_DB)"""
+    return _service('import_manager', lambda: ImportManager(get_device_store(), get_regeneration_queue()))
+
+@app.route('/api/import', methods=['POST'])
+def api_import():
+    """Recibe un inventario CSV/JSON (campo 'file') y lo importa en segundo plano"""
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'success': False, 'error': 'No se ha enviado ningún archivo'}), 400
+    
+    source_format = request.form.get('format') or detect_format(upload.filename)
+    if source_format not in IMPORT_FORMATS:
+        return jsonify({'success': False, 'error': 'Formato no soportado (csv o json)'}), 400
+    
+    # El archivo se guarda en disco por bloques y se procesa fila a fila
+    fd, source_path = tempfile.mkstemp(prefix='fanvil-import-', suffix=f'.{source_format}')
+    with os.fdopen(fd, 'wb') as f:
+        upload.save(f)
+    
+    job = get_import_manager().submit(source_path, upload.filename, source_format)
+    return _job_accepted(job, 'api_import_status')
+
+@app.route('/api/import/<job_id>')
+def api_import_status(job_id):
+    """Progreso, velocidad y errores por fila de una importación"""
+    job = get_import_manager().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Importación no encontrada'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/import')
+def api_import_list():
+    """Últimas importaciones (sin el detalle de errores)"""
+    jobs = [{key: value for key, value in job.items() if key != 'errors'} for job in get_import_manager().recent()]
+    return jsonify({'success': True, 'jobs': jobs})
+
+def get_regeneration_queue():
+    """Regeneración de configuraciones en segundo plano, con una entrada por MAC pendiente"""
+    return _service('regeneration_queue', lambda: RegenerationQueue(
+        get_device_store(), generate_config_file, workers=REGENERATION_WORKERS
+    ))
+
+def _job_accepted(job, status_endpoint):
+    """Respuesta 202 de un trabajo en segundo plano, con la URL de su estado"""
+    return jsonify({'success': True, 'job_id': job.id, 'status_url': url_for(status_endpoint, job_id=job.id)}), 202
+
+@app.route('/api/regenerate', methods=['POST'])
+def api_regenerate():
+    """Regenera todas las configuraciones o solo las de un servidor SIP y/o modelo ({"sip_server": ..., "model": ...})"""
+    data = request.get_json(silent=True) or {}
+    filters = {field: data[field] for field in ('sip_server', 'model') if data.get(field)}
+    regeneration_queue = get_regeneration_queue()
+    job = regeneration_queue.submit_matching(**filters) if filters else regeneration_queue.submit_all()
+    return _job_accepted(job, 'api_regenerate_status')
+
+@app.route('/api/regenerate/<job_id>')
+def api_regenerate_status(job_id):
+    """Progreso, tiempos y errores de una regeneración"""
+    job = get_regeneration_queue().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo no encontrado'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/regenerate')
+def api_regenerate_list():
+    """Últimas regeneraciones (sin el detalle de errores) y MAC pendientes en este proceso"""
+    regeneration_queue = get_regeneration_queue()
+    jobs = [{key: value for key, value in job.items() if key != 'errors'} for job in regeneration_queue.recent()]
+    return jsonify({'success': True, 'pending': regeneration_queue.pending(), 'jobs': jobs})
 
 @app.route('/config/<filename>')
 def download_config(filename):
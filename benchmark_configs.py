@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Benchmark del pipeline de generación de configuraciones Fanvil
+"""
+
+import io
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+import xml.etree.ElementTree as ET
+
+import generate_fanvil_configs as gfc
+from fanvil_provisioner import ConfigGenerator, FanvilXmlWriter
+
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+TRANSPORTS = ['udp', 'tcp', 'tls', 'dns srv']
+MODELS = ['X4U', 'X5U', 'X6U', 'H5', 'C62']
+
+
+def synth_phones(count, seed=0):
+    """Genera un inventario sintético mezclando una y dos cuentas y los cuatro transportes"""
+    rng = random.Random(seed)
+    for i in range(count):
+        extension = 1000 + 2 * i
+        phone = {
+            'mac_address': f'0c:38:3e:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}',
+            'model': MODELS[i % len(MODELS)],
+            'account.1.user_id': str(extension),
+            'account.1.password': f'pw{rng.getrandbits(48):012x}',
+            'account.1.server_address': f'sip{i % 7}.example.com',
+            'account.1.display_name': f'Usuario {extension}',
+            'account.1.auth_id': str(extension),
+            'account.1.sip_port': '5060',
+            'account.1.outbound_proxy_primary': 'proxy.example.com' if i % 3 == 0 else '',
+            'account.1.sip_transport': rng.choice(TRANSPORTS),
+        }
+        if rng.random() < 0.5:
+            phone.update({
+                'account.2.user_id': str(extension + 1),
+                'account.2.password': f'pw{rng.getrandbits(48):012x}',
+                'account.2.server_address': phone['account.1.server_address'],
+                'account.2.display_name': f'Usuario {extension + 1}',
+                'account.2.auth_id': str(extension + 1),
+                'account.2.sip_transport': rng.choice(TRANSPORTS),
+            })
+        yield gfc.apply_batch_defaults(phone)
+
+
+def _device_info(phone):
+    """Convierte un teléfono del inventario al formato de dispositivo de app.py"""
+    return {
+        'mac': phone['mac_address'],
+        'model': phone['model'],
+        'name': phone['account.1.display_name'],
+        'username': phone['account.1.user_id'],
+        'password': phone['account.1.password'],
+        'sip_server': phone['account.1.server_address'],
+        'port': phone['account.1.sip_port'],
+        'display_name': phone['account.1.display_name'],
+    }
+
+
+def bench_render(phones, template, workdir):
+    """create_config_from_data: renderizado en memoria"""
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        start = perf_counter()
+        content = gfc.create_config_from_data(template, phone)
+        elapsed += perf_counter() - start
+        output_bytes += len(content)
+    return elapsed, output_bytes
+
+
+def bench_write(phones, template, workdir):
+    """create_config_file: renderizado y escritura en disco"""
+    output_dir = os.path.join(workdir, 'xml')
+    os.makedirs(output_dir, exist_ok=True)
+    elapsed = 0.0
+    output_bytes = 0
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for phone in phones:
+            start = perf_counter()
+            filepath = gfc.create_config_file(phone['mac_address'], phone, template, output_dir)
+            elapsed += perf_counter() - start
+            output_bytes += os.path.getsize(filepath)
+    return elapsed, output_bytes
+
+
+def bench_cfg(phones, template, workdir):
+    """ConfigGenerator._dict_to_cfg: serialización CFG en memoria"""
+    generator = ConfigGenerator(os.path.join(workdir, 'provisioner'))
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        start = perf_counter()
+        content = generator._dict_to_cfg(phone)
+        elapsed += perf_counter() - start
+        output_bytes += len(content)
+    return elapsed, output_bytes
+
+
+def bench_xml(phones, template, workdir):
+    """ConfigGenerator.generate_xml_config: XML por dispositivo en disco"""
+    generator = ConfigGenerator(os.path.join(workdir, 'provisioner'))
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        start = perf_counter()
+        filepath = generator.generate_xml_config(phone['mac_address'], phone)
+        elapsed += perf_counter() - start
+        output_bytes += os.path.getsize(filepath)
+    return elapsed, output_bytes
+
+
+def render_xml_etree(params):
+    """Serialización FanvilConfig con ElementTree, como la hacía ConfigGenerator antes de FanvilXmlWriter"""
+    root = ET.Element("FanvilConfig")
+    for key, value in params.items():
+        param_elem = ET.SubElement(root, "param")
+        param_elem.set("name", key)
+        param_elem.set("value", str(value))
+    tree = ET.ElementTree(root)
+    ET.indent(tree, space="  ", level=0)
+    buffer = io.BytesIO()
+    tree.write(buffer, encoding="utf-8", xml_declaration=True)
+    return buffer.getvalue()
+
+
+def bench_xml_etree(phones, template, workdir):
+    """ElementTree + ET.indent: serialización FanvilConfig en memoria (referencia)"""
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        start = perf_counter()
+        content = render_xml_etree(phone)
+        elapsed += perf_counter() - start
+        output_bytes += len(content)
+    return elapsed, output_bytes
+
+
+def bench_xml_stream(phones, template, workdir):
+    """FanvilXmlWriter: serialización FanvilConfig en memoria, comprobada contra ElementTree"""
+    writer = FanvilXmlWriter()
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        start = perf_counter()
+        content = writer.render(phone)
+        elapsed += perf_counter() - start
+        output_bytes += len(content)
+        if content != render_xml_etree(phone):
+            raise AssertionError(f"Salida distinta de ElementTree para {phone['mac_address']}")
+    return elapsed, output_bytes
+
+
+def bench_app(phones, template, workdir):
+    """app.generate_config_file: configuración de la aplicación web"""
+    import app as web_app
+    web_app.CONFIG_DIR = os.path.join(workdir, 'app')
+    elapsed = 0.0
+    output_bytes = 0
+    for phone in phones:
+        device_info = _device_info(phone)
+        mac = gfc.clean_mac(phone['mac_address']).upper()
+        start = perf_counter()
+        web_app.generate_config_file(mac, device_info)
+        elapsed += perf_counter() - start
+        output_bytes += os.path.getsize(os.path.join(web_app.CONFIG_DIR, f'sip.cfg{mac}'))
+    return elapsed, output_bytes
+
+
+PHASES = {
+    'render': bench_render,
+    'write': bench_write,
+    'cfg': bench_cfg,
+    'xml': bench_xml,
+    'xml_etree': bench_xml_etree,
+    'xml_stream': bench_xml_stream,
+    'app': bench_app,
+}
+
+
+def run_phase(name, size, template, seed, measure_memory):
+    """Ejecuta una fase sobre un inventario sintético y devuelve sus métricas"""
+    phase = PHASES[name]
+    with tempfile.TemporaryDirectory(prefix=f'fanvil-bench-{name}-') as workdir:
+        try:
+            wall_start = perf_counter()
+            elapsed, output_bytes = phase(synth_phones(size, seed), template, workdir)
+            wall = perf_counter() - wall_start
+        except ImportError as e:
+            return {'skipped': f"Dependencia no disponible: {e}"}
+    
+    result = {
+        'seconds': round(elapsed, 6),
+        'wall_seconds': round(wall, 6),
+        'per_second': round(size / elapsed, 1) if elapsed else None,
+        'us_per_item': round(elapsed / size * 1e6, 3) if size else None,
+        'output_bytes': output_bytes,
+    }
+    
+    if measure_memory:
+        # Segunda pasada con tracemalloc para no distorsionar los tiempos
+        with tempfile.TemporaryDirectory(prefix=f'fanvil-bench-{name}-') as workdir:
+            tracemalloc.start()
+            phase(synth_phones(size, seed), template, workdir)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    
+    return result
+
+
+def run_benchmark(sizes, phases, template, seed=0, measure_memory=True):
+    """Ejecuta todas las fases para cada tamaño de inventario"""
+    results = []
+    for size in sizes:
+        phase_results = {}
+        for name in phases:
+            print(f"[{size}] {name}...", file=sys.stderr)
+            phase_results[name] = run_phase(name, size, template, seed, measure_memory)
+        
+        total = sum(r['seconds'] for r in phase_results.values() if 'seconds' in r)
+        for r in phase_results.values():
+            if 'seconds' in r:
+                r['share'] = round(r['seconds'] / total, 4) if total else None
+        
+        results.append({'size': size, 'total_seconds': round(total, 6), 'phases': phase_results})
+    
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del pipeline de generación de configuraciones Fanvil')
+    parser.add_argument('--template', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fanvil-template.xml'),
+                        help='Ruta a la plantilla XML (por defecto: fanvil-template.xml junto al script)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Tamaños de inventario (por defecto: 1000 10000 100000)')
+    parser.add_argument('--phases', nargs='+', choices=list(PHASES), default=list(PHASES), help='Fases a medir (por defecto: todas)')
+    parser.add_argument('--seed', type=int, default=0, help='Semilla del inventario sintético (por defecto: 0)')
+    parser.add_argument('--no-memory', action='store_true', help='No medir el pico de memoria (evita la segunda pasada)')
+    parser.add_argument('--output', help='Archivo JSON de resultados (por defecto: salida estándar)')
+    
+    args = parser.parse_args()
+    
+    template = gfc.load_template(args.template)
+    report = run_benchmark(args.sizes, args.phases, template, seed=args.seed, measure_memory=not args.no_memory)
+    report['template'] = args.template
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Resultados guardados en: {args.output}", file=sys.stderr)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Importación masiva de inventarios CSV/JSON en la aplicación web
+"""
+
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from config_jobs import MAX_REPORTED_ERRORS, RegenerationQueue
+from device_store import DeviceStore, normalize_mac
+from generate_fanvil_configs import iter_phone_data_from_csv, iter_phone_data_from_json
+
+
+# Filas que se guardan juntas en una transacción (no más de MAX_REPORTED_ERRORS, para
+# que la regeneración de cada bloque informe de todos sus errores)
+IMPORT_CHUNK_SIZE = 500
+
+# Columnas obligatorias del inventario (mismo formato que sample_phones.csv)
+IMPORT_REQUIRED_FIELDS = ('mac_address', 'account.1.user_id', 'account.1.password', 'account.1.server_address')
+
+IMPORT_FORMATS = {
+    'csv': iter_phone_data_from_csv,
+    'json': iter_phone_data_from_json,
+}
+
+
+def detect_format(filename: str) -> Optional[str]:
+    """Formato del inventario según la extensión del archivo"""
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    return extension if extension in IMPORT_FORMATS else None
+
+
+def validate_phone(phone) -> Optional[str]:
+    """Devuelve el error de una fila del inventario o None si es válida"""
+    if not isinstance(phone, dict):
+        return "La fila no es un objeto"
+    if None in phone:
+        return "La fila tiene más columnas que el encabezado"
+    missing = [field for field in IMPORT_REQUIRED_FIELDS if not str(phone.get(field) or '').strip()]
+    if missing:
+        return f"Faltan campos obligatorios: {', '.join(missing)}"
+    
+    mac = normalize_mac(str(phone['mac_address']).strip())
+    if len(mac) != 12 or any(c not in '0123456789ABCDEF' for c in mac):
+        return f"MAC inválida: {phone['mac_address']}"
+    
+    port = str(phone.get('account.1.sip_port') or '5060').strip()
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        return f"Puerto SIP inválido: {port}"
+    return None
+
+
+def phone_to_device(phone: Dict, created_at: str) -> Dict:
+    """Convierte una fila del inventario al formato de dispositivo de la aplicación"""
+    display_name = str(phone.get('account.1.display_name') or '').strip()
+    return {
+        'mac': str(phone['mac_address']).strip(),
+        'model': str(phone.get('model') or '').strip(),
+        'name': display_name or str(phone['account.1.user_id']).strip(),
+        'username': str(phone['account.1.user_id']).strip(),
+        'password': str(phone['account.1.password']),
+        'sip_server': str(phone['account.1.server_address']).strip(),
+        'port': str(phone.get('account.1.sip_port') or '5060').strip(),
+        'display_name': display_name,
+        'created_at': created_at,
+    }
+
+
+class ImportJob:
+    """Estado de una importación: progreso, velocidad y errores por fila"""
+    
+    KIND = 'import'
+    
+    def __init__(self, filename: str, source_format: str):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.format = source_format
+        self.status = 'queued'  # 'queued', 'running', 'done', 'failed'
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.processed = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.error = None
+        self._started = None
+        self._elapsed = 0.0
+    
+    def add_error(self, row: int, mac: Optional[str], message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'mac': mac, 'error': message})
+    
+    def to_dict(self) -> Dict:
+        elapsed = perf_counter() - self._started if self.status == 'running' else self._elapsed
+        return {
+            'id': self.id,
+            'kind': self.KIND,
+            'filename': self.filename,
+            'format': self.format,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'processed': self.processed,
+            'imported': self.imported,
+            'failed': self.failed,
+            'elapsed_seconds': round(elapsed, 3),
+            'rows_per_second': round(self.processed / elapsed, 1) if elapsed else None,
+            'errors': self.errors,
+            'errors_truncated': max(self.failed - len(self.errors), 0),
+            'error': self.error,
+        }
+
+
+class ImportManager:
+    """
+    Ejecuta las importaciones en segundo plano
+    
+    El inventario subido se lee fila a fila (sin cargarlo entero en
+    memoria), cada bloque de filas válidas se guarda en una sola transacción
+    y sus archivos de configuración se generan en la cola de regeneración,
+    cuyos errores se anotan en la fila correspondiente. El estado del
+    trabajo se guarda en el almacén tras cada bloque, de modo que cualquier
+    proceso de la aplicación puede informar del progreso.
+    """
+    
+    def __init__(self, store: DeviceStore, regeneration: RegenerationQueue,
+                 workers: int = 1, chunk_size: int = IMPORT_CHUNK_SIZE):
+        self.store = store
+        self.regeneration = regeneration
+        self.chunk_size = min(chunk_size, MAX_REPORTED_ERRORS)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import')
+    
+    def submit(self, source_path: str, filename: str, source_format: str) -> ImportJob:
+        """Encola la importación de un archivo ya guardado en disco (se elimina al terminar)"""
+        job = ImportJob(filename, source_format)
+        self._save(job)
+        self._executor.submit(self._run, job, source_path)
+        return job
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        job = self.store.get_job(job_id)
+        return job if job and job.get('kind') == ImportJob.KIND else None
+    
+    def recent(self, limit: int = 20) -> List[Dict]:
+        return self.store.list_jobs(ImportJob.KIND, limit)
+    
+    def _save(self, job: ImportJob):
+        self.store.save_job(job.id, job.KIND, job.created_at, job.to_dict())
+    
+    def _run(self, job: ImportJob, source_path: str):
+        job.status = 'running'
+        job.started_at = datetime.now().isoformat()
+        job._started = perf_counter()
+        self._save(job)
+        
+        try:
+            chunk = []
+            for row, phone in enumerate(IMPORT_FORMATS[job.format](source_path), 1):
+                job.processed += 1
+                error = validate_phone(phone)
+                if error:
+                    job.add_error(row, phone.get('mac_address') if isinstance(phone, dict) else None, error)
+                    continue
+                chunk.append((row, phone_to_device(phone, job.created_at)))
+                if len(chunk) >= self.chunk_size:
+                    self._import_chunk(job, chunk)
+                    chunk = []
+            if chunk:
+                self._import_chunk(job, chunk)
+            job.status = 'done'
+        except Exception as e:
+            # Archivo mal formado o error de almacenamiento: se conserva lo ya importado
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job._elapsed = perf_counter() - job._started
+            job.finished_at = datetime.now().isoformat()
+            self._save(job)
+            try:
+                os.remove(source_path)
+            except OSError:
+                pass
+    
+    def _import_chunk(self, job: ImportJob, chunk: List[Tuple[int, Dict]]):
+        """Guarda un bloque de dispositivos y espera a que la cola de regeneración genere sus configuraciones"""
+        keys = self.store.put_many([device for _, device in chunk])
+        regeneration = self.regeneration.submit(keys, {'import': job.id})
+        regeneration.wait()
+        failed = {error['mac']: error['error'] for error in regeneration.errors}
+        for (row, device), key in zip(chunk, keys):
+            if key in failed:
+                job.add_error(row, device['mac'], f"Error al generar configuración: {failed[key]}")
+            else:
+                job.imported += 1
+        self._save(job)
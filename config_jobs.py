@@ -0,0 +1,219 @@
+"""
+Cola de regeneración de archivos de configuración de la aplicación web
+"""
+
+import os
+import uuid
+import queue
+import threading
+from datetime import datetime
+from time import monotonic, perf_counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+from device_store import DeviceStore
+
+
+# Hilos que generan archivos en paralelo (la generación es sobre todo E/S de disco)
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Intervalo mínimo entre guardados del progreso de un trabajo en el almacén
+SAVE_INTERVAL = 1.0
+# Errores por dispositivo que se guardan en el informe (el resto solo se cuentan)
+MAX_REPORTED_ERRORS = 1000
+
+
+class RegenerationJob:
+    """Estado de una regeneración: progreso, tiempos y errores por dispositivo"""
+    
+    KIND = 'regenerate'
+    
+    def __init__(self, scope: Dict):
+        self.id = uuid.uuid4().hex
+        self.scope = scope
+        self.status = 'queued'  # 'queued', 'running', 'done'
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.total = 0
+        self.deduplicated = 0
+        self.generated = 0
+        self.failed = 0
+        self.errors = []
+        self.generate_seconds = 0.0
+        self._queued = perf_counter()
+        self._started = None
+        self._finished = None
+        self._saved = 0.0
+        self._version = 0
+        self._saved_version = 0
+        self._done = threading.Event()
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que terminen todas las generaciones del trabajo; False si vence timeout"""
+        return self._done.wait(timeout)
+    
+    @property
+    def completed(self) -> int:
+        return self.generated + self.failed
+    
+    def to_dict(self) -> Dict:
+        now = perf_counter()
+        elapsed = ((self._finished or now) - self._started) if self._started else 0.0
+        return {
+            'id': self.id,
+            'kind': self.KIND,
+            'scope': self.scope,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'total': self.total,
+            'deduplicated': self.deduplicated,
+            'generated': self.generated,
+            'failed': self.failed,
+            'wait_seconds': round((self._started or now) - self._queued, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'configs_per_second': round(self.completed / elapsed, 1) if elapsed else None,
+            'avg_generate_ms': round(self.generate_seconds / self.completed * 1000, 3) if self.completed else None,
+            'errors': self.errors,
+            'errors_truncated': max(self.failed - len(self.errors), 0),
+        }
+
+
+class RegenerationQueue:
+    """
+    Regenera archivos de configuración en segundo plano con un grupo de hilos
+    
+    Cada trabajo encola las MAC de sus dispositivos. Una MAC que ya está
+    pendiente no se vuelve a encolar: el trabajo nuevo espera a la misma
+    generación, que lee el dispositivo del almacén justo antes de escribir y
+    por tanto usa sus datos más recientes. La MAC deja de estar pendiente al
+    empezar a generarse, así que un cambio durante la generación la vuelve a
+    encolar. El estado de los trabajos se guarda en el almacén, de modo que
+    cualquier proceso de la aplicación puede consultarlo.
+    """
+    
+    def __init__(self, store: DeviceStore, generate_config: Callable[[str, Dict], None],
+                 workers: int = DEFAULT_WORKERS):
+        self.store = store
+        self.generate_config = generate_config
+        self.workers = workers
+        self._queue = queue.SimpleQueue()
+        self._pending = {}  # MAC -> trabajos que esperan su generación
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._threads = []
+    
+    def submit(self, keys: Iterable[str], scope: Dict) -> RegenerationJob:
+        """Encola la regeneración de las MAC normalizadas indicadas"""
+        job = RegenerationJob(scope)
+        with self._lock:
+            self._start_workers()
+            for key in keys:
+                job.total += 1
+                waiting = self._pending.get(key)
+                if waiting is None:
+                    self._pending[key] = [job]
+                    self._queue.put(key)
+                else:
+                    waiting.append(job)
+                    job.deduplicated += 1
+            if job.total == 0:
+                self._finish(job)
+            snapshot = self._snapshot(job)
+        self._save(job, *snapshot)
+        return job
+    
+    def submit_all(self) -> RegenerationJob:
+        return self.submit(self.store.keys(), {'all': True})
+    
+    def submit_matching(self, **filters) -> RegenerationJob:
+        """Regenera los dispositivos cuyos campos coinciden (p. ej. sip_server o model); ValueError si un campo no es válido"""
+        return self.submit(self.store.keys(**filters), filters)
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        job = self.store.get_job(job_id)
+        return job if job and job.get('kind') == RegenerationJob.KIND else None
+    
+    def recent(self, limit: int = 20) -> List[Dict]:
+        return self.store.list_jobs(RegenerationJob.KIND, limit)
+    
+    def pending(self) -> int:
+        """MAC pendientes de generar en este proceso"""
+        with self._lock:
+            return len(self._pending)
+    
+    def _start_workers(self):
+        # Los hilos se crean con el primer trabajo, después del fork de los workers de gunicorn
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'regenerate-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def _snapshot(self, job: RegenerationJob):
+        """Copia numerada del estado del trabajo (se llama con el lock tomado)"""
+        job._saved = monotonic()
+        job._version += 1
+        return job._version, job.to_dict()
+    
+    def _save(self, job: RegenerationJob, version: int, data: Dict):
+        # Los hilos guardan fuera del lock principal; nunca se sobrescribe un estado más reciente
+        with self._save_lock:
+            if version > job._saved_version:
+                self.store.save_job(job.id, job.KIND, job.created_at, data)
+                job._saved_version = version
+    
+    def _finish(self, job: RegenerationJob):
+        job.status = 'done'
+        job._finished = perf_counter()
+        job.finished_at = datetime.now().isoformat()
+        if job._started is None:
+            job._started = job._finished
+            job.started_at = job.finished_at
+        job._done.set()
+    
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                jobs = self._pending.pop(key)
+                for job in jobs:
+                    if job._started is None:
+                        job.status = 'running'
+                        job._started = perf_counter()
+                        job.started_at = datetime.now().isoformat()
+            
+            start = perf_counter()
+            error = None
+            try:
+                device = self.store.get(key)
+                if device is None:
+                    error = "Dispositivo no encontrado"
+                else:
+                    self.generate_config(key, device)
+            except Exception as e:
+                error = str(e)
+            elapsed = perf_counter() - start
+            
+            to_save = []
+            with self._lock:
+                for job in jobs:
+                    job.generate_seconds += elapsed
+                    if error is None:
+                        job.generated += 1
+                    else:
+                        job.failed += 1
+                        if len(job.errors) < MAX_REPORTED_ERRORS:
+                            job.errors.append({'mac': key, 'error': error})
+                    if job.completed == job.total:
+                        self._finish(job)
+                    if job.status == 'done' or monotonic() - job._saved >= SAVE_INTERVAL:
+                        to_save.append((job, *self._snapshot(job)))
+            
+            for job, version, data in to_save:
+                try:
+                    self._save(job, version, data)
+                except Exception:
+                    # Un fallo al guardar el progreso no debe detener la cola
+                    pass
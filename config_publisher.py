@@ -0,0 +1,178 @@
+"""
+Publicación atómica de directorios de configuración generados
+"""
+
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Union
+
+
+STAGING_SUFFIX = '.staging'
+VERSION_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+
+def _tmp_path(filepath: str) -> str:
+    """Temporal junto a filepath, único por proceso e hilo"""
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def atomic_write(filepath: Union[str, Path], content: Union[str, bytes], encoding: str = 'utf-8'):
+    """Escribe un archivo mediante un temporal y rename, sin exponer archivos a medio escribir"""
+    filepath = os.fspath(filepath)
+    tmp_path = _tmp_path(filepath)
+    
+    try:
+        if isinstance(content, bytes):
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+        else:
+            with open(tmp_path, 'w', encoding=encoding) as f:
+                f.write(content)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def atomic_writer(filepath: Union[str, Path]) -> Iterator[BinaryIO]:
+    """Abre un temporal binario que sustituye a filepath con rename al salir del bloque sin errores"""
+    filepath = os.fspath(filepath)
+    tmp_path = _tmp_path(filepath)
+    
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ReleasePublisher:
+    """
+    Publica lotes completos de configuraciones de forma atómica
+    
+    El directorio publicado (live_dir) pasa a ser un enlace simbólico a una
+    versión dentro de .<nombre>.releases/. Cada lote se escribe en un
+    directorio de staging, inicializado con enlaces duros a la versión actual,
+    y se publica cambiando el enlace con un único rename. Las versiones
+    anteriores se conservan para poder volver atrás al instante.
+    
+    La primera publicación sobre un directorio real no es atómica: ese
+    directorio debe apartarse antes de poner el enlace en su lugar, y entre
+    los dos rename live_dir no existe durante un instante.
+    """
+    
+    def __init__(self, live_dir: Union[str, Path], keep: int = 3):
+        # Resolver el directorio padre para comparar rutas de versiones sin ambigüedad
+        live_dir = os.path.abspath(live_dir)
+        self.live_dir = Path(os.path.realpath(os.path.dirname(live_dir))) / os.path.basename(live_dir)
+        self.releases_dir = self.live_dir.parent / f".{self.live_dir.name}.releases"
+        self.keep = max(keep, 2)
+        self.staging_dir = None
+    
+    def releases(self) -> List[Path]:
+        """Versiones publicadas, de la más antigua a la más reciente"""
+        if not self.releases_dir.is_dir():
+            return []
+        return sorted(
+            path for path in self.releases_dir.iterdir()
+            if path.is_dir() and not path.name.endswith(STAGING_SUFFIX)
+        )
+    
+    def current_release(self) -> Optional[Path]:
+        """Versión a la que apunta actualmente el enlace publicado"""
+        if not self.live_dir.is_symlink():
+            return None
+        return Path(os.path.realpath(self.live_dir))
+    
+    def stage(self) -> Path:
+        """Crea el directorio de staging del siguiente lote y lo devuelve"""
+        self.releases_dir.mkdir(parents=True, exist_ok=True)
+        version = datetime.now().strftime(VERSION_FORMAT)
+        staging_dir = self.releases_dir / f"{version}{STAGING_SUFFIX}"
+        staging_dir.mkdir()
+        
+        # Partir de la versión actual para que solo cambien los archivos regenerados
+        if self.live_dir.is_dir():
+            for entry in os.scandir(self.live_dir):
+                if entry.is_file(follow_symlinks=False):
+                    target = staging_dir / entry.name
+                    try:
+                        os.link(entry.path, target)
+                    except OSError:
+                        shutil.copy2(entry.path, target)
+        
+        self.staging_dir = staging_dir
+        return staging_dir
+    
+    def publish(self) -> Path:
+        """Publica el staging actual como nueva versión y devuelve su ruta"""
+        if self.staging_dir is None:
+            raise RuntimeError("No hay ningún lote en staging para publicar")
+        
+        release = self.staging_dir.with_name(self.staging_dir.name[:-len(STAGING_SUFFIX)])
+        os.rename(self.staging_dir, release)
+        self.staging_dir = None
+        
+        tmp_link = self._link_to(release)
+        if self.live_dir.is_dir() and not self.live_dir.is_symlink():
+            # Primera publicación: el directorio real se conserva como versión anterior.
+            # El enlace ya está creado, así que live_dir solo falta entre estos dos rename
+            mtime = datetime.fromtimestamp(self.live_dir.stat().st_mtime)
+            os.rename(self.live_dir, self.releases_dir / mtime.strftime(VERSION_FORMAT))
+        os.replace(tmp_link, self.live_dir)
+        self._cleanup()
+        return release
+    
+    def discard(self):
+        """Descarta el staging actual sin publicarlo"""
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = None
+    
+    def rollback(self) -> Optional[Path]:
+        """Vuelve a publicar la versión anterior a la actual; devuelve None si no la hay"""
+        releases = self.releases()
+        current = self.current_release()
+        if current not in releases:
+            return None
+        
+        index = releases.index(current)
+        if index == 0:
+            return None
+        
+        previous = releases[index - 1]
+        self._switch_to(previous)
+        return previous
+    
+    def _link_to(self, release: Path) -> Path:
+        """Crea junto a live_dir un enlace temporal a release y devuelve su ruta"""
+        tmp_link = self.live_dir.parent / f".{self.live_dir.name}.{os.getpid()}.link"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(release, self.live_dir.parent), tmp_link)
+        return tmp_link
+    
+    def _switch_to(self, release: Path):
+        """Apunta el enlace publicado a release con un rename atómico"""
+        os.replace(self._link_to(release), self.live_dir)
+    
+    def _cleanup(self):
+        """Elimina las versiones más antiguas, conservando las últimas self.keep"""
+        current = self.current_release()
+        for release in self.releases()[:-self.keep]:
+            if release != current:
+                shutil.rmtree(release, ignore_errors=True)
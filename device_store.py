@@ -0,0 +1,330 @@
+"""
+Almacén de dispositivos de la aplicación web, indexado por MAC
+"""
+
+import os
+import json
+import base64
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+
+# Campos de un dispositivo, en el orden de las columnas de la tabla
+DEVICE_FIELDS = (
+    'mac', 'model', 'name', 'username', 'password', 'sip_server', 'port',
+    'display_name', 'created_at', 'updated_at',
+)
+# Campos con una columna normalizada (<campo>_folded) para ordenar y buscar sin distinguir mayúsculas
+FOLDED_FIELDS = ('name', 'username', 'sip_server', 'model')
+# Marcadores de una fila completa: clave + campos + campos normalizados
+_ROW_PLACEHOLDERS = ', '.join('?' * (len(DEVICE_FIELDS) + 1 + len(FOLDED_FIELDS)))
+
+# Expresiones por las que se puede ordenar y buscar; cada una tiene su índice (expresión, clave)
+SORT_EXPRESSIONS = {
+    'mac': "key",
+    **{field: f"{field}_folded" for field in FOLDED_FIELDS},
+}
+# Campos en los que busca el texto libre (por prefijo)
+SEARCH_FIELDS = ('mac', 'name', 'username', 'sip_server')
+
+# Mayor carácter Unicode: prefijo + MAX_CHAR acota por arriba todas las cadenas con ese prefijo
+_MAX_CHAR = '\U0010ffff'
+
+
+def fold(value) -> str:
+    """
+    Texto normalizado para ordenar y buscar sin distinguir mayúsculas
+    
+    Se calcula en Python tanto al guardar como al buscar: lower() de SQLite
+    solo convierte ASCII, por lo que 'Ñ' o 'É' no coincidirían con su minúscula.
+    """
+    return unicodedata.normalize('NFC', '' if value is None else str(value)).casefold()
+
+
+def normalize_mac(mac: str) -> str:
+    """MAC en mayúsculas y sin separadores, tal como se usa como clave"""
+    return mac.replace(':', '').replace('-', '').replace('.', '').upper()
+
+
+class DeviceStore:
+    """
+    Dispositivos guardados en SQLite, con lecturas y escrituras por dispositivo
+    
+    Sustituye a devices.json: cada operación toca solo la fila afectada y las
+    escrituras son transacciones de SQLite, por lo que varios procesos (por
+    ejemplo, workers de gunicorn) pueden compartir el mismo archivo sin
+    perder actualizaciones.
+    """
+    
+    # Pragmas aplicados a cada conexión nueva
+    CONNECTION_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=30000",
+    )
+    
+    # 1: importación de devices.json, 2: índices de búsqueda y ordenación (sobre lower()),
+    # 3: trabajos en segundo plano, 4: columnas normalizadas en Python para ordenar y buscar
+    SCHEMA_VERSION = 4
+    
+    SCHEMA = f'''
+        CREATE TABLE IF NOT EXISTS devices (
+            key TEXT PRIMARY KEY, -- MAC normalizada
+            {', '.join(f'{field} TEXT' for field in DEVICE_FIELDS)},
+            {', '.join(f'{field}_folded TEXT' for field in FOLDED_FIELDS)}
+        )
+    '''
+    
+    def __init__(self, db_path: str = 'devices.db', legacy_json: Optional[str] = None):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_database(legacy_json)
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """Devuelve la conexión persistente del hilo actual, creándola si hace falta"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for pragma in self.CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Transacción de escritura; BEGIN IMMEDIATE evita carreras de lectura-modificación-escritura"""
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def _init_database(self, legacy_json: Optional[str]):
+        """Crea la tabla e importa devices.json la primera vez (una sola vez aunque arranquen varios procesos)"""
+        with self.transaction() as conn:
+            conn.execute(self.SCHEMA)
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= self.SCHEMA_VERSION:
+                return
+            if version < 1 and legacy_json and os.path.exists(legacy_json):
+                with open(legacy_json, 'r') as f:
+                    legacy_devices = json.load(f)
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO devices VALUES ({_ROW_PLACEHOLDERS})",
+                    [self._row(key, device) for key, device in legacy_devices.items()]
+                )
+            if version < 3:
+                # Estado de los trabajos en SQLite: cualquier worker puede consultarlo, no solo el que lo ejecuta
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        created_at TEXT NOT NULL,
+                        data TEXT NOT NULL -- JSON con el estado del trabajo
+                    )
+                ''')
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_kind_created_at ON jobs (kind, created_at)")
+            if version < 4:
+                self._add_folded_columns(conn)
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+    
+    @staticmethod
+    def _add_folded_columns(conn: sqlite3.Connection):
+        """Añade y rellena las columnas normalizadas y sustituye los índices sobre lower() por índices sobre ellas"""
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(devices)")}
+        for field in FOLDED_FIELDS:
+            if f'{field}_folded' not in columns:
+                conn.execute(f"ALTER TABLE devices ADD COLUMN {field}_folded TEXT")
+        rows = conn.execute(f"SELECT key, {', '.join(FOLDED_FIELDS)} FROM devices").fetchall()
+        conn.executemany(
+            f"UPDATE devices SET {', '.join(f'{field}_folded = ?' for field in FOLDED_FIELDS)} WHERE key = ?",
+            [(*(fold(row[field]) for field in FOLDED_FIELDS), row['key']) for row in rows]
+        )
+        for field in FOLDED_FIELDS:
+            conn.execute(f"DROP INDEX IF EXISTS idx_devices_{field}")
+            conn.execute(f"CREATE INDEX idx_devices_{field} ON devices ({SORT_EXPRESSIONS[field]}, key)")
+    
+    @staticmethod
+    def _row(key: str, device: Dict) -> tuple:
+        return (
+            key,
+            *(device.get(field) for field in DEVICE_FIELDS),
+            *(fold(device.get(field)) for field in FOLDED_FIELDS),
+        )
+    
+    @staticmethod
+    def _device(row: sqlite3.Row) -> Dict:
+        device = {field: row[field] for field in DEVICE_FIELDS}
+        if device['updated_at'] is None:
+            del device['updated_at']
+        return device
+    
+    def get(self, mac: str) -> Optional[Dict]:
+        """Devuelve un dispositivo por MAC (en cualquier formato) o None"""
+        row = self.get_connection().execute(
+            "SELECT * FROM devices WHERE key = ?", (normalize_mac(mac),)
+        ).fetchone()
+        return self._device(row) if row else None
+    
+    def all(self) -> Dict[str, Dict]:
+        """Todos los dispositivos, por MAC normalizada"""
+        rows = self.get_connection().execute("SELECT * FROM devices ORDER BY key")
+        return {row['key']: self._device(row) for row in rows}
+    
+    def page(self, limit: int = 50, cursor: Optional[str] = None, sort: str = 'mac',
+             descending: bool = False, search: Optional[str] = None) -> Tuple[List[Tuple[str, Dict]], Optional[str]]:
+        """
+        Devuelve una página de dispositivos (clave, dispositivo) y el cursor de la siguiente
+        
+        La paginación es por cursor (el último valor de ordenación y la clave
+        de la página anterior), de modo que cada página recorre solo su tramo
+        del índice, sin OFFSET. La búsqueda es por prefijo, sin distinguir
+        mayúsculas, en MAC, nombre, usuario y servidor SIP. El cursor es None
+        en la última página. Lanza ValueError si sort o cursor no son válidos.
+        """
+        if sort not in SORT_EXPRESSIONS:
+            raise ValueError(f"Campo de ordenación no válido: {sort}")
+        expression = SORT_EXPRESSIONS[sort]
+        conditions = []
+        params = []
+        
+        if search:
+            alternatives = []
+            for field in SEARCH_FIELDS:
+                prefix = normalize_mac(search) if field == 'mac' else fold(search)
+                if not prefix:
+                    continue
+                alternatives.append(f"({SORT_EXPRESSIONS[field]} >= ? AND {SORT_EXPRESSIONS[field]} < ?)")
+                params.extend((prefix, prefix + _MAX_CHAR))
+            conditions.append(f"({' OR '.join(alternatives)})")
+        
+        if cursor:
+            # Equivale a (expresión, clave) > (?, ?), escrito para que SQLite busque en el índice
+            op = '<' if descending else '>'
+            sort_value, key = self._decode_cursor(cursor)
+            conditions.append(f"{expression} {op}= ? AND ({expression} {op} ? OR key {op} ?)")
+            params.extend((sort_value, sort_value, key))
+        
+        direction = 'DESC' if descending else 'ASC'
+        rows = self.get_connection().execute(
+            f"""
+            SELECT *, {expression} AS sort_value FROM devices
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY {expression} {direction}, key {direction}
+            LIMIT ?
+            """,
+            (*params, limit + 1)
+        ).fetchall()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_cursor(rows[-1]['sort_value'], rows[-1]['key'])
+        return [(row['key'], self._device(row)) for row in rows], next_cursor
+    
+    @staticmethod
+    def _encode_cursor(sort_value: str, key: str) -> str:
+        return base64.urlsafe_b64encode(json.dumps([sort_value, key]).encode()).decode()
+    
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[str, str]:
+        try:
+            sort_value, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Cursor no válido: {cursor}") from e
+        return sort_value, key
+    
+    def keys(self, **filters) -> List[str]:
+        """
+        MAC normalizadas de los dispositivos, opcionalmente filtradas por campo
+        
+        Cada filtro (por ejemplo, sip_server='sip.example.com' o model='X4U')
+        compara sin distinguir mayúsculas y usa el índice del campo. Lanza
+        ValueError si un campo no es válido.
+        """
+        conditions = []
+        params = []
+        for field, value in filters.items():
+            if field not in SORT_EXPRESSIONS:
+                raise ValueError(f"Campo de filtro no válido: {field}")
+            conditions.append(f"{SORT_EXPRESSIONS[field]} = ?")
+            params.append(normalize_mac(value) if field == 'mac' else fold(value))
+        rows = self.get_connection().execute(
+            f"SELECT key FROM devices {'WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY key",
+            params
+        )
+        return [row['key'] for row in rows]
+    
+    def count(self) -> int:
+        return self.get_connection().execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+    
+    def put(self, device: Dict) -> str:
+        """Crea o reemplaza un dispositivo y devuelve su MAC normalizada"""
+        key = normalize_mac(device['mac'])
+        with self.transaction() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO devices VALUES ({_ROW_PLACEHOLDERS})",
+                self._row(key, device)
+            )
+        return key
+    
+    def put_many(self, devices: List[Dict]) -> List[str]:
+        """Crea o reemplaza varios dispositivos en una sola transacción y devuelve sus MAC normalizadas"""
+        rows = [self._row(normalize_mac(device['mac']), device) for device in devices]
+        with self.transaction() as conn:
+            conn.executemany(f"INSERT OR REPLACE INTO devices VALUES ({_ROW_PLACEHOLDERS})", rows)
+        return [row[0] for row in rows]
+    
+    def update(self, mac: str, device: Dict) -> Optional[Dict]:
+        """
+        Reemplaza un dispositivo existente, que puede cambiar de MAC
+        
+        Conserva created_at. Devuelve el dispositivo guardado o None si no existía.
+        """
+        key = normalize_mac(mac)
+        new_key = normalize_mac(device['mac'])
+        with self.transaction() as conn:
+            row = conn.execute("SELECT created_at FROM devices WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            device = {**device, 'created_at': row['created_at']}
+            if new_key != key:
+                conn.execute("DELETE FROM devices WHERE key = ?", (key,))
+            conn.execute(
+                f"INSERT OR REPLACE INTO devices VALUES ({_ROW_PLACEHOLDERS})",
+                self._row(new_key, device)
+            )
+        return device
+    
+    def delete(self, mac: str) -> bool:
+        """Elimina un dispositivo; devuelve False si no existía"""
+        with self.transaction() as conn:
+            cursor = conn.execute("DELETE FROM devices WHERE key = ?", (normalize_mac(mac),))
+        return cursor.rowcount > 0
+    
+    def save_job(self, job_id: str, kind: str, created_at: str, data: Dict):
+        """Guarda (o actualiza) el estado de un trabajo en segundo plano"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, kind, created_at, data) VALUES (?, ?, ?, ?)",
+                (job_id, kind, created_at, json.dumps(data))
+            )
+    
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """Devuelve el estado de un trabajo o None si no existe"""
+        row = self.get_connection().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def list_jobs(self, kind: str, limit: int = 20) -> List[Dict]:
+        """Últimos trabajos de un tipo, del más reciente al más antiguo"""
+        rows = self.get_connection().execute(
+            "SELECT data FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?", (kind, limit)
+        )
+        return [json.loads(row['data']) for row in rows]
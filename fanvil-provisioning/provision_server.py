@@ -4,40 +4,956 @@ Servidor simple para autoprovisionamiento de dispositivos Fanvil
 """
 
 import http.server
-import socketserver
+import socket
+import sqlite3
+import signal
+import argparse
+import sys
+import threading
 import os
 import logging
+import logging.handlers
+import queue
+import random
+import re
+import io
+import json
+import gzip
+import time
+import posixpath
+import select
+import urllib.parse
+import stat
+import struct
+import hashlib
+import datetime
+import email.utils
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
-# Configuración de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/provision_server.log'),
-        logging.StreamHandler()
-    ]
-)
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = termios = None
+
+# Los módulos de generación están en el directorio raíz del proyecto
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import generate_fanvil_configs as gfc
+from fanvil_provisioner import ConfigGenerator, DatabaseManager, GroupLayer
+
+# Directorio donde se sirven los archivos de configuración
+CONFIG_DIR = os.path.abspath('config')
+# Directorio de imágenes de firmware, servido bajo /firmware/
+FIRMWARE_DIR = os.path.abspath('firmware')
+FIRMWARE_PREFIX = '/firmware/'
+
+# Registro de accesos (una línea JSON por solicitud)
+ACCESS_LOG_FILE = 'logs/access.log'
+# MAC de 12 dígitos hexadecimales en el nombre del archivo solicitado (001122aabbcc.cfg, cfg001122aabbcc.xml...)
+_PATH_MAC_RE = re.compile(r'(?<![0-9a-f])([0-9a-f]{12})(?![0-9a-f])', re.IGNORECASE)
+
+# Rango de bytes simple (bytes=inicio-fin, bytes=inicio- o bytes=-sufijo)
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Tamaño mínimo para comprimir una respuesta; por debajo la cabecera gzip no compensa
+GZIP_MIN_BYTES = 256
+
+# ioctl que devuelve los bytes de un socket TCP aún no confirmados por el cliente (SIOCOUTQ, solo Linux)
+_SIOCOUTQ = getattr(termios, 'TIOCOUTQ', None) if sys.platform.startswith('linux') else None
+
+# Parámetros de fanvil_provisioner y variables de la plantilla XML que los reciben
+TEMPLATE_PARAM_KEYS = {
+    'sip_server': ('account.1.server_address',),
+    'sip_user': ('account.1.user_id', 'account.1.auth_id'),
+    'sip_password': ('account.1.password',),
+    'display_name': ('account.1.display_name',),
+    'sip_port': ('account.1.sip_port',),
+    'sip_transport': ('account.1.sip_transport',),
+    'sip_outbound_proxy': ('account.1.outbound_proxy_primary',),
+    'ntp_server': ('ntp_server_primary',),
+    'dns_server1': ('dns_server_primary',),
+    'dns_server2': ('dns_server_secondary',),
+}
+
+# Intervalo con el que una conexión keep-alive inactiva comprueba si el pool está saturado
+KEEPALIVE_POLL_INTERVAL = 0.1
+
+
+def template_params(params: Dict, mac: str, model: str) -> Dict:
+    """
+    Traduce los parámetros de un dispositivo a las variables de la plantilla XML
+    
+    Las variables de la plantilla presentes en params tienen prioridad sobre
+    las traducidas; las que falten reciben los valores por defecto del lote.
+    """
+    data = dict(params)
+    for key, names in TEMPLATE_PARAM_KEYS.items():
+        value = params.get(key)
+        if value in (None, ''):
+            continue
+        for name in names:
+            if not data.get(name):
+                data[name] = value
+    data.setdefault('mac_address', mac)
+    data.setdefault('model', model)
+    return gfc.apply_batch_defaults(data)
+
+
+def wait_until_sent(sock: socket.socket, timeout: float) -> bool:
+    """
+    Espera a que el cliente confirme todos los bytes escritos en el socket
+    
+    sendfile y send terminan al copiar los datos al búfer del kernel, no cuando
+    llegan al cliente. Devuelve False si el envío no avanza durante timeout
+    segundos o el socket falla. En sistemas sin SIOCOUTQ no espera.
+    """
+    if _SIOCOUTQ is None:
+        return True
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    pending = None
+    while True:
+        try:
+            unsent = struct.unpack('i', fcntl.ioctl(sock.fileno(), _SIOCOUTQ, b'\0' * 4))[0]
+        except OSError:
+            return False
+        if unsent == 0:
+            return True
+        now = time.monotonic()
+        if pending is None or unsent < pending:
+            # El plazo cuenta desde el último avance: una descarga lenta pero viva no se corta
+            pending = unsent
+            deadline = now + timeout
+        elif now >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+class CacheEntry:
+    """Contenido de un archivo en caché junto con sus validadores HTTP"""
+    
+    __slots__ = ('key', 'body', 'etag', 'mtime', 'last_modified', '_gzip_body')
+    
+    def __init__(self, key, body: bytes, mtime: float):
+        self.key = key
+        self.body = body
+        # ETag fuerte: solo cambia si cambia el contenido, aunque el archivo se reescriba
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.mtime = int(mtime)
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self._gzip_body = None
+    
+    @property
+    def gzip_etag(self) -> str:
+        """ETag de la variante comprimida (cada representación necesita el suyo)"""
+        return f'{self.etag[:-1]}-gzip"'
+    
+    def gzip_body(self) -> Optional[bytes]:
+        """Variante gzip, comprimida solo la primera vez; None si no reduce el tamaño"""
+        if self._gzip_body is None:
+            # mtime=0: salida determinista, la misma en todos los procesos
+            compressed = gzip.compress(self.body, compresslevel=6, mtime=0)
+            self._gzip_body = compressed if len(compressed) < len(self.body) else b''
+        return self._gzip_body or None
+
+
+class ConfigCache:
+    """
+    Caché LRU en memoria de los archivos servidos
+    
+    Cada consulta hace un stat() del archivo y la entrada se invalida si cambia
+    su mtime, tamaño o inodo (por ejemplo, tras una publicación atómica).
+    Con max_bytes=0 no se guarda nada: cada consulta lee el archivo y la
+    entrada solo sirve para esa respuesta (ETag, 304 y gzip).
+    """
+    
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_file_bytes: int = 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def lookup(self, path: str) -> Tuple[Optional[CacheEntry], bool]:
+        """Devuelve (entrada, acierto); la entrada es None si el archivo no se puede cachear"""
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):
+            # ValueError: ruta con un carácter NUL (%00 en la URL)
+            return None, False
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file_bytes:
+            return None, False
+        
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        entry = self._get(path, key)
+        if entry is not None:
+            return entry, True
+        
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            return None, False
+        entry = CacheEntry(key, body, st.st_mtime)
+        if self.max_bytes <= 0:
+            return entry, False
+        return self._put(path, entry), False
+    
+    def _get(self, name, key) -> Optional[CacheEntry]:
+        """Devuelve la entrada de name si sigue siendo válida para key"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.key == key:
+                self._entries.move_to_end(name)
+                return entry
+        return None
+    
+    def _put(self, name, entry: CacheEntry) -> CacheEntry:
+        """Guarda una entrada, expulsando las menos usadas si se supera max_bytes"""
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self._entries[name] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.body)
+        return entry
+
+
+class DeviceConfigRenderer(ConfigCache):
+    """
+    Genera bajo demanda /<mac>.cfg y /<mac>.xml a partir de la base de datos
+    
+    Cada solicitud consulta la fila del dispositivo y la de su grupo; la
+    entrada en caché solo se reutiliza si ambas (y la plantilla) no han
+    cambiado. Las solicitudes simultáneas de la misma MAC comparten un único
+    renderizado.
+    """
+    
+    PATH_RE = re.compile(r'^/([0-9a-f]{12})\.(cfg|xml)$', re.IGNORECASE)
+    
+    def __init__(self, db_manager: DatabaseManager, template_path: Optional[str] = None,
+                 max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(max_bytes)
+        self.db_manager = db_manager
+        self.template_path = template_path
+        self._template = None  # (mtime, plantilla compilada)
+        self._inflight = {}
+    
+    def lookup(self, request_path: str) -> Tuple[Optional[CacheEntry], bool]:
+        """Devuelve (entrada, acierto); la entrada es None si la ruta no es de un dispositivo conocido"""
+        match = self.PATH_RE.match(request_path)
+        if not match:
+            return None, False
+        mac, extension = match.group(1).lower(), match.group(2).lower()
+        device = self.db_manager.get_device_config(mac)
+        if device is None:
+            return None, False
+        
+        name = f"{mac}.{extension}"
+        key = (device['model'], device['config_params'], device['group_config'], self._template_mtime(extension))
+        entry = self._get(name, key)
+        if entry is not None:
+            return entry, True
+        
+        # Single-flight: el primer hilo renderiza y los demás esperan su resultado
+        with self._lock:
+            future = self._inflight.get((name, key))
+            leader = future is None
+            if leader:
+                future = self._inflight[(name, key)] = Future()
+        if not leader:
+            return future.result(), False
+        
+        try:
+            entry = self._put(name, CacheEntry(key, self._render(device, mac, extension, key[3]), time.time()))
+            future.set_result(entry)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[(name, key)]
+        return entry, False
+    
+    def _template_mtime(self, extension: str) -> Optional[int]:
+        """Fecha de la plantilla XML, para invalidar la caché cuando se modifica"""
+        if extension != 'xml' or not self.template_path:
+            return None
+        return os.stat(self.template_path).st_mtime_ns
+    
+    def _compiled_template(self, mtime: int) -> gfc.CompiledTemplate:
+        """Plantilla XML compilada; solo se vuelve a leer y compilar si cambia su fecha"""
+        cached = self._template
+        if cached is None or cached[0] != mtime:
+            cached = self._template = (mtime, gfc.compile_template(gfc.load_template(self.template_path)))
+        return cached[1]
+    
+    def _render(self, device: Dict, mac: str, extension: str, template_mtime: Optional[int]) -> bytes:
+        """Combina los parámetros del grupo y del dispositivo y genera el archivo"""
+        # config_params solo guarda lo propio del dispositivo; se superpone al grupo igual que en fanvil_provisioner
+        layer = GroupLayer(json.loads(device['group_config'] or '{}'))
+        delta = json.loads(device['config_params'] or '{}')
+        
+        if extension == 'cfg':
+            return layer.render_cfg(delta).encode('utf-8')
+        params = layer.merge(delta)
+        if not self.template_path:
+            return ConfigGenerator.render_xml(params)
+        
+        template = self._compiled_template(template_mtime)
+        return template.render(template_params(params, mac, device['model'])).encode('utf-8')
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta registros en vez de bloquear si la cola está llena"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # Los registros de acceso no llevan argumentos: se formatean en el hilo escritor
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _JsonFormatter(logging.Formatter):
+    """Formatea cada registro de acceso como una línea JSON"""
+    
+    def format(self, record):
+        timestamp = datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+        return json.dumps({'ts': timestamp.isoformat(timespec='milliseconds'), **record.access}, ensure_ascii=False)
+
+
+class AccessLog:
+    """
+    Registro de accesos estructurado y asíncrono
+    
+    Los hilos que atienden solicitudes solo encolan el registro; un hilo
+    aparte lo formatea y lo escribe en disco con rotación por tamaño o por
+    tiempo. Con carga alta se puede muestrear el tráfico correcto (los
+    errores se registran siempre) y, si la cola se llena, los registros se
+    descartan en lugar de frenar las respuestas.
+    """
+    
+    def __init__(self, path: str = ACCESS_LOG_FILE, max_bytes: int = 50 * 1024 * 1024, backups: int = 5,
+                 when: Optional[str] = None, sample: float = 1.0, queue_size: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.when = when
+        self.sample = sample
+        self.queue_size = queue_size
+        self._logger = logging.getLogger('provision.access')
+        self._logger.propagate = False
+        self._queue_handler = None
+        self._listener = None
+    
+    def use_worker_file(self, index: int):
+        """Usa un archivo propio por proceso (la rotación no es segura entre procesos)"""
+        root, extension = os.path.splitext(self.path)
+        self.path = f"{root}.{index}{extension}"
+    
+    def start(self):
+        """Abre el archivo e inicia el hilo escritor"""
+        if self.when:
+            file_handler = logging.handlers.TimedRotatingFileHandler(self.path, when=self.when, backupCount=self.backups)
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups)
+        file_handler.setFormatter(_JsonFormatter())
+        
+        self._queue_handler = _DroppingQueueHandler(queue.Queue(self.queue_size))
+        self._logger.addHandler(self._queue_handler)
+        self._logger.setLevel(logging.INFO)
+        self._listener = logging.handlers.QueueListener(self._queue_handler.queue, file_handler)
+        self._listener.start()
+    
+    def stop(self):
+        """Escribe los registros pendientes y detiene el hilo escritor"""
+        if self._listener is None:
+            return
+        self._logger.removeHandler(self._queue_handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        if self._queue_handler.dropped:
+            logging.warning(f"Registro de accesos: {self._queue_handler.dropped} registros descartados por cola llena")
+        self._listener = None
+    
+    def log(self, fields: Dict):
+        """Encola un registro de acceso, aplicando el muestreo a las respuestas correctas"""
+        if fields['status'] < 400 and self.sample < 1 and random.random() >= self.sample:
+            return
+        if self.sample < 1:
+            fields['sample'] = self.sample
+        self._logger.info('', extra={'access': fields})
+
+
+class CheckinRecorder:
+    """
+    Registro diferido (write-behind) de las conexiones de los teléfonos
+    
+    Cada solicitud solo anota en memoria la última conexión de su MAC; un
+    hilo aparte vuelca lo acumulado a la base de datos cada `interval`
+    segundos (o antes si se acumulan `max_pending` MAC) en una sola
+    transacción. Las solicitudes repetidas de una misma MAC entre volcados
+    se combinan en una única actualización.
+    """
+    
+    def __init__(self, db_manager: DatabaseManager, interval: float = 5.0, max_pending: int = 5000):
+        self.db_manager = db_manager
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+    
+    def record(self, mac: str, ip_address: str, status: str = 'online'):
+        """Anota una conexión; no accede a la base de datos"""
+        seen_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self._lock:
+            self._pending[mac] = (mac, status, ip_address, seen_at)
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+    
+    def start(self):
+        """Inicia el hilo que vuelca las conexiones acumuladas"""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='checkin-flush', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Vuelca lo pendiente y detiene el hilo"""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+    
+    def flush(self) -> int:
+        """Escribe las conexiones acumuladas y devuelve cuántas se han volcado"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        
+        try:
+            self.db_manager.record_checkins(list(pending.values()))
+        except sqlite3.Error as e:
+            logging.warning(f"No se pudieron registrar {len(pending)} conexiones: {e}")
+            # Reintentar en el siguiente volcado, salvo las MAC que ya tienen una conexión más reciente
+            with self._lock:
+                for mac, checkin in pending.items():
+                    self._pending.setdefault(mac, checkin)
+            return 0
+        return len(pending)
+    
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+
+class TransferLimiter:
+    """
+    Limita las descargas simultáneas de firmware
+    
+    Como máximo `transfers` descargas en curso; el resto se rechaza de
+    inmediato con 503 y Retry-After, sin ocupar un hilo esperando turno. Así
+    las imágenes de firmware nunca ocupan todos los hilos del pool y las
+    consultas de configuración siguen atendiéndose durante una actualización
+    masiva.
+    """
+    
+    def __init__(self, transfers: int = 8, retry_after: int = 30):
+        self._active = threading.BoundedSemaphore(transfers)
+        self.retry_after = retry_after
+    
+    @contextmanager
+    def slot(self):
+        """Reserva un turno sin esperar; produce False si no queda ninguno libre"""
+        if not self._active.acquire(blocking=False):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._active.release()
+
 
 class FanvilProvisionHandler(http.server.SimpleHTTPRequestHandler):
     """Handler personalizado para el aprovisionamiento de Fanvil"""
     
+    # HTTP/1.1 con keep-alive: un teléfono puede pedir varios archivos en la misma conexión
+    protocol_version = "HTTP/1.1"
+    # Tiempo máximo para recibir una solicitud ya empezada (segundos)
+    timeout = 15
+    # Espera máxima de la siguiente solicitud en una conexión keep-alive (segundos); se
+    # cierra antes si hay conexiones esperando un hilo libre
+    keepalive_timeout = 2
+    
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory="config", **kwargs)
+        # Ruta sin resolver: si 'config' es un enlace simbólico publicado de forma
+        # atómica, cada solicitud sigue el enlace y ve siempre la versión actual
+        super().__init__(*args, directory=CONFIG_DIR, **kwargs)
+    
+    # Caché compartida por todos los hilos del proceso (None sirve los archivos sin ETag, 304 ni gzip)
+    cache = ConfigCache()
+    
+    # Generación bajo demanda desde la base de datos (None la desactiva)
+    renderer = None
+    # Extensiones que se comprimen con gzip si el cliente lo acepta
+    gzip_types = frozenset({'.xml', '.cfg', '.json', '.txt'})
+    
+    # Límite de descargas de firmware simultáneas (None sin límite)
+    firmware_limiter = TransferLimiter()
+    
+    # Registro de accesos (None lo desactiva)
+    access_log = None
+    # Registro diferido de conexiones en la base de datos (None lo desactiva)
+    checkins = None
+    
+    def handle(self):
+        """Atiende las solicitudes de la conexión sin retener el hilo mientras está inactiva"""
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self._wait_next_request():
+            self.handle_one_request()
+    
+    def _wait_next_request(self) -> bool:
+        """
+        Espera a que llegue la siguiente solicitud de una conexión keep-alive
+        
+        Devuelve False (y la conexión se cierra) si el cliente la cierra, si no
+        llega nada en keepalive_timeout segundos o si el pool está saturado, para
+        que una conexión inactiva no deje sin hilo a los teléfonos en espera.
+        """
+        deadline = time.monotonic() + self.keepalive_timeout
+        self.connection.setblocking(False)
+        try:
+            readable = False
+            while True:
+                try:
+                    # Sin bloquear: devuelve lo que haya en el búfer (solicitudes encadenadas) o en el socket
+                    if self.rfile.peek(1):
+                        return True
+                except OSError:
+                    return False
+                if readable:
+                    # Legible pero sin datos: el cliente ha cerrado la conexión
+                    return False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.server.saturated():
+                    return False
+                readable = bool(select.select([self.connection], [], [], min(remaining, KEEPALIVE_POLL_INTERVAL))[0])
+        finally:
+            self.connection.settimeout(self.timeout)
+    
+    def handle_one_request(self):
+        """Atiende una solicitud y la registra al terminar de responder"""
+        self._status = None
+        self._sent_bytes = 0
+        self.cache_status = 'bypass'
+        self._started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            if self._status is not None:
+                mac = self._request_mac()
+                if self.access_log is not None:
+                    self._log_access(mac)
+                if self.checkins is not None and mac and self._status < 400:
+                    self.checkins.record(mac, self.client_address[0])
+    
+    def parse_request(self):
+        # La latencia se mide desde que llega la solicitud, no desde que la conexión queda en espera
+        self._started = time.perf_counter()
+        return super().parse_request()
+    
+    def send_response_only(self, code, message=None):
+        self._status = code
+        super().send_response_only(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._sent_bytes = int(value)
+        super().send_header(keyword, value)
+    
+    def _request_mac(self) -> Optional[str]:
+        """MAC contenida en el nombre del archivo solicitado, en minúsculas"""
+        path = urllib.parse.urlsplit(getattr(self, 'path', '')).path
+        match = _PATH_MAC_RE.search(posixpath.basename(path))
+        return match.group(1).lower() if match else None
+    
+    def _log_access(self, mac: Optional[str]):
+        """Envía el registro estructurado de la solicitud al hilo escritor"""
+        self.access_log.log({
+            'mac': mac,
+            'ip': self.client_address[0],
+            'method': getattr(self, 'command', None),
+            'path': urllib.parse.urlsplit(getattr(self, 'path', '')).path,
+            'status': self._status,
+            'bytes': self._sent_bytes,
+            'latency_ms': round((time.perf_counter() - self._started) * 1000, 3),
+            'cache': self.cache_status,
+        })
+    
+    def do_GET(self):
+        """Atiende GET; el firmware va por su propia ruta sin copias en espacio de usuario"""
+        if self.path.startswith(FIRMWARE_PREFIX):
+            self.send_firmware()
+        else:
+            super().do_GET()
+    
+    def do_HEAD(self):
+        """Atiende HEAD con las mismas cabeceras que GET"""
+        if self.path.startswith(FIRMWARE_PREFIX):
+            self.send_firmware(head_only=True)
+        else:
+            super().do_HEAD()
+    
+    def send_firmware(self, head_only: bool = False):
+        """Envía una imagen de firmware con os.sendfile, admitiendo rangos para reanudar descargas"""
+        path = self._firmware_path()
+        try:
+            f = open(path, 'rb')
+        except (OSError, ValueError):
+            # ValueError: ruta con un carácter NUL (%00 en la URL)
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+                return
+            
+            size = st.st_size
+            etag = f'"{st.st_ino:x}-{size:x}-{st.st_mtime_ns:x}"'
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+            byte_range = self._byte_range(size, etag, last_modified)
+            if byte_range is False:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            
+            limiter = self.firmware_limiter if not head_only else None
+            with limiter.slot() if limiter else nullcontext(True) as acquired:
+                if not acquired:
+                    self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+                    self.send_header('Retry-After', str(limiter.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                
+                if byte_range is None:
+                    start, end = 0, size - 1
+                    self.send_response(HTTPStatus.OK)
+                else:
+                    start, end = byte_range
+                    self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                self.send_header('Content-Type', self.guess_type(path))
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                
+                if not head_only and end >= start:
+                    # socket.sendfile usa os.sendfile (copia en el kernel) y respeta el timeout
+                    self.connection.sendfile(f, start, end - start + 1)
+                    if limiter is not None:
+                        # El turno se conserva hasta que el cliente ha recibido la imagen completa
+                        if not wait_until_sent(self.connection, self.timeout):
+                            self.close_connection = True
+    
+    def _firmware_path(self) -> str:
+        """Traduce /firmware/<ruta> a un archivo dentro de FIRMWARE_DIR"""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        # normpath sobre una ruta absoluta elimina cualquier '..' que intente salir del directorio
+        parts = [part for part in posixpath.normpath(path).split('/') if part]
+        return os.path.join(FIRMWARE_DIR, *parts[1:])
+    
+    def _byte_range(self, size: int, etag: str, last_modified: str):
+        """
+        Interpreta la cabecera Range
+        
+        Devuelve (inicio, fin) para una respuesta parcial, None para enviar el
+        archivo completo y False si el rango no se puede satisfacer. Los rangos
+        múltiples se ignoran y se envía el archivo completo.
+        """
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return None
+        
+        # If-Range: solo se reanuda si el archivo no ha cambiado desde la primera descarga
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None
+        
+        match = _RANGE_RE.match(range_header.strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        
+        first, last = match.groups()
+        if not first:
+            # Sufijo: los últimos N bytes
+            length = int(last)
+            if length == 0:
+                return False
+            return max(size - length, 0), size - 1
+        
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or (last and int(last) < start):
+            return False
+        return start, end
+    
+    def send_head(self):
+        """Sirve los archivos desde la caché, respondiendo 304 si el teléfono ya los tiene"""
+        self.cache_status = 'bypass'
+        path = self.translate_path(self.path)
+        if '\x00' in path:
+            # open() y os.stat() rechazan con ValueError las rutas con NUL (%00 en la URL)
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        
+        entry = None
+        if self.renderer is not None:
+            # Los dispositivos registrados se generan desde la base de datos; el resto, desde disco
+            try:
+                entry, hit = self.renderer.lookup(urllib.parse.urlsplit(self.path).path)
+            except Exception:
+                logging.exception(f"Error al generar {self.path}")
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+                return None
+        if entry is None:
+            if self.cache is None or self.path.endswith('/') or os.path.isdir(path):
+                return super().send_head()
+            entry, hit = self.cache.lookup(path)
+            if entry is None:
+                return super().send_head()
+        self.cache_status = 'hit' if hit else 'miss'
+        
+        # Negociación de contenido: variante gzip para los tipos habilitados
+        compressible = os.path.splitext(path)[1].lower() in self.gzip_types and len(entry.body) >= GZIP_MIN_BYTES
+        body, etag = entry.body, entry.etag
+        if compressible and self._accepts_gzip():
+            gzip_body = entry.gzip_body()
+            if gzip_body is not None:
+                body, etag = gzip_body, entry.gzip_etag
+        
+        if self._not_modified(entry, etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', entry.last_modified)
+            if compressible:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return None
+        
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', self.guess_type(path))
+        if body is not entry.body:
+            self.send_header('Content-Encoding', 'gzip')
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', entry.last_modified)
+        self.end_headers()
+        return io.BytesIO(body)
+    
+    def _accepts_gzip(self) -> bool:
+        """Indica si el cliente acepta gzip (Accept-Encoding, respetando q=0)"""
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() not in ('gzip', 'x-gzip', '*'):
+                continue
+            quality = params.strip().lower()
+            if quality.startswith('q='):
+                try:
+                    return float(quality[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+        return False
+    
+    def _not_modified(self, entry: CacheEntry, etag: str) -> bool:
+        """Evalúa If-None-Match (prioritario) o If-Modified-Since"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            return entry.mtime <= since.timestamp()
+        
+        return False
+    
+    def log_request(self, code='-', size='-'):
+        # Las solicitudes se registran en el registro de accesos al terminar la respuesta
+        pass
+    
+    def log_error(self, format, *args):
+        # Las respuestas de error ya quedan en el registro de accesos con su código
+        if self.access_log is None:
+            self.log_message(format, *args)
     
     def log_message(self, format, *args):
-        """Registra las solicitudes entrantes"""
-        logging.info(f"{self.address_string()} - {format % args}")
-        super().log_message(format, *args)
+        """Registra los errores del servidor HTTP (una sola vez)"""
+        logging.warning(f"{self.address_string()} - {format % args}")
     
     def end_headers(self):
         """Agrega encabezados de seguridad"""
+        if not self.close_connection and self.server.saturated():
+            # Con conexiones esperando hilo, cerrar tras la respuesta en lugar de mantenerla abierta
+            self.send_header('Connection', 'close')
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        # Sin no-store: el teléfono puede guardar la copia, pero debe revalidarla siempre (ETag)
+        self.send_header('Cache-Control', 'no-cache, must-revalidate')
         self.send_header('Pragma', 'no-cache')
         self.send_header('Expires', '0')
         super().end_headers()
 
+class ProvisionHTTPServer(http.server.HTTPServer):
+    """
+    Servidor HTTP que atiende las conexiones en un pool acotado de hilos
+    
+    Un teléfono lento solo ocupa uno de los hilos del pool. Cuando todos están
+    ocupados y la cola interna está llena, el servidor deja de aceptar y las
+    conexiones nuevas esperan en el backlog del sistema operativo. Mientras
+    haya conexiones esperando hilo, las conexiones keep-alive se cierran al
+    terminar su respuesta en curso.
+    """
+    
+    allow_reuse_address = True
+    
+    def __init__(self, server_address, handler_class, workers: int = 64, backlog: int = 1024,
+                 reuse_port: bool = False):
+        self.request_queue_size = backlog
+        self.reuse_port = reuse_port
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='provision')
+        # Conexiones entregadas al pool (atendiéndose o esperando hilo)
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+        # Conexiones aceptadas pendientes de atender como máximo (en ejecución + en cola)
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        super().__init__(server_address, handler_class)
+    
+    def server_bind(self):
+        """Activa SO_REUSEPORT para compartir el puerto entre varios procesos"""
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def saturated(self) -> bool:
+        """Indica si hay conexiones esperando un hilo libre del pool"""
+        return self._connections > self.workers
+    
+    def _connection_done(self):
+        with self._connections_lock:
+            self._connections -= 1
+        self._slots.release()
+    
+    def process_request(self, request, client_address):
+        """Entrega la conexión al pool de hilos"""
+        self._slots.acquire()
+        with self._connections_lock:
+            self._connections += 1
+        try:
+            self._executor.submit(self._process_request_worker, request, client_address)
+        except BaseException:
+            self._connection_done()
+            self.shutdown_request(request)
+            raise
+    
+    def _process_request_worker(self, request, client_address):
+        """Atiende una conexión dentro de un hilo del pool"""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._connection_done()
+    
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+def serve(port: int, workers: int, backlog: int, reuse_port: bool = False):
+    """Ejecuta un servidor de aprovisionamiento hasta que se detenga"""
+    with ProvisionHTTPServer(("", port), FanvilProvisionHandler, workers=workers,
+                             backlog=backlog, reuse_port=reuse_port) as httpd:
+        logging.info(f"Servidor de aprovisionamiento iniciado en puerto {port} (pid {os.getpid()}, {workers} hilos)")
+        # Los hilos auxiliares se inician en cada proceso: los hilos no sobreviven a fork()
+        access_log = FanvilProvisionHandler.access_log
+        checkins = FanvilProvisionHandler.checkins
+        if access_log is not None:
+            access_log.start()
+        if checkins is not None:
+            checkins.start()
+        try:
+            httpd.serve_forever()
+        finally:
+            if checkins is not None:
+                checkins.stop()
+            if access_log is not None:
+                access_log.stop()
+
+
+def start_worker_processes(count: int, port: int, workers: int, backlog: int):
+    """Lanza procesos hijos que comparten el puerto mediante SO_REUSEPORT"""
+    children = []
+    for index in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            # Proceso hijo: el padre se encarga de detenerlo con SIGTERM
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            if FanvilProvisionHandler.access_log is not None:
+                FanvilProvisionHandler.access_log.use_worker_file(index)
+            try:
+                serve(port, workers, backlog, reuse_port=True)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    return children
+
+
 def main():
     """Función principal para iniciar el servidor de aprovisionamiento"""
     
@@ -46,27 +962,99 @@ def main():
     os.makedirs('logs', exist_ok=True)
     os.makedirs('firmware', exist_ok=True)
     
-    # Puerto por defecto para el servidor de aprovisionamiento
-    PORT = 8000
+    # Configuración de logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('logs/provision_server.log'),
+            logging.StreamHandler()
+        ]
+    )
+    
+    parser = argparse.ArgumentParser(description='Servidor de autoprovisionamiento Fanvil')
+    parser.add_argument('--port', type=int, default=8000, help='Puerto del servidor (por defecto: 8000)')
+    parser.add_argument('--workers', type=int, default=64, help='Hilos que atienden conexiones por proceso (por defecto: 64)')
+    parser.add_argument('--processes', type=int, default=1, help='Procesos que comparten el puerto con SO_REUSEPORT (por defecto: 1)')
+    parser.add_argument('--backlog', type=int, default=1024, help='Conexiones pendientes en cola del sistema (por defecto: 1024)')
+    parser.add_argument('--timeout', type=float, default=15, help='Segundos para recibir una solicitud ya empezada (por defecto: 15)')
+    parser.add_argument('--keepalive-timeout', type=float, default=2,
+                        help='Segundos que una conexión keep-alive espera la siguiente solicitud (por defecto: 2)')
+    parser.add_argument('--cache-size', type=int, default=64, help='Tamaño máximo de la caché en memoria en MB, 0 la desactiva sin perder ETag, 304 ni gzip (por defecto: 64)')
+    parser.add_argument('--db', help='Base de datos de fanvil_provisioner.py; genera /<MAC>.cfg y /<MAC>.xml bajo demanda')
+    parser.add_argument('--template', help='Plantilla XML de Fanvil para /<MAC>.xml generado bajo demanda')
+    parser.add_argument('--gzip-types', default='xml,cfg,json,txt',
+                        help='Extensiones que se comprimen con gzip, separadas por comas; vacío lo desactiva (por defecto: xml,cfg,json,txt)')
+    parser.add_argument('--firmware-transfers', type=int, default=8, help='Descargas de firmware simultáneas por proceso (por defecto: 8)')
+    parser.add_argument('--firmware-retry-after', type=int, default=30,
+                        help='Segundos de Retry-After en el 503 cuando no quedan descargas de firmware libres (por defecto: 30)')
+    parser.add_argument('--access-log', default=ACCESS_LOG_FILE, help=f'Registro de accesos en JSON, vacío lo desactiva (por defecto: {ACCESS_LOG_FILE})')
+    parser.add_argument('--log-max-bytes', type=int, default=50, help='Tamaño en MB a partir del cual se rota el registro de accesos (por defecto: 50)')
+    parser.add_argument('--log-rotate-when', help="Rotar por tiempo en lugar de por tamaño (p. ej. 'midnight' o 'H')")
+    parser.add_argument('--log-backups', type=int, default=5, help='Archivos rotados que se conservan (por defecto: 5)')
+    parser.add_argument('--log-sample', type=float, default=1.0, help='Fracción de respuestas correctas que se registran (por defecto: 1.0)')
+    parser.add_argument('--checkin-interval', type=float, default=5,
+                        help='Segundos entre volcados de las conexiones de los teléfonos a la base de datos, 0 lo desactiva (por defecto: 5)')
+    args = parser.parse_args()
     
-    # Directorio donde se sirven los archivos de configuración
-    os.chdir('config')
+    if args.processes > 1 and not (hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork')):
+        print("Error: --processes requiere un sistema con SO_REUSEPORT y fork()")
+        return
+    
+    # Puerto para el servidor de aprovisionamiento
+    PORT = args.port
+    FanvilProvisionHandler.timeout = args.timeout
+    FanvilProvisionHandler.keepalive_timeout = args.keepalive_timeout
+    # Con --cache-size 0 no se guarda nada en memoria, pero se mantienen los validadores y gzip
+    FanvilProvisionHandler.cache = ConfigCache(max(args.cache_size, 0) * 1024 * 1024)
+    if args.access_log:
+        FanvilProvisionHandler.access_log = AccessLog(
+            args.access_log, args.log_max_bytes * 1024 * 1024, args.log_backups, args.log_rotate_when, args.log_sample
+        )
+    FanvilProvisionHandler.firmware_limiter = TransferLimiter(args.firmware_transfers, args.firmware_retry_after)
+    if args.firmware_transfers >= args.workers:
+        print("Aviso: las descargas de firmware pueden ocupar todos los hilos; aumente --workers")
+    FanvilProvisionHandler.gzip_types = frozenset(
+        f".{ext.strip().lstrip('.').lower()}" for ext in args.gzip_types.split(',') if ext.strip()
+    )
+    if args.db:
+        FanvilProvisionHandler.renderer = DeviceConfigRenderer(
+            DatabaseManager(args.db), args.template, max(args.cache_size, 1) * 1024 * 1024
+        )
+        if args.checkin_interval > 0:
+            FanvilProvisionHandler.checkins = CheckinRecorder(FanvilProvisionHandler.renderer.db_manager, args.checkin_interval)
+        # Cada proceso y cada hilo abren su propia conexión al atender la primera solicitud
+        FanvilProvisionHandler.renderer.db_manager.close()
     
     print(f"Iniciando servidor de aprovisionamiento Fanvil en el puerto {PORT}")
     print("Asegúrese de que los archivos de configuración estén en el directorio 'config'")
-    print("Los dispositivos Fanvil deben apuntar a: http://<IP_SERVIDOR>:{PORT}/<MAC>.cfg")
+    print(f"Los dispositivos Fanvil deben apuntar a: http://<IP_SERVIDOR>:{PORT}/<MAC>.cfg")
     print("Presione Ctrl+C para detener el servidor")
     
+    # SIGTERM detiene el servidor pasando por el bloque finally (y detiene a los hijos)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    
+    children = []
     try:
-        with socketserver.TCPServer(("", PORT), FanvilProvisionHandler) as httpd:
-            logging.info(f"Servidor de aprovisionamiento iniciado en puerto {PORT}")
-            httpd.serve_forever()
+        reuse_port = args.processes > 1
+        if reuse_port:
+            children = start_worker_processes(args.processes - 1, PORT, args.workers, args.backlog)
+            if FanvilProvisionHandler.access_log is not None:
+                FanvilProvisionHandler.access_log.use_worker_file(0)
+        serve(PORT, args.workers, args.backlog, reuse_port=reuse_port)
     except KeyboardInterrupt:
         print("\nServidor detenido por el usuario")
         logging.info("Servidor de aprovisionamiento detenido")
     except Exception as e:
         logging.error(f"Error al iniciar el servidor: {e}")
         print(f"Error al iniciar el servidor: {e}")
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,12 +5,13 @@ Aplicación para autoprovisionamiento de equipos Fanvil
 """
 
 import os
+import sys
+import csv
 import json
 import hashlib
 import sqlite3
-import xml.etree.ElementTree as ET
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import ipaddress
 import argparse
 import getpass
@@ -20,22 +21,163 @@ import http.server
 import socketserver
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+from config_publisher import ReleasePublisher, atomic_write, atomic_writer
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # Solo es necesario para cifrar configuraciones (pip install cryptography)
+    Cipher = None
+
+
+# MAC en minúsculas y sin separadores; debe coincidir con la expresión del índice idx_devices_clean_mac
+CLEAN_MAC_SQL = "lower(replace(replace(mac_address, ':', ''), '-', ''))"
+
+
+# Cifrado de configuraciones como lo descifra el teléfono: AES-ECB con relleno PKCS#7, sin
+# cabecera ni IV, con la clave configurada tal cual (32 caracteres para AES-256)
+ENCRYPTION_CHUNK_SIZE = 64 * 1024
+ENCRYPTION_KEY_SIZES = (16, 24, 32)
+# Variable de entorno con la clave para el subcomando encrypt-configs
+ENCRYPTION_KEY_ENV = 'FANVIL_ENCRYPTION_KEY'
+# Archivos por tarea al cifrar un directorio con varios procesos
+ENCRYPTION_BATCH_SIZE = 256
+
+# Dispositivos por lote al aprovisionar desde un archivo
+PROVISION_BATCH_SIZE = 500
+# Columnas de un archivo de dispositivos que no son parámetros de configuración
+DEVICE_INPUT_FIELDS = ('mac_address', 'model', 'client_id')
+
+
+def clean_mac_address(mac_address: str) -> str:
+    """Normaliza una MAC a minúsculas sin separadores, como en los nombres de archivo"""
+    return mac_address.lower().replace(':', '').replace('-', '')
+
+
+@lru_cache(maxsize=64)
+def encryption_key_bytes(encryption_key: str) -> bytes:
+    """
+    Clave AES tal como se configura en el teléfono, sin derivarla
+    
+    Sus bytes UTF-8 son la clave: 16, 24 o 32 caracteres para AES-128, 192 o
+    256. Lanza ValueError con cualquier otra longitud.
+    """
+    key = encryption_key.encode('utf-8')
+    if len(key) not in ENCRYPTION_KEY_SIZES:
+        raise ValueError(
+            f"La clave de cifrado debe tener 16, 24 o 32 caracteres (AES-128/192/256); tiene {len(key)}"
+        )
+    return key
+
+
+def _strip_group_owned_params(conn: sqlite3.Connection):
+    """
+    Migración 6: deja en los miembros de cada grupo solo los parámetros que difieren del grupo
+    
+    Hasta ahora algunos caminos guardaban en el dispositivo los parámetros ya
+    combinados con los del grupo, que después tapaban cualquier cambio del
+    grupo. Se quitan las claves con el mismo valor que en el grupo y se
+    conservan las que lo redefinen, con la regla de GroupLayer.overrides.
+    Se hace en Python porque depende del JSON de cada grupo.
+    """
+    groups = conn.execute("SELECT id, config_template FROM groups").fetchall()
+    for group_id, config_template in groups:
+        group_params = json.loads(config_template or '{}')
+        if not group_params:
+            continue
+        updates = []
+        for mac_address, config_params in conn.execute(
+            "SELECT mac_address, config_params FROM devices WHERE group_id = ?", (group_id,)
+        ).fetchall():
+            params = json.loads(config_params or '{}')
+            overrides = {
+                key: value for key, value in params.items()
+                if key not in group_params or group_params[key] != value
+            }
+            if len(overrides) != len(params):
+                updates.append((json.dumps(overrides), mac_address))
+        conn.executemany("UPDATE devices SET config_params = ? WHERE mac_address = ?", updates)
+
+
+def _require_cryptography():
+    if Cipher is None:
+        raise ImportError("El cifrado de configuraciones requiere el paquete cryptography")
+
+
+def encrypt_file(source_path: str, destination_path: str, key: bytes) -> str:
+    """Cifra un archivo por bloques con AES-ECB y relleno PKCS#7 y escribe el resultado de forma atómica"""
+    _require_cryptography()
+    encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    
+    with open(source_path, 'rb') as source, atomic_writer(destination_path) as destination:
+        for chunk in iter(lambda: source.read(ENCRYPTION_CHUNK_SIZE), b''):
+            destination.write(encryptor.update(padder.update(chunk)))
+        destination.write(encryptor.update(padder.finalize()) + encryptor.finalize())
+    return destination_path
+
+
+def decrypt_file(source_path: str, key: bytes) -> bytes:
+    """Descifra un archivo generado por encrypt_file (para verificar configuraciones cifradas)"""
+    _require_cryptography()
+    with open(source_path, 'rb') as source:
+        decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        content = []
+        for chunk in iter(lambda: source.read(ENCRYPTION_CHUNK_SIZE), b''):
+            content.append(unpadder.update(decryptor.update(chunk)))
+    content.append(unpadder.update(decryptor.finalize()) + unpadder.finalize())
+    return b''.join(content)
+
+
+def _encrypt_files(paths: List[str], key: bytes) -> List[Tuple[str, Optional[str]]]:
+    """Cifra varios archivos y devuelve (ruta, error o None) por cada uno"""
+    results = []
+    for path in paths:
+        try:
+            encrypt_file(path, f"{path}.enc", key)
+            results.append((path, None))
+        except Exception as e:
+            results.append((path, str(e)))
+    return results
+
+
+# Clave del proceso de trabajo: se valida en el proceso principal y se recibe una sola vez
+_worker_key = None
+
+
+def _init_encrypt_worker(key: bytes):
+    global _worker_key
+    _worker_key = key
+
+
+def _encrypt_files_in_worker(paths: List[str]) -> List[Tuple[str, Optional[str]]]:
+    return _encrypt_files(paths, _worker_key)
 
 
 class DatabaseManager:
     """Gestor de base de datos para almacenar información de dispositivos y usuarios"""
     
-    def __init__(self, db_path: str = "fanvil_provision.db"):
-        self.db_path = db_path
-        self.init_database()
+    # Pragmas aplicados a cada conexión nueva
+    CONNECTION_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",  # ~16 MB de caché de páginas
+        "PRAGMA temp_store=MEMORY",
+    )
     
-    def init_database(self):
-        """Inicializa la base de datos con las tablas necesarias"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Tabla de usuarios (Administrador, Agente, Cliente)
-        cursor.execute('''
+    # Migraciones del esquema (versión, sentencias SQL o funciones que reciben la conexión);
+    # PRAGMA user_version guarda la última aplicada
+    MIGRATIONS = [
+        (1, (
+            # Tabla de usuarios (Administrador, Agente, Cliente)
+            '''
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 username TEXT UNIQUE NOT NULL,
@@ -43,10 +185,9 @@ class DatabaseManager:
                 role TEXT NOT NULL, -- 'admin', 'agent', 'client'
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
-        
-        # Tabla de dispositivos
-        cursor.execute('''
+            ''',
+            # Tabla de dispositivos
+            '''
             CREATE TABLE IF NOT EXISTS devices (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 mac_address TEXT UNIQUE NOT NULL,
@@ -59,10 +200,9 @@ class DatabaseManager:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 last_seen TIMESTAMP
             )
-        ''')
-        
-        # Tabla de grupos de configuración
-        cursor.execute('''
+            ''',
+            # Tabla de grupos de configuración
+            '''
             CREATE TABLE IF NOT EXISTS groups (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
@@ -71,10 +211,9 @@ class DatabaseManager:
                 created_by INTEGER,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
-        
-        # Tabla de logs de operaciones
-        cursor.execute('''
+            ''',
+            # Tabla de logs de operaciones
+            '''
             CREATE TABLE IF NOT EXISTS logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -83,41 +222,136 @@ class DatabaseManager:
                 details TEXT,
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
+            ''',
+        )),
+        (2, (
+            # Historial de un dispositivo ordenado por fecha
+            "CREATE INDEX IF NOT EXISTS idx_logs_device_mac_timestamp ON logs (device_mac, timestamp)",
+            # Paneles por estado; cubre también el orden por última conexión dentro de cada estado
+            "CREATE INDEX IF NOT EXISTS idx_devices_status_last_seen ON devices (status, last_seen)",
+            "CREATE INDEX IF NOT EXISTS idx_devices_group_id ON devices (group_id)",
+            "CREATE INDEX IF NOT EXISTS idx_devices_client_id ON devices (client_id)",
+            "CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen)",
+        )),
+        (3, (
+            # Parámetros propios de cada dispositivo (JSON), para generar su configuración bajo demanda
+            "ALTER TABLE devices ADD COLUMN config_params TEXT",
+            # Búsqueda por MAC normalizada, tal como la piden los teléfonos (001122aabbcc.cfg)
+            f"CREATE INDEX IF NOT EXISTS idx_devices_clean_mac ON devices ({CLEAN_MAC_SQL})",
+        )),
+        (4, (
+            # Se incrementa con cada cambio de config_template para invalidar las capas de grupo en caché
+            "ALTER TABLE groups ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        )),
+        (5, (
+            # Índice de dependencias grupo -> dispositivos, ordenado por MAC para recorrerlo por bloques
+            "CREATE INDEX IF NOT EXISTS idx_devices_group_members ON devices (group_id, mac_address)",
+            # Cubierto por el anterior
+            "DROP INDEX IF EXISTS idx_devices_group_id",
+        )),
+        (6, (
+            # config_params guarda solo lo propio del dispositivo; el grupo se combina al generar
+            _strip_group_owned_params,
+        )),
+    ]
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
+    
+    # Parámetros por consulta IN (por debajo del límite clásico de SQLite, 999)
+    MAX_QUERY_PARAMS = 500
+    
+    def __init__(self, db_path: str = "fanvil_provision.db"):
+        self.db_path = db_path
+        # Una conexión persistente por hilo; sqlite3 reutiliza las sentencias preparadas de cada una
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.init_database()
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """Devuelve la conexión persistente del hilo actual, creándola si hace falta"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, cached_statements=256, check_same_thread=False)
+            for pragma in self.CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Ejecuta un bloque en una transacción (commit al salir, rollback si hay error)"""
+        conn = self.get_connection()
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            if depth:
+                # Transacción anidada: la confirma el bloque exterior
+                yield conn
+            else:
+                with conn:
+                    yield conn
+        finally:
+            self._local.depth = depth
+    
+    def close(self):
+        """Cierra todas las conexiones abiertas por el gestor"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+    
+    def init_database(self):
+        """Inicializa la base de datos aplicando solo las migraciones pendientes"""
+        conn = self.get_connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+            return
         
-        conn.commit()
-        conn.close()
+        # BEGIN IMMEDIATE: si varios procesos arrancan a la vez, solo uno migra
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for migration_version, statements in self.MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {migration_version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        
+        # Actualizar las estadísticas del planificador para los nuevos índices
+        conn.execute("PRAGMA optimize")
     
     def add_user(self, username: str, password: str, role: str):
         """Agrega un nuevo usuario"""
         password_hash = hashlib.sha256(password.encode()).hexdigest()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         
         try:
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
-                (username, password_hash, role)
-            )
-            conn.commit()
+            with self.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
+                    (username, password_hash, role)
+                )
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
     
     def verify_user(self, username: str, password: str) -> Optional[Dict]:
         """Verifica credenciales de usuario"""
         password_hash = hashlib.sha256(password.encode()).hexdigest()
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
         
-        cursor.execute(
+        result = self.get_connection().execute(
             "SELECT id, username, role FROM users WHERE username = ? AND password_hash = ?",
             (username, password_hash)
-        )
-        result = cursor.fetchone()
-        conn.close()
+        ).fetchone()
         
         if result:
             return {
@@ -129,32 +363,22 @@ class DatabaseManager:
     
     def add_device(self, mac_address: str, model: str, client_id: int = None):
         """Agrega un nuevo dispositivo"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute(
-                "INSERT INTO devices (mac_address, model, client_id) VALUES (?, ?, ?)",
-                (mac_address, model, client_id)
-            )
-            conn.commit()
+            with self.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO devices (mac_address, model, client_id) VALUES (?, ?, ?)",
+                    (mac_address, model, client_id)
+                )
             return True
         except sqlite3.IntegrityError:
             return False
-        finally:
-            conn.close()
     
     def get_device(self, mac_address: str) -> Optional[Dict]:
         """Obtiene información de un dispositivo por MAC"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        result = self.get_connection().execute(
             "SELECT * FROM devices WHERE mac_address = ?",
             (mac_address,)
-        )
-        result = cursor.fetchone()
-        conn.close()
+        ).fetchone()
         
         if result:
             return {
@@ -171,125 +395,447 @@ class DatabaseManager:
             }
         return None
     
-    def update_device_status(self, mac_address: str, status: str, ip_address: str = None):
-        """Actualiza el estado de un dispositivo"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_device_config(self, mac_address: str) -> Optional[Dict]:
+        """
+        Obtiene los datos necesarios para generar la configuración de un dispositivo
+        
+        Acepta la MAC en cualquier formato. Los parámetros se devuelven como el
+        JSON almacenado, sin interpretar, para poder compararlos a bajo coste.
+        """
+        result = self.get_connection().execute(
+            f"""
+            SELECT d.mac_address, d.model, d.config_params, g.config_template
+            FROM devices d LEFT JOIN groups g ON g.id = d.group_id
+            WHERE {CLEAN_MAC_SQL.replace('mac_address', 'd.mac_address')} = ?
+            """,
+            (clean_mac_address(mac_address),)
+        ).fetchone()
+        
+        if result:
+            return {
+                'mac_address': result[0],
+                'model': result[1],
+                'config_params': result[2],
+                'group_config': result[3]
+            }
+        return None
+    
+    def get_existing_macs(self, mac_addresses: List[str]) -> set:
+        """Devuelve cuáles de las MAC indicadas ya están registradas, consultando por bloques"""
+        conn = self.get_connection()
+        macs = list(dict.fromkeys(mac_addresses))
+        existing = set()
         
-        if ip_address:
-            cursor.execute(
-                "UPDATE devices SET status = ?, ip_address = ?, last_seen = CURRENT_TIMESTAMP WHERE mac_address = ?",
-                (status, ip_address, mac_address)
+        for start in range(0, len(macs), self.MAX_QUERY_PARAMS):
+            chunk = macs[start:start + self.MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT mac_address FROM devices WHERE mac_address IN ({placeholders})",
+                chunk
             )
-        else:
-            cursor.execute(
-                "UPDATE devices SET status = ?, last_seen = CURRENT_TIMESTAMP WHERE mac_address = ?",
-                (status, mac_address)
+            existing.update(row[0] for row in rows)
+        
+        return existing
+    
+    def get_device_groups(self, mac_addresses: List[str]) -> Dict[str, Optional[int]]:
+        """Grupo (o None) de cada una de las MAC indicadas que ya está registrada, consultando por bloques"""
+        conn = self.get_connection()
+        macs = list(dict.fromkeys(mac_addresses))
+        groups = {}
+        
+        for start in range(0, len(macs), self.MAX_QUERY_PARAMS):
+            chunk = macs[start:start + self.MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(
+                f"SELECT mac_address, group_id FROM devices WHERE mac_address IN ({placeholders})",
+                chunk
             )
+            groups.update(rows)
         
-        conn.commit()
-        conn.close()
+        return groups
+    
+    def add_devices(self, devices: List[Tuple[str, str, Optional[int]]]):
+        """Agrega varios dispositivos (mac, modelo, cliente) en una sola transacción"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO devices (mac_address, model, client_id) VALUES (?, ?, ?)",
+                devices
+            )
+    
+    def set_device_params(self, device_params: List[Tuple[str, Union[Dict, str]]]):
+        """Guarda los parámetros de configuración (mac, parámetros o su JSON ya serializado) de varios dispositivos"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE devices SET config_params = ? WHERE mac_address = ?",
+                [(params if isinstance(params, str) else json.dumps(params), mac_address)
+                 for mac_address, params in device_params]
+            )
+    
+    def set_devices_group(self, mac_addresses: List[str], group_id: Optional[int]):
+        """Asigna varios dispositivos a un grupo (o los saca de él con None)"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE devices SET group_id = ? WHERE mac_address = ?",
+                [(group_id, mac_address) for mac_address in mac_addresses]
+            )
+    
+    def iter_group_members(self, group_id: int, chunk_size: int = 500) -> Iterator[List[Tuple[str, Optional[str]]]]:
+        """
+        Recorre los dispositivos de un grupo por bloques de (mac, parámetros JSON)
+        
+        Cada bloque es una consulta por rango sobre el índice
+        idx_devices_group_members, de modo que el coste depende del tamaño
+        del grupo y no del total de dispositivos.
+        """
+        conn = self.get_connection()
+        last_mac = ''
+        while True:
+            chunk = conn.execute(
+                "SELECT mac_address, config_params FROM devices WHERE group_id = ? AND mac_address > ? "
+                "ORDER BY mac_address LIMIT ?",
+                (group_id, last_mac, chunk_size)
+            ).fetchall()
+            if not chunk:
+                return
+            yield chunk
+            last_mac = chunk[-1][0]
+    
+    def add_group(self, name: str, description: str, params: Dict, created_by: Optional[int] = None) -> int:
+        """Crea un grupo de configuración y devuelve su ID"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO groups (name, description, config_template, created_by) VALUES (?, ?, ?, ?)",
+                (name, description, json.dumps(params), created_by)
+            )
+        return cursor.lastrowid
+    
+    def update_group_config(self, group_id: int, params: Dict) -> bool:
+        """Reemplaza la configuración base de un grupo; devuelve False si no existe"""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE groups SET config_template = ?, version = version + 1 WHERE id = ?",
+                (json.dumps(params), group_id)
+            )
+        return cursor.rowcount > 0
+    
+    def get_group(self, group_id: int) -> Optional[Dict]:
+        """Obtiene un grupo con su configuración base sin interpretar (JSON) y su versión"""
+        result = self.get_connection().execute(
+            "SELECT id, name, description, config_template, version FROM groups WHERE id = ?",
+            (group_id,)
+        ).fetchone()
+        
+        if result:
+            return {
+                'id': result[0],
+                'name': result[1],
+                'description': result[2],
+                'config_template': result[3],
+                'version': result[4]
+            }
+        return None
+    
+    def update_device_status(self, mac_address: str, status: str, ip_address: str = None):
+        """Actualiza el estado de un dispositivo"""
+        with self.transaction() as conn:
+            if ip_address:
+                conn.execute(
+                    "UPDATE devices SET status = ?, ip_address = ?, last_seen = CURRENT_TIMESTAMP WHERE mac_address = ?",
+                    (status, ip_address, mac_address)
+                )
+            else:
+                conn.execute(
+                    "UPDATE devices SET status = ?, last_seen = CURRENT_TIMESTAMP WHERE mac_address = ?",
+                    (status, mac_address)
+                )
+    
+    def record_checkins(self, checkins: List[Tuple[str, str, str, str]]):
+        """
+        Registra varias conexiones de dispositivos (mac, estado, ip, fecha) en una sola transacción
+        
+        La MAC puede venir en cualquier formato; la fecha usa el formato de
+        CURRENT_TIMESTAMP (UTC, 'AAAA-MM-DD HH:MM:SS').
+        """
+        with self.transaction() as conn:
+            conn.executemany(
+                f"UPDATE devices SET status = ?, ip_address = ?, last_seen = ? WHERE {CLEAN_MAC_SQL} = ?",
+                [(status, ip_address, seen_at, clean_mac_address(mac_address))
+                 for mac_address, status, ip_address, seen_at in checkins]
+            )
     
     def add_log(self, user_id: int, device_mac: str, operation: str, details: str):
         """Agrega un registro de operación"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO logs (user_id, device_mac, operation, details) VALUES (?, ?, ?, ?)",
+                (user_id, device_mac, operation, details)
+            )
+    
+    def add_logs(self, logs: List[Tuple[int, str, str, str]]):
+        """Agrega varios registros (usuario, mac, operación, detalles) en una sola transacción"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO logs (user_id, device_mac, operation, details) VALUES (?, ?, ?, ?)",
+                logs
+            )
+
+
+# Mismos escapes de atributos que ElementTree
+_XML_ATTRIBUTE_ESCAPES = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+    '\r': '&#13;', '\n': '&#10;', '\t': '&#09;',
+})
+
+
+class FanvilXmlWriter:
+    """
+    Serializa documentos FanvilConfig sin construir un árbol de ElementTree
+    
+    La salida es idéntica byte a byte a la de ElementTree con
+    ET.indent(space="  ") y declaración XML. Las líneas <param name="...">
+    ya escapadas se guardan entre documentos (los nombres se repiten en
+    todos los dispositivos) y la lista de fragmentos se reutiliza. Una
+    instancia no debe usarse desde varios hilos a la vez.
+    """
+    
+    DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+    EMPTY_DOCUMENT = DECLARATION + b"<FanvilConfig />"
+    # Nombres distintos que se guardan como máximo
+    MAX_CACHED_NAMES = 4096
+    
+    def __init__(self):
+        self._names = {}
+        self._parts = []
+    
+    def render(self, params: Dict) -> bytes:
+        """Documento FanvilConfig con un <param> por parámetro"""
+        if not params:
+            return self.EMPTY_DOCUMENT
         
-        cursor.execute(
-            "INSERT INTO logs (user_id, device_mac, operation, details) VALUES (?, ?, ?, ?)",
-            (user_id, device_mac, operation, details)
-        )
-        conn.commit()
-        conn.close()
+        names = self._names
+        parts = self._parts
+        parts.clear()
+        parts.append("<FanvilConfig>")
+        for key, value in params.items():
+            prefix = names.get(key)
+            if prefix is None:
+                if len(names) >= self.MAX_CACHED_NAMES:
+                    names.clear()
+                prefix = names[key] = f'\n  <param name="{str.translate(key, _XML_ATTRIBUTE_ESCAPES)}" value="'
+            parts.append(prefix)
+            parts.append(str(value).translate(_XML_ATTRIBUTE_ESCAPES))
+            parts.append('" />')
+        parts.append("\n</FanvilConfig>")
+        return self.DECLARATION + "".join(parts).encode('utf-8', 'xmlcharrefreplace')
 
 
 class ConfigGenerator:
     """Generador de archivos de configuración para dispositivos Fanvil"""
     
-    def __init__(self, config_dir: str = "config_files"):
+    # Un escritor XML por hilo: render_xml se usa también desde los hilos del servidor
+    _xml_writers = threading.local()
+    
+    def __init__(self, config_dir: str = "config_files", publish: bool = False, keep_releases: int = 3):
         self.config_dir = Path(config_dir)
-        self.config_dir.mkdir(exist_ok=True)
+        # En modo publicación los lotes se escriben en un staging y se publican de forma atómica
+        self.publisher = ReleasePublisher(self.config_dir, keep_releases) if publish else None
+        if not self.config_dir.exists():
+            self.config_dir.mkdir()
+        self.output_dir = self.config_dir
+    
+    def begin_batch(self):
+        """Inicia un lote; en modo publicación las escrituras van al staging"""
+        if self.publisher:
+            self.output_dir = self.publisher.stage()
+    
+    def publish_batch(self) -> Optional[str]:
+        """Publica el lote en curso y devuelve la versión publicada"""
+        if not self.publisher or self.output_dir == self.config_dir:
+            return None
+        self.output_dir = self.config_dir
+        return str(self.publisher.publish())
+    
+    def discard_batch(self):
+        """Descarta el lote en curso sin publicarlo"""
+        if self.publisher:
+            self.publisher.discard()
+            self.output_dir = self.config_dir
+    
+    def rollback(self) -> Optional[str]:
+        """Vuelve a publicar la versión anterior del directorio de configuración"""
+        if not self.publisher:
+            return None
+        release = self.publisher.rollback()
+        return str(release) if release else None
+    
+    def _write(self, filename: str, content) -> str:
+        """Escribe un archivo de configuración de forma atómica y devuelve su ruta publicada"""
+        atomic_write(self.output_dir / filename, content)
+        return str(self.config_dir / filename)
     
     def generate_general_config(self, model: str, params: Dict) -> str:
         """Genera archivo de configuración general para un modelo"""
         filename = f"f0C00{model[1:]}00000.cfg"  # Ejemplo: f0C006200000.cfg para C62
-        filepath = self.config_dir / filename
         
         # Convertir parámetros a formato CFG
         config_content = self._dict_to_cfg(params)
         
-        with open(filepath, 'w') as f:
-            f.write(config_content)
-        
-        return str(filepath)
+        return self._write(filename, config_content)
     
     def generate_mac_specific_config(self, mac_address: str, params: Dict) -> str:
         """Genera archivo de configuración específico por MAC"""
         # Convertir MAC a minúsculas y eliminar separadores
-        clean_mac = mac_address.lower().replace(':', '').replace('-', '')
+        clean_mac = clean_mac_address(mac_address)
         filename = f"{clean_mac}.cfg"
-        filepath = self.config_dir / filename
         
         # Convertir parámetros a formato CFG
         config_content = self._dict_to_cfg(params)
         
-        with open(filepath, 'w') as f:
-            f.write(config_content)
-        
-        return str(filepath)
+        return self._write(filename, config_content)
     
     def generate_xml_config(self, mac_address: str, params: Dict) -> str:
         """Genera archivo de configuración en formato XML"""
-        clean_mac = mac_address.lower().replace(':', '').replace('-', '')
+        clean_mac = clean_mac_address(mac_address)
         filename = f"{clean_mac}.xml"
-        filepath = self.config_dir / filename
-        
-        root = ET.Element("FanvilConfig")
-        
-        for key, value in params.items():
-            param_elem = ET.SubElement(root, "param")
-            param_elem.set("name", key)
-            param_elem.set("value", str(value))
         
-        # Guardar XML con formato
-        tree = ET.ElementTree(root)
-        ET.indent(tree, space="  ", level=0)
-        tree.write(filepath, encoding="utf-8", xml_declaration=True)
-        
-        return str(filepath)
+        return self._write(filename, self.render_xml(params))
     
-    def _dict_to_cfg(self, params: Dict) -> str:
+    def generate_xml_configs(self, devices: Iterable[Tuple[str, Dict]]) -> List[str]:
+        """Genera los archivos XML de varios dispositivos (mac, parámetros) con un mismo escritor"""
+        writer = FanvilXmlWriter()
+        return [
+            self._write(f"{clean_mac_address(mac_address)}.xml", writer.render(params))
+            for mac_address, params in devices
+        ]
+    
+    @classmethod
+    def render_xml(cls, params: Dict) -> bytes:
+        """Serializa los parámetros en el formato XML de FanvilConfig"""
+        writer = getattr(cls._xml_writers, 'writer', None)
+        if writer is None:
+            writer = cls._xml_writers.writer = FanvilXmlWriter()
+        return writer.render(params)
+    
+    @staticmethod
+    def render_cfg(params: Dict) -> str:
         """Convierte diccionario de parámetros a formato CFG"""
         lines = []
         for key, value in params.items():
             lines.append(f"{key}={value}")
         return "\n".join(lines)
     
+    def _dict_to_cfg(self, params: Dict) -> str:
+        """Convierte diccionario de parámetros a formato CFG"""
+        return self.render_cfg(params)
+    
+    def generate_layered_config(self, mac_address: str, layer: 'GroupLayer', delta: Dict) -> str:
+        """Genera el archivo CFG de un dispositivo a partir de la capa de su grupo y sus parámetros propios"""
+        return self._write(f"{clean_mac_address(mac_address)}.cfg", layer.render_cfg(delta))
+    
     def encrypt_config(self, filepath: str, encryption_key: str) -> str:
-        """Cifra un archivo de configuración usando AES de 256 bits"""
-        # En una implementación real, se usaría una biblioteca como cryptography
-        # Por simplicidad, aquí solo se simula el proceso
-        encrypted_filepath = f"{filepath}.enc"
-        
-        # Simulación de cifrado (en la realidad usaríamos AES)
-        with open(filepath, 'rb') as f:
-            content = f.read()
+        """Cifra un archivo de configuración con la clave AES configurada en el teléfono"""
+        return encrypt_file(filepath, f"{filepath}.enc", encryption_key_bytes(encryption_key))
+    
+    def encrypt_directory(self, encryption_key: str, workers: Optional[int] = None,
+                          suffixes: Tuple[str, ...] = ('.cfg', '.xml')) -> Dict:
+        """
+        Cifra todas las configuraciones del lote en curso (o del directorio publicado)
         
-        # Simulación de cifrado (no es real, solo para demostración)
-        encrypted_content = content  # Aquí iría la lógica real de cifrado
+        Los archivos se reparten por bloques entre un pool de procesos, con un
+        número acotado de bloques en vuelo. Devuelve las rutas publicadas de
+        los archivos cifrados y los errores por archivo.
+        """
+        _require_cryptography()
+        key = encryption_key_bytes(encryption_key)
+        workers = workers or os.cpu_count() or 1
+        paths = sorted(
+            entry.path for entry in os.scandir(self.output_dir)
+            if entry.is_file() and entry.name.endswith(suffixes)
+        )
+        chunks = [paths[i:i + ENCRYPTION_BATCH_SIZE] for i in range(0, len(paths), ENCRYPTION_BATCH_SIZE)]
         
-        with open(encrypted_filepath, 'wb') as f:
-            f.write(encrypted_content)
+        results = []
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                results.extend(_encrypt_files(chunk, key))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_encrypt_worker,
+                                     initargs=(key,)) as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(_encrypt_files_in_worker, chunk))
+                    if len(pending) >= workers * 2:
+                        results.extend(pending.popleft().result())
+                while pending:
+                    results.extend(pending.popleft().result())
         
-        return encrypted_filepath
+        return {
+            'encrypted': [str(self.config_dir / f"{os.path.basename(path)}.enc") for path, error in results if error is None],
+            'errors': {os.path.basename(path): error for path, error in results if error is not None},
+        }
+
+
+class GroupLayer:
+    """
+    Capa base de configuración de un grupo, interpretada y serializada una sola vez
+    
+    La configuración de un dispositivo equivale a {**parámetros del grupo,
+    **delta}. Las líneas CFG del grupo se generan al crear la capa; por
+    dispositivo solo se serializa su delta, y únicamente si redefine
+    claves del grupo se copian y sustituyen esas líneas. La salida es
+    idéntica a la de ConfigGenerator.render_cfg sobre los parámetros combinados.
+    """
+    
+    def __init__(self, params: Dict, group_id: Optional[int] = None, version: Optional[int] = None):
+        self.group_id = group_id
+        self.version = version
+        self.params = params
+        self._index = {key: i for i, key in enumerate(params)}
+        self._cfg_lines = [f"{key}={value}" for key, value in params.items()]
+        self._cfg = "\n".join(self._cfg_lines)
+    
+    @classmethod
+    def from_group(cls, group: Dict) -> 'GroupLayer':
+        """Crea la capa a partir de una fila de DatabaseManager.get_group"""
+        return cls(json.loads(group['config_template'] or '{}'), group['id'], group['version'])
+    
+    def merge(self, delta: Dict) -> Dict:
+        """Parámetros completos de un dispositivo"""
+        return {**self.params, **delta}
+    
+    def overrides(self, params: Dict) -> Dict:
+        """Parámetros que hay que guardar en el dispositivo: los que el grupo no define con el mismo valor"""
+        return {key: value for key, value in params.items() if key not in self._index or self.params[key] != value}
+    
+    def render_cfg(self, delta: Dict) -> str:
+        """CFG de un dispositivo: las líneas del grupo con su delta superpuesto"""
+        if not delta:
+            return self._cfg
+        lines = self._cfg_lines
+        extra = []
+        for key, value in delta.items():
+            index = self._index.get(key)
+            if index is None:
+                extra.append(f"{key}={value}")
+                continue
+            if lines is self._cfg_lines:
+                lines = list(lines)
+            lines[index] = f"{key}={value}"
+        if lines is self._cfg_lines and self._cfg:
+            return f"{self._cfg}\n" + "\n".join(extra)
+        return "\n".join(lines + extra)
 
 
 class ProvisioningEngine:
     """Motor de aprovisionamiento para gestión de dispositivos"""
     
-    def __init__(self, db_manager: DatabaseManager, config_generator: ConfigGenerator):
+    def __init__(self, db_manager: DatabaseManager, config_generator: ConfigGenerator, write_workers: int = 4):
         self.db_manager = db_manager
         self.config_generator = config_generator
+        # Hilos que escriben archivos de configuración durante los lotes
+        self.write_workers = write_workers
+        # Capas de grupo ya serializadas, por ID de grupo (se descartan al cambiar su versión)
+        self._group_layers = {}
     
     def provision_device(self, mac_address: str, model: str, params: Dict, client_id: int = None) -> bool:
         """Provisiona un dispositivo individual"""
@@ -298,8 +844,18 @@ class ProvisioningEngine:
         if not device_exists:
             self.db_manager.add_device(mac_address, model, client_id)
         
-        # Generar archivo de configuración específico
-        config_file = self.config_generator.generate_mac_specific_config(mac_address, params)
+        if device_exists and device_exists['group_id'] is not None:
+            # Miembro de un grupo: solo se guarda lo que difiere del grupo, para que le lleguen sus cambios
+            layer = self.group_layer(device_exists['group_id'])
+            delta = layer.overrides(params)
+            self.db_manager.set_device_params([(mac_address, delta)])
+            config_file = self.config_generator.generate_layered_config(mac_address, layer, delta)
+        else:
+            # Guardar los parámetros para poder servir la configuración bajo demanda
+            self.db_manager.set_device_params([(mac_address, params)])
+            
+            # Generar archivo de configuración específico
+            config_file = self.config_generator.generate_mac_specific_config(mac_address, params)
         
         # Registrar operación
         user_id = 1  # Suponiendo usuario admin para este ejemplo
@@ -307,24 +863,146 @@ class ProvisioningEngine:
         
         return True
     
-    def provision_batch(self, devices: List[Dict], group_params: Dict) -> List[bool]:
-        """Provisiona múltiples dispositivos"""
-        results = []
-        for device in devices:
-            mac = device['mac_address']
-            model = device['model']
-            client_id = device.get('client_id')
-            
-            # Combinar parámetros generales con específicos del dispositivo
-            params = {**group_params}
-            if 'specific_params' in device:
-                params.update(device['specific_params'])
-            
-            result = self.provision_device(mac, model, params, client_id)
-            results.append(result)
+    def group_layer(self, group_id: int) -> GroupLayer:
+        """Capa de configuración de un grupo, desde la caché si el grupo no ha cambiado"""
+        group = self.db_manager.get_group(group_id)
+        if group is None:
+            raise ValueError(f"Grupo no encontrado: {group_id}")
+        layer = self._group_layers.get(group_id)
+        if layer is None or layer.version != group['version']:
+            layer = self._group_layers[group_id] = GroupLayer.from_group(group)
+        return layer
+    
+    def provision_batch(self, devices: List[Dict], group_params: Optional[Dict] = None,
+                        group_id: Optional[int] = None) -> List[bool]:
+        """
+        Provisiona múltiples dispositivos
+        
+        Las MAC existentes se resuelven en una sola consulta, los dispositivos
+        nuevos y los registros se insertan con executemany en una única
+        transacción, y los archivos se escriben en paralelo mientras tanto.
+        
+        Con group_id los dispositivos se asignan a ese grupo, su configuración
+        base sale de la capa en caché del grupo y solo se guardan sus
+        parámetros propios. Sin group_id cada dispositivo conserva su grupo:
+        los que ya pertenecen a uno se generan con la capa de ese grupo y
+        guardan lo que difiere de ella, como en provision_device, y el resto
+        guarda los parámetros completos. Los parámetros de cada dispositivo son
+        group_params combinados con los suyos; group_params se aplica como una
+        capa temporal y no crea ningún grupo.
+        """
+        user_id = 1  # Suponiendo usuario admin para este ejemplo
+        macs = [device['mac_address'] for device in devices]
+        device_groups = self.db_manager.get_device_groups(macs)
+        common_layer = GroupLayer(group_params or {})
+        
+        # En modo publicación el lote completo se publica de una sola vez al final
+        self.config_generator.begin_batch()
+        try:
+            with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+                futures = []
+                device_params = []
+                for device in devices:
+                    mac = device['mac_address']
+                    specific_params = device.get('specific_params') or {}
+                    device_group_id = group_id if group_id is not None else device_groups.get(mac)
+                    if device_group_id is not None:
+                        # Solo se guardan y serializan los parámetros propios; la base del grupo ya lo está
+                        layer = self.group_layer(device_group_id)
+                        delta = layer.overrides(common_layer.merge(specific_params))
+                        device_params.append((mac, delta))
+                    else:
+                        layer, delta = common_layer, specific_params
+                        device_params.append((mac, common_layer.merge(specific_params)))
+                    
+                    futures.append(executor.submit(
+                        self.config_generator.generate_layered_config, mac, layer, delta
+                    ))
+                
+                with self.db_manager.transaction():
+                    # Registrar los dispositivos nuevos mientras se escriben los archivos
+                    new_devices = {}
+                    for device in devices:
+                        mac = device['mac_address']
+                        if mac not in device_groups and mac not in new_devices:
+                            new_devices[mac] = (mac, device['model'], device.get('client_id'))
+                    self.db_manager.add_devices(list(new_devices.values()))
+                    self.db_manager.set_device_params(device_params)
+                    if group_id is not None:
+                        self.db_manager.set_devices_group(macs, group_id)
+                    
+                    results = []
+                    logs = []
+                    for device, future in zip(devices, futures):
+                        try:
+                            config_file = future.result()
+                        except Exception:
+                            results.append(False)
+                            continue
+                        results.append(True)
+                        logs.append((user_id, device['mac_address'], 'provision', f"Config file generated: {config_file}"))
+                    self.db_manager.add_logs(logs)
+        except BaseException:
+            self.config_generator.discard_batch()
+            raise
+        self.config_generator.publish_batch()
         
         return results
     
+    def reprovision_group(self, group_id: int, chunk_size: int = 500) -> Dict:
+        """
+        Regenera las configuraciones de los dispositivos de un grupo, y solo esas
+        
+        Los miembros se leen del índice de dependencias por bloques y cada
+        bloque se escribe en paralelo con la capa del grupo. Se registra una
+        única entrada de log con el resumen, que también se devuelve.
+        """
+        user_id = 1  # Suponiendo usuario admin para este ejemplo
+        layer = self.group_layer(group_id)
+        start = time.perf_counter()
+        generated = 0
+        failed = []
+        
+        self.config_generator.begin_batch()
+        try:
+            with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+                for chunk in self.db_manager.iter_group_members(group_id, chunk_size):
+                    futures = [
+                        executor.submit(
+                            self.config_generator.generate_layered_config,
+                            mac_address, layer, json.loads(config_params or '{}')
+                        )
+                        for mac_address, config_params in chunk
+                    ]
+                    for (mac_address, _), future in zip(chunk, futures):
+                        try:
+                            future.result()
+                        except Exception:
+                            failed.append(mac_address)
+                            continue
+                        generated += 1
+        except BaseException:
+            self.config_generator.discard_batch()
+            raise
+        self.config_generator.publish_batch()
+        
+        summary = {
+            'group_id': group_id,
+            'version': layer.version,
+            'devices': generated + len(failed),
+            'generated': generated,
+            'failed': failed,
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+        self.db_manager.add_log(user_id, None, 'group_reprovision', json.dumps(summary))
+        return summary
+    
+    def update_group(self, group_id: int, params: Dict) -> Dict:
+        """Cambia la configuración base de un grupo y regenera solo sus dispositivos"""
+        if not self.db_manager.update_group_config(group_id, params):
+            raise ValueError(f"Grupo no encontrado: {group_id}")
+        return self.reprovision_group(group_id)
+    
     def update_firmware(self, mac_address: str, firmware_url: str) -> bool:
         """Actualiza firmware de un dispositivo"""
         # Registrar operación
@@ -341,29 +1019,178 @@ class ProvisioningEngine:
         return True
     
     def add_to_group(self, mac_address: str, group_id: int) -> bool:
-        """Agrega un dispositivo a un grupo de configuración"""
-        conn = sqlite3.connect(self.db_manager.db_path)
-        cursor = conn.cursor()
+        """
+        Agrega un dispositivo a un grupo de configuración y regenera su archivo con la capa del grupo
         
-        cursor.execute(
-            "UPDATE devices SET group_id = ? WHERE mac_address = ?",
-            (group_id, mac_address)
-        )
-        conn.commit()
-        conn.close()
+        Se quitan del dispositivo los parámetros con el mismo valor que en el
+        grupo, para que a partir de ahora los aporte el grupo y le lleguen sus
+        cambios; los que difieren se conservan, como en provision_device.
+        """
+        layer = self.group_layer(group_id)
+        device = self.db_manager.get_device_config(mac_address)
+        if device is None:
+            return False
+        
+        delta = layer.overrides(json.loads(device['config_params'] or '{}'))
+        with self.db_manager.transaction():
+            self.db_manager.set_devices_group([device['mac_address']], group_id)
+            self.db_manager.set_device_params([(device['mac_address'], delta)])
+        self.config_generator.generate_layered_config(mac_address, layer, delta)
         
         return True
 
 
+def detect_input_format(path: str) -> Optional[str]:
+    """Formato de un archivo de dispositivos según su extensión ('csv' o 'jsonl')"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return None
+
+
+def iter_device_rows(path: str, input_format: str) -> Iterator[Tuple[int, Optional[str], Union[Dict, str]]]:
+    """
+    Lee un archivo de dispositivos fila a fila y devuelve (fila, MAC, dispositivo o error)
+    
+    La MAC es None si la fila no la trae o no se puede leer; las filas no
+    válidas la incluyen siempre que se pueda, para identificarlas en el informe.
+    
+    Cada dispositivo tiene mac_address, model, client_id opcional y
+    specific_params. En CSV, las columnas que no son de dispositivo (con
+    valor) pasan a specific_params. En JSONL, cada línea es un objeto que
+    puede traer specific_params explícitos o, si no, los campos restantes.
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if input_format == 'csv':
+            rows = enumerate(csv.DictReader(f), 1)
+        else:
+            rows = ((number, line) for number, line in enumerate(f, 1) if line.strip())
+        
+        for number, row in rows:
+            if input_format == 'jsonl':
+                try:
+                    row = json.loads(row)
+                except ValueError as e:
+                    yield number, None, f"JSON inválido: {e}"
+                    continue
+                if not isinstance(row, dict):
+                    yield number, None, "La línea no es un objeto JSON"
+                    continue
+            
+            mac_address = str(row.get('mac_address') or '').strip()
+            model = str(row.get('model') or '').strip()
+            if input_format == 'csv' and None in row:
+                yield number, mac_address or None, "La fila tiene más columnas que el encabezado"
+                continue
+            if not mac_address or not model:
+                yield number, mac_address or None, "Faltan mac_address o model"
+                continue
+            
+            specific_params = row.get('specific_params')
+            if not isinstance(specific_params, dict):
+                specific_params = {
+                    key: value for key, value in row.items()
+                    if key not in DEVICE_INPUT_FIELDS and key != 'specific_params' and value not in ('', None)
+                }
+            client_id = row.get('client_id')
+            yield number, mac_address, {
+                'mac_address': mac_address,
+                'model': model,
+                'client_id': int(client_id) if str(client_id or '').strip().isdigit() else None,
+                'specific_params': specific_params,
+            }
+
+
 class FanvilProvisioner:
     """Clase principal de la aplicación de aprovisionamiento"""
     
-    def __init__(self):
-        self.db_manager = DatabaseManager()
-        self.config_generator = ConfigGenerator()
+    def __init__(self, db_path: str = "fanvil_provision.db", config_dir: str = "config_files"):
+        self.db_manager = DatabaseManager(db_path)
+        self.config_generator = ConfigGenerator(config_dir)
         self.provisioning_engine = ProvisioningEngine(self.db_manager, self.config_generator)
         self.current_user = None
     
+    def provision_from_file(self, path: str, input_format: str, group_id: Optional[int] = None,
+                            batch_size: int = PROVISION_BATCH_SIZE, results_path: Optional[str] = None,
+                            progress: bool = True) -> Dict:
+        """
+        Aprovisiona los dispositivos de un archivo CSV o JSONL sin interacción
+        
+        El archivo se lee fila a fila y se envía a ProvisioningEngine en lotes
+        de batch_size. Con results_path se escribe una línea JSON por fila
+        (fila, MAC, estado y error), en el orden del archivo: las filas no
+        válidas se guardan en el lote y se escriben junto a las demás cuando
+        este termina. Devuelve el resumen del proceso.
+        """
+        start = time.perf_counter()
+        summary = {'input': path, 'group_id': group_id, 'rows': 0, 'provisioned': 0, 'failed': 0, 'invalid': 0}
+        results_file = open(results_path, 'w', encoding='utf-8') if results_path else None
+        
+        def report(number, mac_address, status, error=None):
+            summary[status] += 1
+            if results_file:
+                results_file.write(json.dumps({'row': number, 'mac_address': mac_address, 'status': status, 'error': error}) + "\n")
+        
+        def run_batch(batch):
+            devices = [device for _, _, device in batch if not isinstance(device, str)]
+            results = iter(self.provisioning_engine.provision_batch(devices, group_id=group_id) if devices else [])
+            for number, mac_address, device in batch:
+                if isinstance(device, str):
+                    report(number, mac_address, 'invalid', device)
+                    continue
+                ok = next(results)
+                report(number, mac_address, 'provisioned' if ok else 'failed',
+                       None if ok else "Error al generar la configuración")
+            if progress:
+                elapsed = time.perf_counter() - start
+                print(f"\r{summary['rows']} filas, {summary['provisioned']} aprovisionados "
+                      f"({summary['provisioned'] / elapsed:.0f} dispositivos/s)", end='', file=sys.stderr, flush=True)
+        
+        try:
+            batch = []
+            for number, mac_address, device in iter_device_rows(path, input_format):
+                summary['rows'] += 1
+                batch.append((number, mac_address, device))
+                if len(batch) >= batch_size:
+                    run_batch(batch)
+                    batch = []
+            if batch:
+                run_batch(batch)
+        finally:
+            if results_file:
+                results_file.close()
+            if progress:
+                print(file=sys.stderr)
+        
+        summary['seconds'] = round(time.perf_counter() - start, 3)
+        summary['devices_per_second'] = round(summary['provisioned'] / summary['seconds'], 1) if summary['seconds'] else None
+        return summary
+    
+    def list_devices(self, status: Optional[str] = None, group_id: Optional[int] = None) -> Iterator[Dict]:
+        """Recorre los dispositivos (opcionalmente por estado o grupo) sin cargarlos todos en memoria"""
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if group_id is not None:
+            conditions.append("group_id = ?")
+            params.append(group_id)
+        
+        cursor = self.db_manager.get_connection().execute(
+            f"""
+            SELECT mac_address, model, ip_address, status, group_id, last_seen FROM devices
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY mac_address
+            """,
+            params
+        )
+        columns = [column[0] for column in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+    
     def login(self, username: str, password: str) -> bool:
         """Inicia sesión de usuario"""
         user = self.db_manager.verify_user(username, password)
@@ -502,12 +1329,9 @@ class FanvilProvisioner:
     
     def _view_devices(self):
         """Ver lista de dispositivos"""
-        conn = sqlite3.connect(self.db_manager.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT mac_address, model, ip_address, status, last_seen FROM devices")
-        devices = cursor.fetchall()
-        conn.close()
+        devices = self.db_manager.get_connection().execute(
+            "SELECT mac_address, model, ip_address, status, last_seen FROM devices"
+        ).fetchall()
         
         print("\n--- Lista de Dispositivos ---")
         print(f"{'MAC Address':<20} {'Modelo':<10} {'IP':<15} {'Estado':<10} {'Última conexión':<20}")
@@ -538,16 +1362,7 @@ class FanvilProvisioner:
                 params[custom_key] = custom_value
         
         # Guardar grupo en base de datos
-        conn = sqlite3.connect(self.db_manager.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO groups (name, description, config_template, created_by) VALUES (?, ?, ?, ?)",
-            (group_name, description, json.dumps(params), self.current_user['id'])
-        )
-        conn.commit()
-        group_id = cursor.lastrowid
-        conn.close()
+        group_id = self.db_manager.add_group(group_name, description, params, self.current_user['id'])
         
         print(f"Grupo '{group_name}' creado con ID {group_id}")
     
@@ -596,8 +1411,96 @@ class FanvilProvisioner:
 
 def main():
     """Función principal"""
-    provisioner = FanvilProvisioner()
-    provisioner.interactive_menu()
+    parser = argparse.ArgumentParser(description='Fanvil Distributed Provisioning Service')
+    parser.add_argument('--db', default='fanvil_provision.db', help='Base de datos (por defecto: fanvil_provision.db)')
+    parser.add_argument('--config-dir', default='config_files', help='Directorio de configuraciones (por defecto: config_files)')
+    subparsers = parser.add_subparsers(dest='command', help='Sin subcomando se abre el menú interactivo')
+    
+    batch_parser = subparsers.add_parser('provision-batch', help='Aprovisiona los dispositivos de un archivo CSV o JSONL')
+    batch_parser.add_argument('--input', required=True, help='Archivo de dispositivos (mac_address, model, client_id y parámetros)')
+    batch_parser.add_argument('--format', choices=['csv', 'jsonl'], help='Formato del archivo (por defecto: según la extensión)')
+    batch_parser.add_argument('--group', type=int, help='ID del grupo cuya configuración base se aplica')
+    batch_parser.add_argument('--batch-size', type=int, default=PROVISION_BATCH_SIZE,
+                              help=f'Dispositivos por lote (por defecto: {PROVISION_BATCH_SIZE})')
+    batch_parser.add_argument('--results', help='Archivo JSONL con el resultado de cada fila')
+    batch_parser.add_argument('--quiet', action='store_true', help='No mostrar el progreso')
+    
+    list_parser = subparsers.add_parser('list-devices', help='Lista los dispositivos registrados')
+    list_parser.add_argument('--status', help='Solo los dispositivos con este estado')
+    list_parser.add_argument('--group', type=int, help='Solo los dispositivos de este grupo')
+    list_parser.add_argument('--format', choices=['table', 'csv', 'jsonl'], default='table', help='Formato de salida (por defecto: table)')
+    
+    group_parser = subparsers.add_parser('create-group', help='Crea un grupo de configuración')
+    group_parser.add_argument('--name', required=True, help='Nombre del grupo')
+    group_parser.add_argument('--description', default='', help='Descripción del grupo')
+    group_parser.add_argument('--from', dest='from_file', required=True, help='Archivo JSON con los parámetros del grupo')
+    
+    encrypt_parser = subparsers.add_parser('encrypt-configs', help='Cifra las configuraciones .cfg y .xml del directorio')
+    encrypt_parser.add_argument('--key', help=f'Clave AES del teléfono (por defecto: ${ENCRYPTION_KEY_ENV} o se pide)')
+    encrypt_parser.add_argument('--workers', type=int, help='Procesos de cifrado (por defecto: uno por núcleo)')
+    
+    args = parser.parse_args()
+    provisioner = FanvilProvisioner(args.db, args.config_dir)
+    
+    if args.command is None:
+        provisioner.interactive_menu()
+    
+    elif args.command == 'provision-batch':
+        input_format = args.format or detect_input_format(args.input)
+        if input_format is None:
+            parser.error("No se reconoce el formato del archivo; use --format csv|jsonl")
+        try:
+            summary = provisioner.provision_from_file(
+                args.input, input_format, group_id=args.group, batch_size=args.batch_size,
+                results_path=args.results, progress=not args.quiet
+            )
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(summary, indent=2))
+        if summary['failed'] or summary['invalid']:
+            sys.exit(2)
+    
+    elif args.command == 'list-devices':
+        devices = provisioner.list_devices(args.status, args.group)
+        if args.format == 'jsonl':
+            for device in devices:
+                print(json.dumps(device))
+        elif args.format == 'csv':
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['mac_address', 'model', 'ip_address', 'status', 'group_id', 'last_seen'])
+            for device in devices:
+                writer.writerow(device.values())
+        else:
+            print(f"{'MAC Address':<20} {'Modelo':<10} {'IP':<15} {'Estado':<10} {'Grupo':<6} {'Última conexión':<20}")
+            print("-" * 86)
+            for device in devices:
+                print(f"{device['mac_address']:<20} {device['model']:<10} {device['ip_address'] or 'N/A':<15} "
+                      f"{device['status']:<10} {device['group_id'] or '-':<6} {device['last_seen'] or 'N/A':<20}")
+    
+    elif args.command == 'create-group':
+        try:
+            with open(args.from_file, 'r', encoding='utf-8') as f:
+                params = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error al leer {args.from_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not isinstance(params, dict):
+            print(f"Error: {args.from_file} debe contener un objeto JSON de parámetros", file=sys.stderr)
+            sys.exit(1)
+        group_id = provisioner.db_manager.add_group(args.name, args.description, params)
+        print(f"Grupo '{args.name}' creado con ID {group_id}")
+    
+    elif args.command == 'encrypt-configs':
+        key = args.key or os.environ.get(ENCRYPTION_KEY_ENV) or getpass.getpass("Clave AES: ")
+        try:
+            result = provisioner.config_generator.encrypt_directory(key, args.workers)
+        except (ImportError, OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps({'encrypted': len(result['encrypted']), 'errors': result['errors']}, indent=2))
+        if result['errors']:
+            sys.exit(2)
 
 
 if __name__ == "__main__":
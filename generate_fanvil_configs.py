@@ -4,12 +4,19 @@ Script para generar archivos de configuración XML para dispositivos Fanvil en l
 """
 
 import os
+import re
 import csv
 import json
+import hashlib
 import argparse
 from string import Template
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from config_publisher import ReleasePublisher, atomic_write
+
 
 def load_template(template_path):
     """Carga la plantilla XML desde un archivo"""
@@ -17,251 +24,615 @@ def load_template(template_path):
         return f.read()
 
 
-def create_config_from_data(template, phone_data):
-    """Crea un archivo de configuración XML reemplazando variables en la plantilla"""
-    # Reemplazar variables de la plantilla primero
-    config_content = template
-    
-    # Reemplazar variables de la plantilla
-    for key, value in phone_data.items():
-        if value is None:
-            value = ""
-        placeholder = f'{{$%s}}' % key
-        config_content = config_content.replace(placeholder, str(value))
-    
-    # Procesar condicionales Smarty paso a paso
-    
-    # 1. Determinar si incluir la segunda cuenta
-    if phone_data.get('account.2.user_id', '').strip():
-        # La segunda cuenta tiene datos, dejarla tal cual después de haber reemplazado variables
-        # Solo procesar los condicionales internos de la segunda cuenta
-        
-        # Procesar Enable_Reg condicional para la cuenta 2
-        enable_reg_conditional_2 = "{if isset($account.2.password)}1{else}0{/if}"
-        if enable_reg_conditional_2 in config_content:
-            if phone_data.get('account.2.password', '').strip():
-                config_content = config_content.replace(enable_reg_conditional_2, "1")
-            else:
-                config_content = config_content.replace(enable_reg_conditional_2, "0")
-        
-        # Procesar condicionales de transporte para la cuenta 2
-        transport_mapping = {
-            'udp': '0',
-            'tcp': '1',
-            'tls': '2',
-            'dns srv': '1'  # DNS SRV no tiene un valor único, se puede usar TCP
-        }
-        
-        for transport_key, transport_value in transport_mapping.items():
-            transport_conditional = f"{{if $account.2.sip_transport == '{transport_key}'}}<Transport>{transport_value}</Transport>{{/if}}"
-            if transport_conditional in config_content:
-                if phone_data.get('account.2.sip_transport', '').lower() == transport_key:
-                    config_content = config_content.replace(transport_conditional, f"<Transport>{transport_value}</Transport>")
-                else:
-                    config_content = config_content.replace(transport_conditional, "")
-        
-        # Procesar condicionales de DNS SRV para la cuenta 2
-        dns_srv_conditional_2 = "{if $account.2.sip_transport == 'dns srv'}<DNS_SRV>1</DNS_SRV>{/if}"
-        if dns_srv_conditional_2 in config_content:
-            if phone_data.get('account.2.sip_transport', '').lower() == 'dns srv':
-                config_content = config_content.replace(dns_srv_conditional_2, "<DNS_SRV>1</DNS_SRV>")
-            else:
-                config_content = config_content.replace(dns_srv_conditional_2, "")
-        
-        dns_srv_mode_conditional_2 = "{if $account.2.sip_transport == 'dns srv'}<DNS_Mode>1</DNS_Mode>{/if}"
-        if dns_srv_mode_conditional_2 in config_content:
-            if phone_data.get('account.2.sip_transport', '').lower() == 'dns srv':
-                config_content = config_content.replace(dns_srv_mode_conditional_2, "<DNS_Mode>1</DNS_Mode>")
-            else:
-                config_content = config_content.replace(dns_srv_mode_conditional_2, "")
-    else:
-        # La segunda cuenta no tiene datos, eliminarla completamente del archivo
-        start_marker = "<!-- Second account starts here -->"
-        end_marker = "<!-- End of second account -->"
-        
-        start_pos = config_content.find(start_marker)
-        end_pos = config_content.find(end_marker)
-        
-        if start_pos != -1 and end_pos != -1:
-            # Incluir también el marcador de cierre en la eliminación
-            end_pos += len(end_marker)
-            config_content = config_content[:start_pos] + config_content[end_pos:]
-    
-    # 2. Procesar condicionales de transporte para la cuenta 1
-    transport_mapping = {
-        'udp': '0',
-        'tcp': '1',
-        'tls': '2',
-        'dns srv': '1'  # DNS SRV no tiene un valor único, se puede usar TCP
-    }
+# Marcadores que delimitan la segunda cuenta dentro de la plantilla
+SECOND_ACCOUNT_START = "<!-- Second account starts here -->"
+SECOND_ACCOUNT_END = "<!-- End of second account -->"
+
+# Subconjunto de Smarty soportado: {$var}, {if ...}, {else} y {/if}
+_TAG_RE = re.compile(r'\{(\$[\w.]+|if\s+[^{}]*|else|/if)\}')
+_ISSET_RE = re.compile(r"isset\(\$([\w.]+)\)$")
+_EQUALS_RE = re.compile(r"\$([\w.]+)\s*==\s*'([^']*)'$")
+
+# Líneas en blanco consecutivas (solo se conserva la primera)
+_BLANK_LINES_RE = re.compile(r'^([^\S\n]*)(?:\n[^\S\n]*$)+', re.MULTILINE)
+
+# Valores por defecto para variables que no vienen en los datos del teléfono
+_DEFAULT_VALUES = {
+    'account.2.sip_port': '5060',
+    'account.2.register_expires': '3600',
+    'account.2.outbound_proxy_primary': '',
+    'account.2.outbound_proxy_secondary': '',
+    'fanvil_time_display': '0',
+    'fanvil_date_display': '0',
+    'http_auth_username': '',
+    'http_auth_password': '',
+    'domain_name': 'example.com',
+    'dns_server_primary': '8.8.8.8',
+    'dns_server_secondary': '8.8.4.4',
+    'ntp_server_primary': 'pool.ntp.org',
+    'ntp_server_secondary': 'time.nist.gov',
+    'fanvil_time_zone': 'GMT+0:00',
+    'fanvil_location': 'Default',
+    'fanvil_time_zone_name': 'GMT',
+    'fanvil_enable_dst': '0',
+}
+
+_MISSING = object()
+
+
+def _value_as_text(phone_data, name):
+    """Devuelve el valor de un campo como texto ('' si no existe o es None)"""
+    value = phone_data.get(name)
+    return '' if value is None else str(value)
+
+
+def _default_value(name, phone_data):
+    """Valor por defecto de una variable ausente, o None si no tiene"""
+    if name == 'fanvil_server_name':
+        return str(phone_data.get('account.1.server_address', 'sip.example.com'))
+    if name == 'fanvil_greeting':
+        return f'Bienvenido {phone_data.get("account.1.user_id", "Usuario")}'
+    return _DEFAULT_VALUES.get(name)
+
+
+def _compile_condition(expression):
+    """Convierte la expresión de un {if} en una función sobre los datos del teléfono"""
+    match = _ISSET_RE.match(expression)
+    if match:
+        name = match.group(1)
+        return lambda phone_data: bool(_value_as_text(phone_data, name).strip())
     
-    for transport_key, transport_value in transport_mapping.items():
-        transport_conditional = f"{{if $account.1.sip_transport == '{transport_key}'}}<Transport>{transport_value}</Transport>{{/if}}"
-        if transport_conditional in config_content:
-            if phone_data.get('account.1.sip_transport', '').lower() == transport_key:
-                config_content = config_content.replace(transport_conditional, f"<Transport>{transport_value}</Transport>")
-            else:
-                config_content = config_content.replace(transport_conditional, "")
+    match = _EQUALS_RE.match(expression)
+    if match:
+        name, expected = match.group(1), match.group(2).lower()
+        return lambda phone_data: _value_as_text(phone_data, name).lower() == expected
+    
+    raise ValueError(f"Condición no soportada en la plantilla: {{if {expression}}}")
+
+
+class _Variable:
+    """Nodo {$var} de la plantilla"""
+    __slots__ = ('name', 'placeholder')
+    
+    def __init__(self, name):
+        self.name = name
+        self.placeholder = '{$%s}' % name
     
-    # 3. Procesar condicionales de DNS SRV para la cuenta 1
-    dns_srv_conditional_1 = "{if $account.1.sip_transport == 'dns srv'}<DNS_SRV>1</DNS_SRV>{/if}"
-    if dns_srv_conditional_1 in config_content:
-        if phone_data.get('account.1.sip_transport', '').lower() == 'dns srv':
-            config_content = config_content.replace(dns_srv_conditional_1, "<DNS_SRV>1</DNS_SRV>")
+    def render(self, phone_data, out):
+        value = phone_data.get(self.name, _MISSING)
+        if value is _MISSING:
+            # Sin dato ni valor por defecto se deja la variable tal cual
+            value = _default_value(self.name, phone_data)
+            out.append(self.placeholder if value is None else value)
+        elif value is None:
+            out.append('')
         else:
-            config_content = config_content.replace(dns_srv_conditional_1, "")
+            out.append(str(value))
+
+
+class _Conditional:
+    """Nodo {if ...}{else}{/if} de la plantilla"""
+    __slots__ = ('test', 'then_nodes', 'else_nodes', 'has_else')
+    
+    def __init__(self, test):
+        self.test = test
+        self.then_nodes = []
+        self.else_nodes = []
+        self.has_else = False
     
-    dns_srv_mode_conditional_1 = "{if $account.1.sip_transport == 'dns srv'}<DNS_Mode>1</DNS_Mode>{/if}"
-    if dns_srv_mode_conditional_1 in config_content:
-        if phone_data.get('account.1.sip_transport', '').lower() == 'dns srv':
-            config_content = config_content.replace(dns_srv_mode_conditional_1, "<DNS_Mode>1</DNS_Mode>")
+    def render(self, phone_data, out):
+        nodes = self.then_nodes if self.test(phone_data) else self.else_nodes
+        if self.has_else:
+            # Las ramas de un bloque con {else} se recortan, como en {if}1{else}0{/if}
+            branch = []
+            _render_nodes(nodes, phone_data, branch)
+            out.append(''.join(branch).strip())
+        else:
+            _render_nodes(nodes, phone_data, out)
+
+
+def _render_nodes(nodes, phone_data, out):
+    """Renderiza una lista de nodos acumulando los fragmentos en out"""
+    for node in nodes:
+        if node.__class__ is str:
+            out.append(node)
         else:
-            config_content = config_content.replace(dns_srv_mode_conditional_1, "")
+            node.render(phone_data, out)
+
+
+def _parse(source):
+    """Analiza un fragmento de plantilla y devuelve su lista de nodos"""
+    nodes = []
+    current = nodes
+    stack = []  # (condicional abierto, lista de nodos padre)
+    pos = 0
     
-    # 4. Procesar Enable_Reg condicional para la cuenta 1
-    enable_reg_conditional_1 = "{if isset($account.1.password)}1{else}0{/if}"
-    if enable_reg_conditional_1 in config_content:
-        if phone_data.get('account.1.password', '').strip():
-            config_content = config_content.replace(enable_reg_conditional_1, "1")
+    for match in _TAG_RE.finditer(source):
+        if match.start() > pos:
+            _append_literal(current, source[pos:match.start()])
+        pos = match.end()
+        tag = match.group(1)
+        
+        if tag.startswith('$'):
+            current.append(_Variable(tag[1:]))
+        elif tag == 'else':
+            if not stack or stack[-1][0].has_else:
+                raise ValueError("Plantilla inválida: {else} sin {if} correspondiente")
+            stack[-1][0].has_else = True
+            current = stack[-1][0].else_nodes
+        elif tag == '/if':
+            if not stack:
+                raise ValueError("Plantilla inválida: {/if} sin {if} correspondiente")
+            current = stack.pop()[1]
         else:
-            config_content = config_content.replace(enable_reg_conditional_1, "0")
+            conditional = _Conditional(_compile_condition(tag[2:].strip()))
+            current.append(conditional)
+            stack.append((conditional, current))
+            current = conditional.then_nodes
     
-    # 5. Procesar condicionales comunes
+    if stack:
+        raise ValueError("Plantilla inválida: {if} sin cerrar")
+    if pos < len(source):
+        _append_literal(current, source[pos:])
     
-    # Condición para fanvil_time_display
-    while '{if isset($fanvil_time_display)}' in config_content:
-        start_tag = '{if isset($fanvil_time_display)}'
-        else_part = '{else}'
-        end_tag = '{/if}'
-        
-        start_pos = config_content.find(start_tag)
-        if start_pos != -1:
-            # Encontrar la parte 'else' y el final
-            else_pos = config_content.find(else_part, start_pos)
-            end_pos = config_content.find(end_tag, start_pos) + len(end_tag)
-            
-            if else_pos != -1 and else_pos < end_pos:
-                # Extraer las partes
-                if_part_start = start_pos + len(start_tag)
-                if_part_end = else_pos
-                else_part_start = else_pos + len(else_part)
-                else_part_end = end_pos - len(end_tag)
-                
-                if_content = config_content[if_part_start:if_part_end].strip()
-                else_content = config_content[else_part_start:else_part_end].strip()
-                
-                # Determinar qué valor usar
-                if phone_data.get('fanvil_time_display', '').strip():
-                    replacement = if_content
-                else:
-                    replacement = else_content
-                
-                # Reemplazar el bloque condicional completo
-                config_content = config_content[:start_pos] + replacement + config_content[end_pos:]
-            else:
-                # Sin parte else, solo eliminar la condición
-                config_content = config_content.replace(start_tag, '').replace(end_tag, '')
-    
-    # 6. Reemplazar cualquier variable restante que no haya sido procesada
-    remaining_vars = [
-        'account.2.sip_port', 'account.2.register_expires', 'account.2.outbound_proxy_primary',
-        'account.2.outbound_proxy_secondary', 'fanvil_time_display', 'fanvil_date_display',
-        'http_auth_username', 'http_auth_password', 'domain_name', 'fanvil_server_name',
-        'dns_server_primary', 'dns_server_secondary', 'ntp_server_primary', 'ntp_server_secondary',
-        'fanvil_time_zone', 'fanvil_location', 'fanvil_time_zone_name', 'fanvil_enable_dst',
-        'fanvil_greeting'
-    ]
-    
-    for var in remaining_vars:
-        placeholder = f'{{$%s}}' % var
-        if placeholder in config_content:
-            value = phone_data.get(var, '')
-            if not value:
-                # Asignar valor por defecto si no está definido
-                defaults = {
-                    'account.2.sip_port': '5060',
-                    'account.2.register_expires': '3600',
-                    'account.2.outbound_proxy_primary': '',
-                    'account.2.outbound_proxy_secondary': '',
-                    'fanvil_time_display': '0',
-                    'fanvil_date_display': '0',
-                    'http_auth_username': '',
-                    'http_auth_password': '',
-                    'domain_name': 'example.com',
-                    'fanvil_server_name': phone_data.get('account.1.server_address', 'sip.example.com'),
-                    'dns_server_primary': '8.8.8.8',
-                    'dns_server_secondary': '8.8.4.4',
-                    'ntp_server_primary': 'pool.ntp.org',
-                    'ntp_server_secondary': 'time.nist.gov',
-                    'fanvil_time_zone': 'GMT+0:00',
-                    'fanvil_location': 'Default',
-                    'fanvil_time_zone_name': 'GMT',
-                    'fanvil_enable_dst': '0',
-                    'fanvil_greeting': f'Bienvenido {phone_data.get("account.1.user_id", "Usuario")}'
-                }
-                value = defaults.get(var, '')
-            config_content = config_content.replace(placeholder, str(value))
-    
-    # Eliminar líneas vacías sobrantes
-    lines = config_content.split('\n')
-    cleaned_lines = []
-    prev_empty = False
-    
-    for line in lines:
-        is_empty = line.strip() == ''
-        if is_empty and prev_empty:
-            continue  # Skip consecutive empty lines
-        cleaned_lines.append(line)
-        prev_empty = is_empty
-    
-    config_content = '\n'.join(cleaned_lines)
-    
-    return config_content
+    return nodes
 
 
-def create_config_file(mac_address, phone_data, template, output_dir):
-    """
-    Genera un archivo de configuración XML para un dispositivo Fanvil específico
-    """
+def _append_literal(nodes, text):
+    """Agrega texto literal fusionándolo con el literal anterior si lo hay"""
+    if nodes and nodes[-1].__class__ is str:
+        nodes[-1] += text
+    else:
+        nodes.append(text)
+
+
+class CompiledTemplate:
+    """Plantilla compilada en nodos literales, variables y condicionales"""
+    __slots__ = ('nodes',)
+    
+    def __init__(self, nodes):
+        self.nodes = nodes
+    
+    def render(self, phone_data):
+        """Genera el contenido de configuración para un teléfono"""
+        out = []
+        _render_nodes(self.nodes, phone_data, out)
+        # Eliminar líneas vacías sobrantes
+        return _BLANK_LINES_RE.sub(r'\1', ''.join(out))
+
+
+@lru_cache(maxsize=8)
+def compile_template(template):
+    """Compila la plantilla una sola vez en un plan de renderizado"""
+    start_pos = template.find(SECOND_ACCOUNT_START)
+    end_pos = template.find(SECOND_ACCOUNT_END)
+    
+    if start_pos != -1 and end_pos != -1 and start_pos < end_pos:
+        # La segunda cuenta (marcadores incluidos) solo se incluye si tiene usuario
+        end_pos += len(SECOND_ACCOUNT_END)
+        second_account = _Conditional(_compile_condition('isset($account.2.user_id)'))
+        second_account.then_nodes = _parse(template[start_pos:end_pos])
+        nodes = _parse(template[:start_pos]) + [second_account] + _parse(template[end_pos:])
+    else:
+        nodes = _parse(template)
+    
+    return CompiledTemplate(nodes)
+
+
+def create_config_from_data(template, phone_data):
+    """Crea un archivo de configuración XML reemplazando variables en la plantilla"""
+    if isinstance(template, str):
+        template = compile_template(template)
+    return template.render(phone_data)
+
+
+def clean_mac(mac_address):
+    """Normaliza una MAC para usarla como nombre de archivo (minúsculas, sin separadores)"""
+    return mac_address.replace(':', '').replace('-', '').lower()
+
+
+def config_file_path(mac_address, output_dir):
+    """Ruta del archivo de configuración XML de un dispositivo"""
+    # Nombre del archivo basado en la dirección MAC
+    return os.path.join(output_dir, f"{clean_mac(mac_address)}.xml")
+
+
+def write_config_file(mac_address, phone_data, template, output_dir):
+    """Escribe el archivo de configuración XML de un dispositivo y devuelve su ruta"""
     # Crear el contenido del archivo de configuración
     config_content = create_config_from_data(template, phone_data)
     
-    # Nombre del archivo basado en la dirección MAC
-    filename = f"{mac_address.replace(':', '').replace('-', '').lower()}.xml"
-    filepath = os.path.join(output_dir, filename)
+    filepath = config_file_path(mac_address, output_dir)
     
-    # Escribir el archivo
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(config_content)
+    # Escribir el archivo (temporal + rename: nunca se sirve a medio escribir)
+    atomic_write(filepath, config_content)
     
+    return filepath
+
+
+# Manifiesto con el hash de entrada de cada configuración generada
+MANIFEST_FILENAME = '.fanvil-manifest.json'
+
+
+def template_digest(template):
+    """Hash de la plantilla, parte del hash de cada teléfono"""
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()
+
+
+def phone_digest(phone_data, template_hash):
+    """Hash de los datos de entrada de un teléfono junto con la plantilla"""
+    row = json.dumps(phone_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{template_hash}\n{row}".encode('utf-8')).hexdigest()
+
+
+def load_manifest(output_dir):
+    """Carga el manifiesto del directorio de salida ({} si no existe o no es válido)"""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('phones'), dict):
+        return {}
+    return manifest
+
+
+def save_manifest(output_dir, manifest):
+    """Guarda el manifiesto de forma atómica (archivo temporal + rename)"""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    atomic_write(manifest_path, json.dumps(manifest, indent=0, sort_keys=True))
+
+
+def prune_orphan_configs(output_dir, previous_phones, seen):
+    """Elimina las configuraciones del manifiesto anterior que ya no están en la entrada"""
+    removed = []
+    for key in previous_phones:
+        if key in seen:
+            continue
+        filepath = config_file_path(key, output_dir)
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            continue
+        removed.append(filepath)
+    return removed
+
+
+def create_config_file(mac_address, phone_data, template, output_dir):
+    """
+    Genera un archivo de configuración XML para un dispositivo Fanvil específico
+    """
+    filepath = write_config_file(mac_address, phone_data, template, output_dir)
     print(f"Archivo de configuración generado: {filepath}")
     return filepath
 
 
-def read_phone_data_from_csv(csv_file):
-    """Lee los datos de los teléfonos desde un archivo CSV"""
-    phones = []
-    
+def iter_phone_data_from_csv(csv_file):
+    """Lee los datos de los teléfonos desde un archivo CSV, uno a uno"""
     with open(csv_file, 'r', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         for row in reader:
-            # Limpiar espacios en blanco de los valores
-            cleaned_row = {k: v.strip() if v else '' for k, v in row.items()}
-            phones.append(cleaned_row)
+            # Limpiar espacios en blanco de los valores (las columnas sobrantes quedan en la clave None)
+            yield {k: v.strip() if isinstance(v, str) else (v or '') for k, v in row.items()}
+
+
+def read_phone_data_from_csv(csv_file):
+    """Lee los datos de los teléfonos desde un archivo CSV"""
+    return list(iter_phone_data_from_csv(csv_file))
+
+
+# Tamaño de los bloques leídos al analizar JSON de forma incremental
+JSON_READ_SIZE = 64 * 1024
+
+# Caracteres que pueden continuar un número JSON
+_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+class _JsonStream:
+    """Lector incremental de JSON que solo mantiene en memoria el valor en curso"""
+    
+    def __init__(self, f, read_size=JSON_READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
     
-    return phones
+    def _fill(self, size):
+        """Lee más datos del archivo; devuelve False si ya no quedan"""
+        if self.eof:
+            return False
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return False
+        # Descartar lo ya consumido antes de crecer el buffer
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+    
+    def peek(self):
+        """Salta espacios y devuelve el siguiente carácter ('' al final del archivo)"""
+        while True:
+            buffer, pos = self.buffer, self.pos
+            while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos += 1
+            self.pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self._fill(self.read_size):
+                return ''
+    
+    def expect(self, chars):
+        """Consume el siguiente carácter, que debe ser uno de chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"JSON inválido: se esperaba {chars!r} en lugar de {char!r}")
+        self.pos += 1
+        return char
+    
+    def value(self):
+        """Decodifica el siguiente valor JSON completo"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # Un número al final del buffer podría estar cortado
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in _NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Valor incompleto: leer más (al menos tanto como lo pendiente)
+            self._fill(max(self.read_size, len(self.buffer) - self.pos))
+    
+    def array_items(self):
+        """Genera los elementos de un array JSON cuyo '[' aún no se ha consumido"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
 
 
-def read_phone_data_from_json(json_file):
-    """Lee los datos de los teléfonos desde un archivo JSON"""
+def iter_phone_data_from_json(json_file):
+    """
+    Lee los datos de los teléfonos desde un archivo JSON, uno a uno
+    
+    Admite un array en la raíz, un objeto {"phones": [...]} o un único teléfono,
+    y analiza los arrays de forma incremental sin cargar el archivo completo.
+    """
     with open(json_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        if isinstance(data, list):
-            return data
-        elif isinstance(data, dict) and 'phones' in data:
-            return data['phones']
+        stream = _JsonStream(f)
+        first = stream.peek()
+        
+        if first == '[':
+            yield from stream.array_items()
+            return
+        if first != '{':
+            yield stream.value()  # Suponemos que es un solo teléfono
+            return
+        
+        # Objeto en la raíz: buscar la clave "phones" sin cargar el resto
+        stream.expect('{')
+        data = {}
+        if stream.peek() != '}':
+            while True:
+                key = stream.value()
+                stream.expect(':')
+                if key == 'phones':
+                    if stream.peek() == '[':
+                        yield from stream.array_items()
+                    else:
+                        phones = stream.value()
+                        yield from phones if isinstance(phones, list) else [phones]
+                    return
+                data[key] = stream.value()
+                if stream.expect(',}') == '}':
+                    break
         else:
-            return [data]  # Suponemos que es un solo teléfono
+            stream.expect('}')
+        
+        yield data  # Suponemos que es un solo teléfono
+
+
+def read_phone_data_from_json(json_file):
+    """Lee los datos de los teléfonos desde un archivo JSON"""
+    return list(iter_phone_data_from_json(json_file))
+
+
+REQUIRED_FIELDS = [
+    'account.1.user_id', 'account.1.password', 'account.1.server_address',
+    'account.1.display_name', 'account.1.auth_id'
+]
+
+# Número de teléfonos que se envían juntos a cada proceso de trabajo
+DEFAULT_CHUNK_SIZE = 256
+
+
+def get_phone_mac(phone_data, index):
+    """Obtiene la MAC de un teléfono del lote (o una MAC ficticia según su posición)"""
+    return phone_data.get('mac_address', phone_data.get('mac', f'00000000000{index:02d}'))
+
+
+def apply_batch_defaults(phone_data):
+    """Completa los datos de un teléfono del lote con los valores por defecto"""
+    # Asegurarse de que todos los campos necesarios estén presentes
+    for field in REQUIRED_FIELDS:
+        if field not in phone_data or not phone_data[field]:
+            phone_data[field] = phone_data.get(field, '')
+    
+    # Establecer valores por defecto si no están presentes
+    defaults = {
+        'account.1.sip_port': '5060',
+        'account.1.register_expires': '3600',
+        'account.1.outbound_proxy_primary': '',
+        'account.1.outbound_proxy_secondary': '',
+        'account.1.sip_transport': 'udp',
+        'fanvil_server_name': phone_data.get('account.1.server_address', 'sip.example.com'),
+        'dns_server_primary': '8.8.8.8',
+        'dns_server_secondary': '8.8.4.4',
+        'ntp_server_primary': 'pool.ntp.org',
+        'ntp_server_secondary': 'time.nist.gov',
+        'fanvil_time_zone': 'GMT+0:00',
+        'fanvil_location': 'Default',
+        'fanvil_time_zone_name': 'GMT',
+        'fanvil_enable_dst': '0',
+        'fanvil_greeting': f'Bienvenido {phone_data.get("account.1.user_id", "Usuario")}',
+        'fanvil_time_display': '0',
+        'fanvil_date_display': '0',
+        'http_auth_username': '',
+        'http_auth_password': '',
+        'domain_name': 'example.com'
+    }
+    
+    for key, default_value in defaults.items():
+        if key not in phone_data or not phone_data[key]:
+            phone_data[key] = default_value
+    
+    return phone_data
+
+
+def _generate_chunk(chunk, template, output_dir, template_hash, previous_phones):
+    """
+    Genera un bloque de teléfonos y devuelve un resultado por cada uno
+    
+    Cada resultado es un diccionario con mac, filepath, status ('created',
+    'updated', 'unchanged' o 'failed'), digest y error. Si previous_phones no es
+    None, los teléfonos cuyo hash coincide con el del manifiesto y cuyo archivo
+    sigue existiendo no se vuelven a escribir.
+    """
+    results = []
+    for index, phone_data in chunk:
+        mac = get_phone_mac(phone_data, index)
+        result = {'mac': mac, 'filepath': None, 'status': 'failed', 'digest': None, 'error': None}
+        try:
+            result['filepath'] = filepath = config_file_path(mac, output_dir)
+            result['digest'] = digest = phone_digest(phone_data, template_hash)
+            exists = os.path.exists(filepath)
+            
+            if exists and previous_phones is not None and previous_phones.get(clean_mac(mac)) == digest:
+                result['status'] = 'unchanged'
+            else:
+                apply_batch_defaults(phone_data)
+                write_config_file(mac, phone_data, template, output_dir)
+                result['status'] = 'updated' if exists else 'created'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        results.append(result)
+    return results
+
+
+# Estado de cada proceso de trabajo: la plantilla se compila una sola vez por proceso
+_worker_args = None
+
+
+def _init_worker(template, output_dir, template_hash, previous_phones):
+    """Inicializa un proceso de trabajo del pool"""
+    global _worker_args
+    _worker_args = (compile_template(template), output_dir, template_hash, previous_phones)
+
+
+def _generate_chunk_in_worker(chunk):
+    """Genera un bloque de teléfonos dentro de un proceso de trabajo"""
+    return _generate_chunk(chunk, *_worker_args)
+
+
+def _chunked(iterable, size):
+    """Agrupa los elementos de un iterable en listas de como máximo size elementos"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def generate_batch(phone_data_list, template, output_dir, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                   previous_phones=None):
+    """
+    Genera las configuraciones de un lote de teléfonos y devuelve los resultados en orden
+    
+    Con jobs > 1 los bloques de teléfonos se reparten entre un pool de procesos y
+    solo se mantiene en vuelo un número acotado de bloques. previous_phones es la
+    tabla MAC -> hash del manifiesto anterior para la regeneración incremental.
+    """
+    chunks = _chunked(enumerate(phone_data_list), chunk_size)
+    template_hash = template_digest(template)
+    
+    if jobs <= 1:
+        compiled = compile_template(template)
+        for chunk in chunks:
+            yield from _generate_chunk(chunk, compiled, output_dir, template_hash, previous_phones)
+        return
+    
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(template, output_dir, template_hash, previous_phones)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_generate_chunk_in_worker, chunk))
+            if len(pending) >= jobs * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def run_batch(phone_data_list, template, output_dir, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE,
+              force=False, prune=False):
+    """Genera un lote completo actualizando el manifiesto e informa del resultado"""
+    manifest = load_manifest(output_dir)
+    previous_phones = manifest.get('phones', {})
+    template_hash = template_digest(template)
+    
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+    phones = {}
+    seen = set()
+    failures = []
+    
+    for result in generate_batch(phone_data_list, template, output_dir,
+                                 jobs=jobs, chunk_size=chunk_size,
+                                 previous_phones=None if force else previous_phones):
+        key = clean_mac(str(result['mac']))
+        seen.add(key)
+        if result['error']:
+            failures.append((result['mac'], result['error']))
+            print(f"Error al generar la configuración de {result['mac']}: {result['error']}")
+            continue
+        
+        counts[result['status']] += 1
+        phones[key] = result['digest']
+        if result['status'] != 'unchanged':
+            print(f"Archivo de configuración generado: {result['filepath']}")
+    
+    removed = []
+    if prune:
+        removed = prune_orphan_configs(output_dir, previous_phones, seen)
+        for filepath in removed:
+            print(f"Archivo de configuración eliminado: {filepath}")
+    else:
+        # Conservar las entradas huérfanas para poder eliminarlas más adelante
+        for key, digest in previous_phones.items():
+            if key not in seen:
+                phones[key] = digest
+    
+    save_manifest(output_dir, {'template': template_hash, 'phones': phones})
+    
+    print(f"Creados: {counts['created']}, actualizados: {counts['updated']}, "
+          f"sin cambios: {counts['unchanged']}, eliminados: {len(removed)}, "
+          f"con errores: {len(failures)}")
+    if failures:
+        print("Fallos por MAC:")
+        for mac, error in failures:
+            print(f"  - {mac}: {error}")
 
 
 def main():
@@ -275,88 +646,76 @@ def main():
     parser.add_argument('--account1_user_id', help='Usuario SIP cuenta 1 (requerido si se usa --single)')
     parser.add_argument('--account1_password', help='Contraseña SIP cuenta 1 (requerido si se usa --single)')
     parser.add_argument('--account1_server_address', help='Servidor SIP cuenta 1 (requerido si se usa --single)')
+    parser.add_argument('--jobs', type=int, default=1, help='Procesos en paralelo para el modo lote (0 = todos los núcleos, por defecto: 1)')
+    parser.add_argument('--force', action='store_true', help='Regenerar todos los archivos aunque no hayan cambiado')
+    parser.add_argument('--prune', action='store_true', help='Eliminar los archivos generados en ejecuciones anteriores que ya no están en la entrada')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'Teléfonos por bloque enviado a cada proceso (por defecto: {DEFAULT_CHUNK_SIZE})')
+    parser.add_argument('--publish', action='store_true', help='Generar en un staging y publicar el lote completo de forma atómica mediante un enlace simbólico')
+    parser.add_argument('--keep-releases', type=int, default=3, help='Versiones publicadas que se conservan para volver atrás (por defecto: 3)')
+    parser.add_argument('--rollback', action='store_true', help='Volver a publicar la versión anterior del directorio de salida')
     
     args = parser.parse_args()
     
+    if args.rollback:
+        release = ReleasePublisher(args.output_dir, keep=args.keep_releases).rollback()
+        if release is None:
+            print(f"Error: No hay una versión anterior publicada para {args.output_dir}")
+        else:
+            print(f"Versión restaurada: {release}")
+        return
+    
     # Cargar la plantilla
     if not os.path.exists(args.template):
         print(f"Error: No se encontró la plantilla en {args.template}")
         return
     
-    template = load_template(args.template)
+    if args.jobs < 0 or args.chunk_size < 1:
+        print("Error: --jobs debe ser 0 o mayor y --chunk-size debe ser 1 o mayor")
+        return
+    jobs = args.jobs or os.cpu_count() or 1
     
-    # Asegurarse de que el directorio de salida exista
-    os.makedirs(args.output_dir, exist_ok=True)
+    template = load_template(args.template)
     
     if args.single:
         # Modo individual
         if not args.mac or not args.account1_user_id or not args.account1_password or not args.account1_server_address:
             print("Error: Para el modo individual, se requieren --mac, --account1_user_id, --account1_password y --account1_server_address")
             return
-        
-        phone_data = {
-            'account.1.user_id': args.account1_user_id,
-            'account.1.password': args.account1_password,
-            'account.1.server_address': args.account1_server_address,
-            'account.1.display_name': args.account1_user_id,
-            'account.1.auth_id': args.account1_user_id,
-            'account.1.sip_port': '5060',
-            'account.1.register_expires': '3600',
-            'account.1.outbound_proxy_primary': '',
-            'account.1.outbound_proxy_secondary': '',
-            'account.1.sip_transport': 'udp',
-            'fanvil_server_name': args.account1_server_address,
-            'dns_server_primary': '8.8.8.8',
-            'dns_server_secondary': '8.8.4.4',
-            'ntp_server_primary': 'pool.ntp.org',
-            'ntp_server_secondary': 'time.nist.gov',
-            'fanvil_time_zone': 'GMT+0:00',
-            'fanvil_location': 'Default',
-            'fanvil_time_zone_name': 'GMT',
-            'fanvil_enable_dst': '0',
-            'fanvil_greeting': f'Bienvenido {args.account1_user_id}',
-            'fanvil_time_display': '0',
-            'fanvil_date_display': '0',
-            'http_auth_username': '',
-            'http_auth_password': '',
-            'domain_name': 'example.com'
-        }
-        
-        create_config_file(args.mac, phone_data, template, args.output_dir)
-        
-    else:
+    elif args.csv:
         # Modo lote
-        if args.csv:
-            phone_data_list = read_phone_data_from_csv(args.csv)
-        elif args.json:
-            phone_data_list = read_phone_data_from_json(args.json)
-        else:
-            print("Error: Debe especificar un archivo --csv o --json con los datos de los teléfonos")
-            return
-        
-        print(f"Procesando {len(phone_data_list)} teléfonos...")
-        
-        for i, phone_data in enumerate(phone_data_list):
-            mac = phone_data.get('mac_address', phone_data.get('mac', f'00000000000{i:02d}'))
-            
-            # Asegurarse de que todos los campos necesarios estén presentes
-            required_fields = [
-                'account.1.user_id', 'account.1.password', 'account.1.server_address',
-                'account.1.display_name', 'account.1.auth_id'
-            ]
-            
-            for field in required_fields:
-                if field not in phone_data or not phone_data[field]:
-                    phone_data[field] = phone_data.get(field, '')
-            
-            # Establecer valores por defecto si no están presentes
-            defaults = {
+        source = args.csv
+        phone_data_list = iter_phone_data_from_csv(args.csv)
+    elif args.json:
+        source = args.json
+        phone_data_list = iter_phone_data_from_json(args.json)
+    else:
+        print("Error: Debe especificar un archivo --csv o --json con los datos de los teléfonos")
+        return
+    
+    # Con --publish todo se escribe en un staging que se publica al terminar
+    publisher = None
+    output_dir = args.output_dir
+    if args.publish:
+        publisher = ReleasePublisher(args.output_dir, keep=args.keep_releases)
+        output_dir = str(publisher.stage())
+    else:
+        # Asegurarse de que el directorio de salida exista
+        os.makedirs(args.output_dir, exist_ok=True)
+    
+    try:
+        if args.single:
+            phone_data = {
+                'account.1.user_id': args.account1_user_id,
+                'account.1.password': args.account1_password,
+                'account.1.server_address': args.account1_server_address,
+                'account.1.display_name': args.account1_user_id,
+                'account.1.auth_id': args.account1_user_id,
                 'account.1.sip_port': '5060',
                 'account.1.register_expires': '3600',
                 'account.1.outbound_proxy_primary': '',
                 'account.1.outbound_proxy_secondary': '',
                 'account.1.sip_transport': 'udp',
-                'fanvil_server_name': phone_data.get('account.1.server_address', 'sip.example.com'),
+                'fanvil_server_name': args.account1_server_address,
                 'dns_server_primary': '8.8.8.8',
                 'dns_server_secondary': '8.8.4.4',
                 'ntp_server_primary': 'pool.ntp.org',
@@ -365,7 +724,7 @@ def main():
                 'fanvil_location': 'Default',
                 'fanvil_time_zone_name': 'GMT',
                 'fanvil_enable_dst': '0',
-                'fanvil_greeting': f'Bienvenido {phone_data.get("account.1.user_id", "Usuario")}',
+                'fanvil_greeting': f'Bienvenido {args.account1_user_id}',
                 'fanvil_time_display': '0',
                 'fanvil_date_display': '0',
                 'http_auth_username': '',
@@ -373,11 +732,20 @@ def main():
                 'domain_name': 'example.com'
             }
             
-            for key, default_value in defaults.items():
-                if key not in phone_data or not phone_data[key]:
-                    phone_data[key] = default_value
-            
-            create_config_file(mac, phone_data, template, args.output_dir)
+            create_config_file(args.mac, phone_data, template, output_dir)
+        else:
+            # Los teléfonos se leen, generan y escriben a medida que se recorre el archivo
+            print(f"Procesando teléfonos desde {source}...")
+            run_batch(phone_data_list, template, output_dir, jobs=jobs, chunk_size=args.chunk_size,
+                      force=args.force, prune=args.prune)
+    except BaseException:
+        if publisher is not None:
+            publisher.discard()
+        raise
+    
+    if publisher is not None:
+        release = publisher.publish()
+        print(f"Versión publicada: {release}")
     
     print(f"Proceso completado. Archivos generados en: {args.output_dir}")
 
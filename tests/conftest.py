@@ -0,0 +1,11 @@
+"""
+Configuración común de las pruebas
+"""
+
+import sys
+from pathlib import Path
+
+# Los módulos están en la raíz del proyecto y el servidor en fanvil-provisioning/
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'fanvil-provisioning'))
@@ -0,0 +1,58 @@
+"""
+Pruebas de la importación masiva
+"""
+
+import time
+
+import pytest
+
+from bulk_import import ImportManager
+from config_jobs import RegenerationQueue
+from device_store import DeviceStore
+
+
+CSV_HEADER = 'mac_address,account.1.user_id,account.1.password,account.1.server_address\n'
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DeviceStore(str(tmp_path / 'devices.db'))
+
+
+def wait_for(manager, job_id):
+    for _ in range(500):
+        job = manager.get(job_id)
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError('La importación no terminó')
+
+
+def test_import_generates_through_regeneration_queue(tmp_path, store):
+    generated = []
+    
+    def generate_config(key, device):
+        if device['username'] == '1002':
+            raise ValueError('plantilla rota')
+        generated.append(key)
+    
+    queue = RegenerationQueue(store, generate_config, workers=2)
+    manager = ImportManager(store, queue, chunk_size=2)
+    source = tmp_path / 'phones.csv'
+    source.write_text(
+        CSV_HEADER
+        + '00:11:22:33:44:01,1001,x,sip.example.com\n'
+        + '00:11:22:33:44:02,1002,x,sip.example.com\n'
+        + 'no-es-mac,1003,x,sip.example.com\n'
+        + '00:11:22:33:44:04,1004,x,sip.example.com\n'
+    )
+    
+    job = wait_for(manager, manager.submit(str(source), 'phones.csv', 'csv').id)
+    assert job['status'] == 'done'
+    assert (job['processed'], job['imported'], job['failed']) == (4, 2, 2)
+    errors = sorted((error['row'], error['mac'], error['error']) for error in job['errors'])
+    assert [error[:2] for error in errors] == [(2, '00:11:22:33:44:02'), (3, 'no-es-mac')]
+    assert 'plantilla rota' in errors[0][2]
+    assert sorted(generated) == ['001122334401', '001122334404']
+    assert store.count() == 3
+    assert not source.exists()
@@ -0,0 +1,71 @@
+"""
+Pruebas de la publicación atómica de configuraciones
+"""
+
+import os
+
+from config_publisher import ReleasePublisher, atomic_write, atomic_writer
+
+
+def test_atomic_write_replaces_without_temporaries(tmp_path):
+    target = tmp_path / 'config.xml'
+    atomic_write(target, 'uno')
+    atomic_write(target, b'dos')
+    assert target.read_bytes() == b'dos'
+    assert os.listdir(tmp_path) == ['config.xml']
+
+
+def test_atomic_writer_keeps_original_on_error(tmp_path):
+    target = tmp_path / 'config.xml'
+    target.write_bytes(b'original')
+    try:
+        with atomic_writer(target) as f:
+            f.write(b'parcial')
+            raise RuntimeError('fallo')
+    except RuntimeError:
+        pass
+    assert target.read_bytes() == b'original'
+    assert os.listdir(tmp_path) == ['config.xml']
+
+
+def test_publish_and_rollback(tmp_path):
+    live = tmp_path / 'config'
+    live.mkdir()
+    (live / 'a.xml').write_text('v1')
+    publisher = ReleasePublisher(live)
+    
+    staging = publisher.stage()
+    assert (staging / 'a.xml').read_text() == 'v1'
+    (staging / 'a.xml').unlink()
+    (staging / 'a.xml').write_text('v2')
+    publisher.publish()
+    assert live.is_symlink()
+    assert (live / 'a.xml').read_text() == 'v2'
+    
+    publisher.rollback()
+    assert (live / 'a.xml').read_text() == 'v1'
+
+
+def test_first_publish_keeps_real_directory_as_release(tmp_path, monkeypatch):
+    live = tmp_path / 'config'
+    live.mkdir()
+    (live / 'a.xml').write_text('v1')
+    publisher = ReleasePublisher(live)
+    staging = publisher.stage()
+    (staging / 'b.xml').write_text('v1')
+    
+    # El enlace nuevo debe existir antes de apartar el directorio real
+    renames = []
+    rename = os.rename
+    def recording_rename(source, destination):
+        if os.fspath(source) == os.fspath(live):
+            renames.append([name for name in os.listdir(tmp_path) if name.endswith('.link')])
+        rename(source, destination)
+    monkeypatch.setattr(os, 'rename', recording_rename)
+    
+    release = publisher.publish()
+    assert renames == [[f".config.{os.getpid()}.link"]]
+    assert os.path.realpath(live) == str(release)
+    assert sorted(os.listdir(live)) == ['a.xml', 'b.xml']
+    assert len(publisher.releases()) == 2
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.link')]
@@ -0,0 +1,126 @@
+"""
+Pruebas del almacén de dispositivos
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+from device_store import DeviceStore, normalize_mac
+
+
+def make_device(i, **fields):
+    device = {
+        'mac': f'00:11:22:33:{i // 256:02X}:{i % 256:02X}',
+        'model': 'X4U' if i % 2 else 'X3S',
+        'name': f'Teléfono {i % 7}',
+        'username': str(1000 + i),
+        'sip_server': f'sip{i % 3}.example.com',
+        'created_at': '2024-01-01T00:00:00',
+    }
+    device.update(fields)
+    return device
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DeviceStore(str(tmp_path / 'devices.db'))
+
+
+def collect_pages(store, **kwargs):
+    keys = []
+    cursor = None
+    while True:
+        page, cursor = store.page(limit=7, cursor=cursor, **kwargs)
+        keys.extend(key for key, _ in page)
+        if cursor is None:
+            return keys
+
+
+@pytest.mark.parametrize('sort', ['mac', 'name', 'sip_server', 'model'])
+@pytest.mark.parametrize('descending', [False, True])
+def test_cursor_pagination_visits_every_device_in_order(store, sort, descending):
+    devices = [make_device(i) for i in range(50)]
+    store.put_many(devices)
+    
+    field = {'mac': 'mac'}.get(sort, sort)
+    expected = sorted(
+        devices,
+        key=lambda d: (normalize_mac(d['mac']) if sort == 'mac' else d[field].lower(), normalize_mac(d['mac'])),
+        reverse=descending,
+    )
+    assert collect_pages(store, sort=sort, descending=descending) == [normalize_mac(d['mac']) for d in expected]
+
+
+def test_search_by_prefix(store):
+    store.put_many([make_device(i) for i in range(20)])
+    keys = collect_pages(store, search='sip1.')
+    assert keys == sorted(normalize_mac(make_device(i)['mac']) for i in range(20) if i % 3 == 1)
+    assert collect_pages(store, search='001122330005') == ['001122330005']
+
+
+def test_invalid_cursor_and_sort(store):
+    with pytest.raises(ValueError):
+        store.page(sort='password')
+    with pytest.raises(ValueError):
+        store.page(cursor='no-es-un-cursor')
+
+
+def test_legacy_json_is_imported_once(tmp_path):
+    legacy = tmp_path / 'devices.json'
+    legacy.write_text(json.dumps({'001122330001': make_device(1)}))
+    db_path = str(tmp_path / 'devices.db')
+    
+    store = DeviceStore(db_path, legacy_json=str(legacy))
+    assert store.get('00:11:22:33:00:01')['username'] == '1001'
+    store.delete('001122330001')
+    
+    # Al volver a abrir no se reimporta devices.json
+    assert DeviceStore(db_path, legacy_json=str(legacy)).count() == 0
+    assert sqlite3.connect(db_path).execute("PRAGMA user_version").fetchone()[0] == DeviceStore.SCHEMA_VERSION
+
+
+def test_update_keeps_created_at_and_can_change_mac(store):
+    store.put(make_device(1))
+    updated = store.update('001122330001', make_device(2, created_at='otro'))
+    assert updated['created_at'] == '2024-01-01T00:00:00'
+    assert store.get('001122330001') is None
+    assert store.get('001122330002')['created_at'] == '2024-01-01T00:00:00'
+
+
+def test_search_and_filters_fold_non_ascii(store):
+    store.put_many([
+        make_device(1, name='Ñandú'),
+        make_device(2, name='Émile', sip_server='SIP.ÉXAMPLE.com'),
+        make_device(3, name='nube'),
+    ])
+    assert collect_pages(store, search='ñan') == ['001122330001']
+    assert collect_pages(store, search='ÉMI') == ['001122330002']
+    assert store.keys(sip_server='sip.éxample.COM') == ['001122330002']
+    # Orden por código de los valores normalizados: 'nube' < 'émile' < 'ñandú'
+    assert collect_pages(store, sort='name') == ['001122330003', '001122330002', '001122330001']
+
+
+def test_migration_adds_folded_columns(tmp_path):
+    db_path = str(tmp_path / 'devices.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE devices (key TEXT PRIMARY KEY, mac TEXT, model TEXT, name TEXT, username TEXT, password TEXT,"
+        " sip_server TEXT, port TEXT, display_name TEXT, created_at TEXT, updated_at TEXT)"
+    )
+    conn.execute("CREATE INDEX idx_devices_name ON devices (lower(coalesce(name, '')), key)")
+    conn.execute(
+        "INSERT INTO devices (key, mac, model, name) VALUES ('001122330001', '00:11:22:33:00:01', 'X4U', 'Ángela')"
+    )
+    conn.execute("PRAGMA user_version = 3")
+    conn.commit()
+    conn.close()
+    
+    store = DeviceStore(db_path)
+    assert collect_pages(store, search='áng') == ['001122330001']
+    assert store.get('001122330001')['name'] == 'Ángela'
+    plan = store.get_connection().execute(
+        "EXPLAIN QUERY PLAN SELECT key FROM devices ORDER BY name_folded, key"
+    ).fetchall()
+    assert 'idx_devices_name' in ' '.join(row[-1] for row in plan)
@@ -0,0 +1,74 @@
+"""
+Pruebas del cifrado de configuraciones
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from conftest import ROOT
+from fanvil_provisioner import ConfigGenerator, decrypt_file, encryption_key_bytes
+
+
+KEY = '0123456789abcdef0123456789abcdef'
+
+
+def test_key_is_used_verbatim():
+    assert encryption_key_bytes(KEY) == KEY.encode()
+    assert len(encryption_key_bytes(KEY[:16])) == 16
+    with pytest.raises(ValueError):
+        encryption_key_bytes('corta')
+
+
+def test_encrypt_config_round_trip_and_format(tmp_path):
+    content = os.urandom(100 * 1024 + 5)
+    source = tmp_path / '001122334455.cfg'
+    source.write_bytes(content)
+    
+    encrypted = ConfigGenerator(str(tmp_path)).encrypt_config(str(source), KEY)
+    data = open(encrypted, 'rb').read()
+    # Sin cabecera ni IV: solo el contenido con relleno PKCS#7 hasta el siguiente bloque
+    assert len(data) == (len(content) // 16 + 1) * 16
+    assert decrypt_file(encrypted, KEY.encode()) == content
+    
+    # Mismo resultado que AES-256-ECB de una sola vez con la clave tal cual
+    padding = 16 - len(content) % 16
+    encryptor = Cipher(algorithms.AES(KEY.encode()), modes.ECB()).encryptor()
+    assert data == encryptor.update(content + bytes([padding]) * padding) + encryptor.finalize()
+
+
+@pytest.mark.skipif(shutil.which('openssl') is None, reason='requiere openssl')
+def test_openssl_decrypts_with_configured_key(tmp_path):
+    source = tmp_path / '001122334455.cfg'
+    source.write_bytes(b'account.1.sip_server=sip.example.com\n')
+    encrypted = ConfigGenerator(str(tmp_path)).encrypt_config(str(source), KEY)
+    result = subprocess.run(
+        ['openssl', 'enc', '-d', '-aes-256-ecb', '-K', KEY.encode().hex(), '-in', encrypted],
+        capture_output=True, check=True,
+    )
+    assert result.stdout == source.read_bytes()
+
+
+def test_encrypt_configs_command(tmp_path):
+    config_dir = tmp_path / 'config'
+    config_dir.mkdir()
+    for i in range(3):
+        (config_dir / f'00112233445{i}.cfg').write_text(f'account.1.user_id=100{i}\n')
+    (config_dir / 'notas.txt').write_text('sin cifrar')
+    
+    result = subprocess.run(
+        [sys.executable, str(ROOT / 'fanvil_provisioner.py'), '--db', str(tmp_path / 'provision.db'),
+         '--config-dir', str(config_dir), 'encrypt-configs', '--workers', '2'],
+        env={**os.environ, 'FANVIL_ENCRYPTION_KEY': KEY}, capture_output=True, text=True, cwd=tmp_path,
+    )
+    assert result.returncode == 0, result.stderr
+    assert sorted(path.name for path in config_dir.glob('*.enc')) == [f'00112233445{i}.cfg.enc' for i in range(3)]
+    for i in range(3):
+        assert decrypt_file(str(config_dir / f'00112233445{i}.cfg.enc'), KEY.encode()) == f'account.1.user_id=100{i}\n'.encode()
@@ -0,0 +1,28 @@
+"""
+Pruebas del motor de plantillas de generate_fanvil_configs
+"""
+
+import generate_fanvil_configs as gfc
+
+from conftest import ROOT
+
+
+TEMPLATE = (ROOT / 'fanvil-template.xml').read_text(encoding='utf-8')
+
+
+def test_sample_phones_match_reference_configs():
+    for phone_data in gfc.iter_phone_data_from_csv(str(ROOT / 'sample_phones.csv')):
+        gfc.apply_batch_defaults(phone_data)
+        expected = (ROOT / 'test_final' / f"{gfc.clean_mac(phone_data['mac_address'])}.xml").read_text(encoding='utf-8')
+        assert gfc.create_config_from_data(TEMPLATE, phone_data) == expected
+
+
+def test_compile_template_is_cached():
+    assert gfc.compile_template(TEMPLATE) is gfc.compile_template(TEMPLATE)
+
+
+def test_second_account_only_with_user_id():
+    template = f"a{gfc.SECOND_ACCOUNT_START}{{$account.2.user_id}}{gfc.SECOND_ACCOUNT_END}b"
+    assert gfc.create_config_from_data(template, {}) == 'ab'
+    rendered = gfc.create_config_from_data(template, {'account.2.user_id': '1002'})
+    assert rendered == f"a{gfc.SECOND_ACCOUNT_START}1002{gfc.SECOND_ACCOUNT_END}b"
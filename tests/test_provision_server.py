@@ -0,0 +1,211 @@
+"""
+Pruebas del servidor de aprovisionamiento
+"""
+
+import socket
+import threading
+import time
+import http.client
+from contextlib import contextmanager
+
+import pytest
+
+import provision_server
+from conftest import ROOT
+from fanvil_provisioner import DatabaseManager
+from provision_server import (
+    DeviceConfigRenderer, FanvilProvisionHandler, ProvisionHTTPServer, TransferLimiter, wait_until_sent,
+)
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    directory = tmp_path / 'config'
+    directory.mkdir()
+    (directory / '001122334455.cfg').write_text('<<VOIP CONFIG FILE>>Version:2.0000\n')
+    monkeypatch.setattr(provision_server, 'CONFIG_DIR', str(directory))
+    return directory
+
+
+@pytest.fixture
+def db_manager(tmp_path):
+    manager = DatabaseManager(str(tmp_path / 'provision.db'))
+    manager.add_device('00:11:22:33:44:66', 'X4U')
+    manager.set_device_params([('00:11:22:33:44:66', {
+        'sip_server': 'sip.example.com', 'sip_user': '2001', 'sip_password': 'secreto', 'display_name': 'Recepción',
+    })])
+    return manager
+
+
+@contextmanager
+def running_server(workers=4, **handler_attributes):
+    handler = type('Handler', (FanvilProvisionHandler,), handler_attributes)
+    server = ProvisionHTTPServer(('127.0.0.1', 0), handler, workers=workers)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def get(port, path, connection=None):
+    connection = connection or http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return connection, response, response.read()
+
+
+def test_keepalive_serves_several_requests_per_connection(config_dir):
+    with running_server(keepalive_timeout=5) as port:
+        connection, response, body = get(port, '/001122334455.cfg')
+        assert response.status == 200
+        assert response.getheader('Connection') is None
+        _, response, _ = get(port, '/001122334455.cfg', connection)
+        assert response.status == 200
+        connection.close()
+
+
+def test_idle_keepalive_connections_do_not_starve_new_clients(config_dir):
+    # Dos conexiones inactivas ocupan los dos hilos; la tercera no debe esperar al keep-alive
+    with running_server(workers=2, keepalive_timeout=30) as port:
+        idle = [get(port, '/001122334455.cfg')[0] for _ in range(2)]
+        start = time.monotonic()
+        _, response, _ = get(port, '/001122334455.cfg')
+        assert response.status == 200
+        assert time.monotonic() - start < 2
+        for connection in idle:
+            connection.close()
+
+
+def test_idle_keepalive_connection_is_closed_after_timeout(config_dir):
+    with running_server(keepalive_timeout=0.2) as port:
+        connection, response, _ = get(port, '/001122334455.cfg')
+        assert response.status == 200
+        time.sleep(0.5)
+        assert connection.sock.recv(1) == b''
+        connection.close()
+
+
+def test_renderer_maps_provisioner_params_to_template(db_manager):
+    renderer = DeviceConfigRenderer(db_manager, str(ROOT / 'fanvil-template.xml'))
+    entry, hit = renderer.lookup('/001122334466.xml')
+    body = entry.body.decode('utf-8')
+    assert '{$' not in body
+    for value in ('sip.example.com', '2001', 'secreto', 'Recepción'):
+        assert value in body
+    
+    # La plantilla se compila una sola vez mientras no cambie
+    template = renderer._template[1]
+    db_manager.set_device_params([('00:11:22:33:44:66', {'sip_user': '2002'})])
+    assert '2002' in renderer.lookup('/001122334466.xml')[0].body.decode('utf-8')
+    assert renderer._template[1] is template
+
+
+def test_renderer_error_returns_500(config_dir, db_manager):
+    db_manager.get_connection().execute(
+        "UPDATE devices SET config_params = '{no es json' WHERE mac_address = '00:11:22:33:44:66'"
+    )
+    db_manager.get_connection().commit()
+    renderer = DeviceConfigRenderer(db_manager)
+    with running_server(renderer=renderer, keepalive_timeout=5) as port:
+        connection, response, _ = get(port, '/001122334466.cfg')
+        assert response.status == 500
+        # El resto de archivos se sigue sirviendo
+        _, response, _ = get(port, '/001122334455.cfg')
+        assert response.status == 200
+
+
+@pytest.fixture
+def firmware_dir(tmp_path, monkeypatch):
+    directory = tmp_path / 'firmware'
+    directory.mkdir()
+    (directory / 'x4u.bin').write_bytes(bytes(range(256)) * 4096)
+    monkeypatch.setattr(provision_server, 'FIRMWARE_DIR', str(directory))
+    return directory
+
+
+def test_firmware_download_holds_slot_until_sent(config_dir, firmware_dir):
+    limiter = TransferLimiter(1)
+    with running_server(firmware_limiter=limiter, keepalive_timeout=5) as port:
+        connection, response, body = get(port, '/firmware/x4u.bin')
+        assert response.status == 200
+        assert body == (firmware_dir / 'x4u.bin').read_bytes()
+        # Terminada la descarga, el turno vuelve a estar libre
+        _, response, _ = get(port, '/firmware/x4u.bin', connection)
+        assert response.status == 200
+
+
+def test_firmware_rejected_immediately_without_free_slot(config_dir, firmware_dir):
+    with running_server(firmware_limiter=TransferLimiter(0, retry_after=7)) as port:
+        start = time.monotonic()
+        _, response, body = get(port, '/firmware/x4u.bin')
+        assert response.status == 503
+        assert response.getheader('Retry-After') == '7'
+        assert time.monotonic() - start < 1
+
+
+@pytest.mark.skipif(provision_server._SIOCOUTQ is None, reason='requiere SIOCOUTQ (Linux)')
+def test_wait_until_sent_waits_for_client():
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    server.setblocking(False)
+    sent = 0
+    try:
+        while True:
+            sent += server.send(b'x' * 65536)
+    except BlockingIOError:
+        pass
+    
+    # El cliente no lee: el envío no avanza
+    assert not wait_until_sent(server, 0.2)
+    
+    def read_all():
+        received = 0
+        while received < sent:
+            received += len(client.recv(1024 * 1024))
+    reader = threading.Thread(target=read_all)
+    reader.start()
+    assert wait_until_sent(server, 5)
+    reader.join()
+    for sock in (client, server, listener):
+        sock.close()
+
+
+@pytest.mark.parametrize('cache', [provision_server.ConfigCache(), None])
+def test_path_with_nul_byte_returns_404(config_dir, cache):
+    with running_server(cache=cache, keepalive_timeout=5) as port:
+        connection, response, _ = get(port, '/0011%0022334455.cfg')
+        assert response.status == 404
+        _, response, _ = get(port, '/001122334455.cfg', connection)
+        assert response.status == 200
+        connection.close()
+
+
+def test_disabled_cache_still_negotiates_gzip_and_304(config_dir):
+    (config_dir / '001122334455.cfg').write_text('<<VOIP CONFIG FILE>>Version:2.0000\n' + 'sip_server=sip.example.com\n' * 50)
+    cache = provision_server.ConfigCache(0)
+    with running_server(cache=cache, keepalive_timeout=5) as port:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        connection.request('GET', '/001122334455.cfg', headers={'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200
+        assert response.getheader('Content-Encoding') == 'gzip'
+        etag = response.getheader('ETag')
+        
+        connection.request('GET', '/001122334455.cfg', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 304
+        connection.close()
+    assert cache.size == 0
+
+
+def test_firmware_path_with_nul_byte_returns_404(config_dir, firmware_dir):
+    with running_server(keepalive_timeout=5) as port:
+        connection, response, _ = get(port, '/firmware/x4u%00.bin')
+        assert response.status == 404
+        connection.close()
@@ -0,0 +1,34 @@
+"""
+Pruebas del aprovisionamiento desde archivo de fanvil_provisioner
+"""
+
+import json
+
+from fanvil_provisioner import FanvilProvisioner
+
+
+def test_results_follow_input_order_and_keep_invalid_macs(tmp_path):
+    source = tmp_path / 'devices.csv'
+    source.write_text(
+        'mac_address,model,sip_user\n'
+        '00:11:22:33:44:01,X4U,1001\n'
+        '00:11:22:33:44:02,,1002\n'
+        '00:11:22:33:44:03,X4U,1003\n'
+        ',X4U,1004\n'
+        '00:11:22:33:44:05,X4U,1005\n'
+    )
+    results_path = tmp_path / 'results.jsonl'
+    provisioner = FanvilProvisioner(str(tmp_path / 'provision.db'), str(tmp_path / 'config'))
+    
+    summary = provisioner.provision_from_file(str(source), 'csv', batch_size=2, results_path=str(results_path), progress=False)
+    assert (summary['rows'], summary['provisioned'], summary['invalid'], summary['failed']) == (5, 3, 2, 0)
+    
+    results = [json.loads(line) for line in results_path.read_text().splitlines()]
+    assert [(result['row'], result['mac_address'], result['status']) for result in results] == [
+        (1, '00:11:22:33:44:01', 'provisioned'),
+        (2, '00:11:22:33:44:02', 'invalid'),
+        (3, '00:11:22:33:44:03', 'provisioned'),
+        (4, None, 'invalid'),
+        (5, '00:11:22:33:44:05', 'provisioned'),
+    ]
+    assert (tmp_path / 'config' / '001122334405.cfg').read_text() == 'sip_user=1005'
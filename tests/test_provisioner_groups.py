@@ -0,0 +1,125 @@
+"""
+Pruebas de los grupos de configuración de fanvil_provisioner
+"""
+
+import json
+
+import pytest
+
+from fanvil_provisioner import ConfigGenerator, DatabaseManager, ProvisioningEngine
+from provision_server import DeviceConfigRenderer
+
+
+MAC = '00:11:22:33:44:77'
+
+
+@pytest.fixture
+def db_manager(tmp_path):
+    return DatabaseManager(str(tmp_path / 'provision.db'))
+
+
+@pytest.fixture
+def engine(tmp_path, db_manager):
+    return ProvisioningEngine(db_manager, ConfigGenerator(str(tmp_path / 'config')))
+
+
+def cfg_params(tmp_path):
+    lines = (tmp_path / 'config' / '001122334477.cfg').read_text().splitlines()
+    return dict(line.split('=', 1) for line in lines)
+
+
+def served_params(db_manager):
+    entry, _ = DeviceConfigRenderer(db_manager).lookup('/001122334477.cfg')
+    return dict(line.split('=', 1) for line in entry.body.decode().splitlines())
+
+
+def test_add_to_group_then_update_group_reaches_device(tmp_path, db_manager, engine):
+    engine.provision_device(MAC, 'X4U', {'sip_server': 'sip.acme.com', 'sip_user': '3001'})
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com'})
+    
+    assert engine.add_to_group(MAC, group_id)
+    assert json.loads(db_manager.get_device_config(MAC)['config_params']) == {'sip_user': '3001'}
+    assert cfg_params(tmp_path)['sip_server'] == 'sip.acme.com'
+    
+    engine.update_group(group_id, {'sip_server': 'nuevo.acme.com', 'ntp_server': 'ntp.acme.com'})
+    for params in (cfg_params(tmp_path), served_params(db_manager)):
+        assert params == {'sip_server': 'nuevo.acme.com', 'ntp_server': 'ntp.acme.com', 'sip_user': '3001'}
+
+
+def test_add_to_group_keeps_device_overrides(tmp_path, db_manager, engine):
+    engine.provision_device(MAC, 'X4U', {'sip_server': 'propio.example.com', 'sip_user': '3001'})
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com'})
+    
+    assert engine.add_to_group(MAC, group_id)
+    stored = {'sip_server': 'propio.example.com', 'sip_user': '3001'}
+    assert json.loads(db_manager.get_device_config(MAC)['config_params']) == stored
+    assert cfg_params(tmp_path) == {**stored, 'ntp_server': 'ntp.acme.com'}
+
+
+def test_provision_device_in_group_stores_only_overrides(tmp_path, db_manager, engine):
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com'})
+    engine.provision_batch([{'mac_address': MAC, 'model': 'X4U'}], group_id=group_id)
+    
+    engine.provision_device(MAC, 'X4U', {'sip_server': 'sip.acme.com', 'sip_user': '3002'})
+    assert json.loads(db_manager.get_device_config(MAC)['config_params']) == {'sip_user': '3002'}
+    
+    engine.update_group(group_id, {'sip_server': 'nuevo.acme.com'})
+    assert cfg_params(tmp_path) == {'sip_server': 'nuevo.acme.com', 'sip_user': '3002'}
+
+
+def test_batch_with_common_params_creates_no_group(tmp_path, db_manager, engine):
+    results = engine.provision_batch(
+        [{'mac_address': MAC, 'model': 'X4U', 'specific_params': {'sip_user': '3003'}}],
+        group_params={'sip_server': 'sip.lote.com'},
+    )
+    assert results == [True]
+    assert db_manager.get_device(MAC)['group_id'] is None
+    assert db_manager.get_connection().execute("SELECT COUNT(*) FROM groups").fetchone()[0] == 0
+    expected = {'sip_server': 'sip.lote.com', 'sip_user': '3003'}
+    assert json.loads(db_manager.get_device_config(MAC)['config_params']) == expected
+    assert cfg_params(tmp_path) == expected
+
+
+def test_batch_keeps_existing_group_members_in_their_group(tmp_path, db_manager, engine):
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com'})
+    engine.provision_batch([{'mac_address': MAC, 'model': 'X4U'}], group_id=group_id)
+    
+    engine.provision_batch(
+        [{'mac_address': MAC, 'model': 'X4U', 'specific_params': {'sip_user': '3005'}}],
+        group_params={'sip_server': 'sip.acme.com'},
+    )
+    assert db_manager.get_device(MAC)['group_id'] == group_id
+    assert json.loads(db_manager.get_device_config(MAC)['config_params']) == {'sip_user': '3005'}
+    assert cfg_params(tmp_path) == {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com', 'sip_user': '3005'}
+    
+    engine.provision_batch([{'mac_address': MAC, 'model': 'X4U', 'specific_params': {'sip_user': '3005'}}])
+    assert cfg_params(tmp_path) == {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com', 'sip_user': '3005'}
+
+
+def test_migration_strips_group_owned_params(tmp_path, db_manager):
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com'})
+    db_manager.add_device(MAC, 'X4U')
+    db_manager.set_devices_group([MAC], group_id)
+    db_manager.set_device_params([(MAC, {'sip_server': 'sip.acme.com', 'sip_user': '3004'})])
+    conn = db_manager.get_connection()
+    conn.execute("PRAGMA user_version = 5")
+    conn.commit()
+    db_manager.close()
+    
+    migrated = DatabaseManager(db_manager.db_path)
+    assert json.loads(migrated.get_device_config(MAC)['config_params']) == {'sip_user': '3004'}
+    assert migrated.get_connection().execute("PRAGMA user_version").fetchone()[0] == DatabaseManager.SCHEMA_VERSION
+
+
+def test_migration_keeps_device_overrides_of_group_keys(tmp_path, db_manager):
+    group_id = db_manager.add_group('acme', '', {'sip_server': 'sip.acme.com', 'ntp_server': 'ntp.acme.com'})
+    db_manager.add_device(MAC, 'X4U')
+    db_manager.set_devices_group([MAC], group_id)
+    db_manager.set_device_params([(MAC, {'sip_server': 'propio.example.com', 'ntp_server': 'ntp.acme.com'})])
+    conn = db_manager.get_connection()
+    conn.execute("PRAGMA user_version = 5")
+    conn.commit()
+    db_manager.close()
+    
+    migrated = DatabaseManager(db_manager.db_path)
+    assert json.loads(migrated.get_device_config(MAC)['config_params']) == {'sip_server': 'propio.example.com'}